@@ -18,213 +18,338 @@ import numpy as np
 import random
 from random import randint
 from PIL import Image, ImageDraw, ImageFilter, ImageEnhance
-from skimage.segmentation import felzenszwalb
-from math import sqrt, acos, degrees, ceil, floor
-import warnings
+from math import sqrt
 import os
+import time
 
 # own imports:
 import imgIO
 import brushstroke
+import segments
+import canvas
+import tiling
+import profiling
+import orientation
 
 
 # give each felzenszwalb segment a random color to improve their visibility and save the clusters as a new image
-def saveClusteredImage(inPix, segmentsByIDlist, width, height, filename):
-    im, pix = imgIO.createWhiteImg(width, height)
-    for segment in range(0,len(segmentsByIDlist)):
-        RGB = inPix[segmentsByIDlist[segment][0][0], segmentsByIDlist[segment][0][1]]
-        for p in range (0, len(segmentsByIDlist[segment])):
-            pix[segmentsByIDlist[segment][p][0], segmentsByIDlist[segment][p][1]] = RGB
-    im.save(filename + "_clustered.png")
-    del im
-    del pix
-    im, pix = imgIO.createWhiteImg(width, height)
-    for segment in range(0,len(segmentsByIDlist)):
-        RGB = (randint(0,255), randint(0,255), randint(0,255))
-        for p in range (0, len(segmentsByIDlist[segment])):
-            pix[segmentsByIDlist[segment][p][0], segmentsByIDlist[segment][p][1]] = RGB
-    im.save(filename + "_clustered_randomColor.png")
-    del im
-    del pix
-
-
-
-# color each segment in outPix with the color inPix contains at that position:
-def colorImgSegments(inPix, segmentsByIDlist, outPix):
-    for segment in range(0, len(segmentsByIDlist)):
-        RGB = inPix[segmentsByIDlist[segment][0][0], segmentsByIDlist[segment][0][1]]
-        for p in range (0, len(segmentsByIDlist[segment])):
-            outPix[segmentsByIDlist[segment][p][0], segmentsByIDlist[segment][p][1]] = RGB
-    return outPix
-
-
-def colorBackground(inIm, inPix, segmentsByIDlist, outIm, outPix, background="blur"):
+# palette: the color of every segment, indexed by segmentID (see segments.SegmentTable.byID())
+def saveClusteredImage(palette, segmentIndex, filename):
+    colorImgSegments(palette, segmentIndex).save(filename + "_clustered.png")
+    palette = np.array([(randint(0,255), randint(0,255), randint(0,255)) for segment in range(0, len(segmentIndex))], dtype=np.uint8).reshape(-1, 3)
+    randomColorsCanvas = canvas.Canvas(Image.new("RGBA", (segmentIndex.width, segmentIndex.height)))
+    randomColorsCanvas.fillSegments(segmentIndex.labels, palette)
+    randomColorsCanvas.toImage().save(filename + "_clustered_randomColor.png")
+
+
+
+# returns an RGBA image with each segment colored with its color in palette (indexed by segmentID), e.g. the color of its first pixel:
+def colorImgSegments(palette, segmentIndex):
+    clusterCanvas = canvas.Canvas(Image.new("RGBA", (segmentIndex.width, segmentIndex.height)))
+    clusterCanvas.fillSegments(segmentIndex.labels, palette)
+    return clusterCanvas.toImage()
+
+
+# inIm: the (saturated) input image for the blurred background, made from inPixNP if None
+# segmentTable: the segments.SegmentTable giving the colors of the segments of the clustered background
+def colorBackground(inIm, inPixNP, segmentIndex, segmentTable, outIm, outPix, background="blur"):
     if background == "blur": # use the blurred input image as background for the output image
+        if inIm == None:
+            inIm = Image.fromarray(inPixNP)
         outIm = inIm.filter(ImageFilter.BLUR)
         outPix = outIm.load()
     elif background == "cluster":
-        outPix = colorImgSegments(inPix, segmentsByIDlist, outPix)
+        outIm = colorImgSegments(segmentTable.byID("color"), segmentIndex)
+        outPix = outIm.load()
     return outIm, outPix
 
 
-def getOutfileName(path, output_dir, infile):
+# returns the name of infile without its extension and the name of an output file in path + output_dir which does not exist yet: FILE + appendix + ".png", with appendix repeated until the name is unused
+# reserve: if True, the output file is created (empty) in the same step as the name is found to be unused, so that conversions running in parallel (main.py --jobs) never get the same name,
+#   e.g. for input images of the same name with different extensions
+def getOutfileName(path, output_dir, infile, appendix="__out", reserve=False):
     extension = ".png"
-    appendix = "__out"
+    suffix = appendix
     outfileTmp = infile.split('.')
     filename = ''
     for namepiece in range(0, len(outfileTmp) - 1):
         filename = filename + outfileTmp[namepiece]
-    i = 0
     outfile = path + output_dir + filename
-    while True or i < 500:
-        if os.path.exists(outfile + appendix + extension):
-            appendix = appendix + "__out"
-        else:
-            outfile = outfile + appendix + extension
+    while True:
+        if reserve:
+            try:
+                os.close(os.open(outfile + appendix + extension, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+                break
+            except FileExistsError:
+                pass
+        elif not os.path.exists(outfile + appendix + extension):
             break
-    return filename, outfile
+        appendix = appendix + suffix
+    return filename, outfile + appendix + extension
 
 
-def clustering(inPixNP, width, height, scale=50, sigma=4.5, min_size=10):
+# lean: if True, the labels are returned as int32 instead of felzenszwalb()'s int64
+def clustering(inPixNP, width, height, scale=50, sigma=4.5, min_size=10, lean=False):
+    from skimage.segmentation import felzenszwalb  # imported here, as importing skimage (and scipy with it) takes longer than starting everything else
     segmentsNP = felzenszwalb(inPixNP, scale, sigma, min_size)
+    if lean:
+        segmentsNP = segmentsNP.astype(np.int32)
     # felzenszwalb(image, scale=1, sigma=0.8, min_size=20)
     # image : (width, height, 3) or (width, height) ndarray - Input image.
     # scale : float - Free parameter. Higher means larger clusters.
     # sigma : float - Width of Gaussian kernel used in preprocessing.
     # min_size : int - Minimum component size. Enforced using postprocessing.
     
-    # create a data structure with regionIDs as keys and lists of their pixel coordinates as values:
-    maxSegmentID = np.max(segmentsNP)
-    segmentsByIDlist = [[] for i in range(maxSegmentID + 1)]
-    for y in range(0,height):
-        for x in range(0,width):
-            regionID = segmentsNP[y,x]
-            segmentsByIDlist[regionID].append((x, y))
-    return segmentsNP, segmentsByIDlist
+    # index the pixel coordinates of every regionID:
+    segmentIndex = segments.SegmentIndex(segmentsNP)
+    return segmentsNP, segmentIndex
+
+
+# A preview (see convertImage()) should take about previewLatency seconds, one half of which is spent on the pixels (segmentation, background) and the other on the brush strokes.
+# PREVIEW_PIXELS_PER_SECOND and PREVIEW_STROKES_PER_SECOND are rough rates at which convertImage() gets through pixels and (small) brush strokes with the default settings.
+PREVIEW_LATENCY = 2.0
+PREVIEW_PIXELS_PER_SECOND = 150000
+PREVIEW_STROKES_PER_SECOND = 600
+
+
+# returns the factor by which an image of size width x height is downscaled for a preview, so that its pixels take about previewLatency / 2 seconds (at least 1, images are never upscaled)
+def getPreviewScale(width, height, previewLatency=PREVIEW_LATENCY):
+    return max(1.0, sqrt(width * height / (previewLatency / 2 * PREVIEW_PIXELS_PER_SECOND)))
+
 
+# Downscaling does not make a preview paint fewer brush strokes, as the strokes and their spacing shrink with the image.
+# Returns the factor by which the strokes of the preview are enlarged (and spaced wider) instead, so that their number, estimated from the full-size stroke density, takes about previewLatency / 2 seconds.
+# The other arguments are those of setParameters() for the full-size image.
+def getPreviewStrokeScale(width, height, previewLatency=PREVIEW_LATENCY, randSizes=100, longStrokes=False, strokeWidth=None, strokeHeight=None, strokeDensity=None):
+    complex_sizeX, complex_sizeY, stroke_density = setParameters(width, height, False, randSizes, longStrokes, strokeWidth, strokeHeight, strokeDensity)
+    numOfStrokes = (width * height) / stroke_density**2  # one stroke per grid point
+    return max(1.0, sqrt(numOfStrokes / (previewLatency / 2 * PREVIEW_STROKES_PER_SECOND)))
 
+
+# scales the felzenszwalb label array of a preview up to width x height (nearest neighbour, so the segments stay connected) and indexes it like clustering() does
+def scaleSegmentation(previewSegmentsNP, width, height):
+    previewHeight, previewWidth = previewSegmentsNP.shape
+    rows = np.arange(height) * previewHeight // height
+    columns = np.arange(width) * previewWidth // width
+    segmentsNP = previewSegmentsNP[rows[:, None], columns]
+    segmentIndex = segments.SegmentIndex(segmentsNP)
+    return segmentsNP, segmentIndex
+
+
+# returns the x and y coordinates of the points of the regression line between minX and maxX as two int32 arrays, without the points lying outside of the image
 def getRegLineCoordinates(minX, maxX, regression, height):
-    # create an array regLine with all x and y coordinates of the regression line
     start = regression[0]*(minX**2) + regression[1]*minX + regression[2]
     stop = regression[0]*(maxX**2) + regression[1]*maxX + regression[2]
     numOfPointsX = euclidDist((minX, start), (maxX, stop))
     stepSize = (maxX - minX) / numOfPointsX
-    pointsX = (np.arange(minX, maxX + 1, stepSize)).tolist()
-    pointsY = list(pointsX)
-    
-    stopLen = len(pointsY)
-    pointY = 0
-    while pointY < stopLen:
-        pointsY[pointY] = int(regression[0]*(pointsY[pointY]**2) + regression[1]*pointsY[pointY] + regression[2])
-        if pointsY[pointY] < 0 or pointsY[pointY] > height - 1: # this regression point is out of range of the input image, so discard it
-            del pointsX[pointY]
-            del pointsY[pointY]
-            stopLen = stopLen - 1
-        else:
-            pointY = pointY + 1
-    return [[int(i) for i in pointsX], [int(i) for i in pointsY]]
-
-
-
-# compute regression lines and rotated bounding boxes of all segments
-# linear regression if the mean squared error is small enough, quadratic regression otherwise
-def getSegmentParams(segmentsByIDlist_sorted, inPix, drawRegressionLines, inImCopy, inPixCopy, width, height):
-    
-    segmentParams = []
-    maxSegmentID = len(segmentsByIDlist_sorted) - 1
+    pointsX = np.arange(minX, maxX + 1, stepSize)
+    pointsY = np.trunc(regression[0]*(pointsX**2) + regression[1]*pointsX + regression[2])
+    inside = (pointsY >= 0) & (pointsY <= height - 1)  # discard the regression points out of range of the input image
+    return [pointsX[inside].astype(np.int32), pointsY[inside].astype(np.int32)]
+
+
+
+# returns the normalization of the coordinates of every segment to its bounding box used by getSegmentMoments(): t = (x - centerX) * scaleX lies in [-1, 1] and u = y - centerY
+def getBoxNormalization(minX, maxX, minY, maxY):
+    return (minX + maxX) / 2, 2 / np.maximum(1, maxX - minX), (minY + maxY) / 2
+
+
+# Accumulates the moment sums of all segments in one pass over the label array, a block of rows at a time, with np.bincount():
+# the sums of t^0 .. t^4, of t^0 .. t^2 * u and of u^2 over the pixels of each segment (see getBoxNormalization()), and the sums of the colors its pixels have in the image array pixelsNP.
+# Returns the arrays (moments, colorSums, minX, maxX, minY, maxY), indexed by segmentID. moments has shape (9, numOfSegments), in the order above, colorSums shape (numOfSegments, 3).
+def getSegmentMoments(segmentIndex, pixelsNP, blockRows=256):
+    numOfSegments = len(segmentIndex)
+    width = segmentIndex.width
+    
+    minX, maxX, minY, maxY = segmentIndex.boundingBoxes()
+    centerX, scaleX, centerY = getBoxNormalization(minX, maxX, minY, maxY)
+    moments = np.zeros((9, numOfSegments))
+    colorSums = np.zeros((numOfSegments, 3))
+    columns = np.arange(width)
+    for top, labels in segmentIndex.labelBands(blockRows):
+        rows = np.arange(top, top + labels.shape[0])
+        band = np.asarray(pixelsNP[top:top + labels.shape[0]])
+        labels = labels.ravel()
+        t = (np.tile(columns, len(rows)) - centerX[labels]) * scaleX[labels]
+        u = np.repeat(rows, width) - centerY[labels]
+        power = np.ones(len(labels))
+        for k in range(0, 5):
+            moments[k] += np.bincount(labels, power, numOfSegments)
+            if k < 3:
+                moments[5 + k] += np.bincount(labels, power * u, numOfSegments)
+            power *= t
+        moments[8] += np.bincount(labels, u * u, numOfSegments)
+        for channel in range(0, 3):
+            colorSums[:, channel] += np.bincount(labels, band[:, :, channel].ravel(), numOfSegments)
+    return moments, colorSums, minX, maxX, minY, maxY
+
+
+# Fits the quadratic regression lines y = a*x^2 + b*x + c of all segments at once from their moments (see getSegmentMoments()), instead of calling np.polyfit() for every segment.
+# x is normalized to t in [-1, 1] on each segment's bounding box, which keeps the 3x3 normal equations well conditioned. Then all normal equations are solved in one call.
+# Returns the arrays (coefficients, fitted), indexed by segmentID. coefficients has shape (numOfSegments, 3), highest power first like the result of np.polyfit().
+# fitted is False where np.polyfit() would raise a RankWarning, i.e. for segments with less than 3 different x coordinates:
+# Felzenszwalb segments are connected, so a segment covers every column between minX and maxX and has maxX - minX + 1 different x coordinates.
+def fitSegmentRegressions(moments, minX, maxX, minY, maxY):
+    centerX, scaleX, centerY = getBoxNormalization(minX, maxX, minY, maxY)
+    fitted = maxX - minX >= 2
+    normalMatrices = moments[[[4, 3, 2], [3, 2, 1], [2, 1, 0]]].transpose(2, 0, 1)
+    normalMatrices[~fitted] = np.identity(3)  # not solvable, the result is not used
+    a, b, c = np.linalg.solve(normalMatrices, moments[[7, 6, 5]].T[:, :, None])[:, :, 0].T
+    
+    # transform back from t = (x - centerX) * scaleX to x:
+    a2 = a * scaleX**2
+    coefficients = np.column_stack((a2, b * scaleX - 2 * a2 * centerX, a2 * centerX**2 - b * scaleX * centerX + c + centerY))
+    return coefficients, fitted
+
+
+# returns the y coordinates of the first and last point of the regression lines getRegLineCoordinates() would compute for the arrays minX, maxX and coefficients,
+# and whether both lie within the image (and thus are the first and last point of the regression line)
+def getRegLineEndpoints(minX, maxX, coefficients, height):
+    a, b, c = coefficients.T
+    start = a*(minX**2) + b*minX + c
+    stop = a*(maxX**2) + b*maxX + c
+    with np.errstate(invalid='ignore', divide='ignore'):  # segments with minX == maxX have no regression line
+        stepSize = (maxX - minX) / np.sqrt((maxX - minX)**2 + (stop - start)**2)
+        lastX = minX + (np.ceil((maxX + 1 - minX) / stepSize) - 1) * ((minX + stepSize) - minX)  # last value of np.arange(minX, maxX + 1, stepSize)
+    startY = np.trunc(a*(minX**2) + b*minX + c)
+    stopY = np.trunc(a*(lastX**2) + b*lastX + c)
+    inside = (startY >= 0) & (startY <= height - 1) & (stopY >= 0) & (stopY <= height - 1)
+    return startY, stopY, inside
+
+
+# returns the angles by which segments have to be rotated to make them upright, from the y coordinates startY and stopY of the ends of their regression lines
+def getRegLineAngles(minX, maxX, startY, stopY):
+    hypotenuse = np.sqrt((maxX - minX)**2 + (stopY - startY)**2)
+    adjacent = np.abs(stopY - startY)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        angles = np.degrees(np.arccos(adjacent / hypotenuse))
+    angles = np.where(stopY > startY, -angles, angles)  # if both x and y coordinate increase, we have to rotate clockwise by angle, otherwise counter-clockwise
+    return np.where(minX != maxX, angles, 0)
+
+
+# draws the regression line regLine in yellow with the ImageDraw inCopyDraw
+def drawRegLine(inCopyDraw, regLine, width, height):
+    # get coordinates that lie on this regression line and WITHIN the borders of the input picture
+    points = np.column_stack((np.clip(regLine[0], 0, width-1), np.clip(regLine[1], 0, height-1)))
+    inCopyDraw.point([tuple(point) for point in points.tolist()], fill=(255,255,0))
+
+
+# Builds the segments.SegmentTable of all non-empty segments of segmentIndex in painting order, with their regression lines and the angles by which they are rotated upright,
+# from one pass over the label array and the (saturated) input image array inPixNP (see getSegmentMoments()). The stroke classes are left to classifySegments().
+# blockRows: the number of rows of the label array getSegmentMoments() processes at once
+def getSegmentTable(segmentIndex, inPixNP, drawRegressionLines, inImCopy, width, height, blockRows=256):
     
     if drawRegressionLines:
         inCopyDraw = ImageDraw.Draw(inImCopy)
+    
+    degree = 2 # degree of polynomial regression used
+    moments, colorSums, minXs, maxXs, minYs, maxYs = getSegmentMoments(segmentIndex, inPixNP, blockRows)
+    coefficients, fitted = fitSegmentRegressions(moments, minXs, maxXs, minYs, maxYs)
+    startYs, stopYs, endpointsInside = getRegLineEndpoints(minXs, maxXs, coefficients, height)
+    angles = getRegLineAngles(minXs, maxXs, startYs, stopYs)
+    
+    sortedSegmentIDs = sortSegmentsBySize(segmentIndex)
+    sortedSegmentIDs = sortedSegmentIDs[segmentIndex.sizes[sortedSegmentIDs] > 0]
+    rows = np.zeros(len(sortedSegmentIDs), dtype=segments.SEGMENT_TABLE_DTYPE)
+    rows["segmentID"] = sortedSegmentIDs
+    rows["area"] = segmentIndex.sizes[sortedSegmentIDs]
+    rows["minX"], rows["minY"], rows["maxX"], rows["maxY"] = minXs[sortedSegmentIDs], minYs[sortedSegmentIDs], maxXs[sortedSegmentIDs], maxYs[sortedSegmentIDs]
+    rows["color"] = segments.getPalette(segmentIndex, inPixNP, blockRows)[sortedSegmentIDs]
+    rows["meanColor"] = colorSums[sortedSegmentIDs] / rows["area"][:, None]
+    
+    # the centroids and central second moments, from the moment sums of t = (x - centerX) * scaleX and u = y - centerY:
+    centerX, scaleX, centerY = getBoxNormalization(minXs, maxXs, minYs, maxYs)
+    numOfPixels = moments[0]
+    with np.errstate(invalid='ignore', divide='ignore'):  # empty segments
+        meanX = moments[1] / scaleX / numOfPixels
+        meanY = moments[5] / numOfPixels
+        momentXX = moments[2] / scaleX**2 / numOfPixels - meanX**2
+        momentXY = moments[6] / scaleX / numOfPixels - meanX * meanY
+        momentYY = moments[8] / numOfPixels - meanY**2
+    rows["centroidX"] = (centerX + meanX)[sortedSegmentIDs]
+    rows["centroidY"] = (centerY + meanY)[sortedSegmentIDs]
+    rows["momentXX"], rows["momentXY"], rows["momentYY"] = momentXX[sortedSegmentIDs], momentXY[sortedSegmentIDs], momentYY[sortedSegmentIDs]
+    rows["orientation"] = np.degrees(0.5 * np.arctan2(2 * rows["momentXY"], rows["momentXX"] - rows["momentYY"]))
+    
+    rows["regression"] = np.nan
+    rows["angle"] = np.nan
+    rows["strokeClass"] = segments.STROKE_NONE
+    regLineLengths = np.zeros(len(rows), dtype=np.int64)
+    regLines = []
+    for row in range(0, len(rows)):
+        segmentID = int(sortedSegmentIDs[row])
         
-    for segmentIndex in range(0, maxSegmentID + 1):
-        regLine = []
-        xList = [x[0] for x in segmentsByIDlist_sorted[segmentIndex][1]]  # list of all x coordinates of this segment
-        yList = [x[1] for x in segmentsByIDlist_sorted[segmentIndex][1]]
-        
-        degree = 2 # degree of polynomial regression used
+        if rows["area"][row] <= degree+6: # not enough data for a regression
+            continue
+        minX = int(minXs[segmentID])
+        maxX = int(maxXs[segmentID])
+        minY = int(minYs[segmentID])
+        maxY = int(maxYs[segmentID])
         
-        # compute the coefficients of the regression line:
-        if len(xList) <= degree+6 or len(yList) <= degree+6: # to fix "ValueError: On entry to DLASCL parameter number 4 had an illegal value" which occurs when there is not enough data for a regression
+        if minX == maxX or minY == maxY: # because if all the elements in either list are identical, the regression would fail
+            xArr, yArr = segmentIndex.pixels(segmentID)  # all x and y coordinates of this segment
+            regLine = [xArr.astype(np.int32), yArr.astype(np.int32)]
+            angle = getRegLineAngles(minX, maxX, regLine[1][0], regLine[1][-1])
+        elif not fitted[segmentID]: # np.polyfit() would have raised a RankWarning: there's not enough data to do regression properly
             continue
-        minX = min(xList)
-        maxX = max(xList)
-        minY = min(yList)
-        maxY = max(yList)
-            
-        if xList[1:] == xList[:-1] or yList[1:] == yList[:-1]: # because if all the elements in either list are  identical, the regression will fail and the program will exit
-            regLine = [xList, yList]
-        else: # do the regression
-            regressionSuccessful = False
-            with warnings.catch_warnings():
-                warnings.filterwarnings('error')
-                try:
-                    regression = np.polyfit(xList, yList, degree)
-                    regressionSuccessful = True
-                except np.RankWarning: # RankWarning means there's not enough data to do regression properly
-                    #print("not enough data for segmentID "+str(segmentID))
-                    regressionSuccessful = False
-            
-            if not regressionSuccessful:
-                continue
-            
+        else:
+            regression = coefficients[segmentID]
             # compute the values of the regression line (pointsX = all x-coordinates, pointsY = all y-coordinates):
             pointsX, pointsY = getRegLineCoordinates(minX, maxX, regression, height)
             regLine = [pointsX, pointsY]
+            if len(pointsY) == 0: # the whole regression line lies outside of the image
+                continue
+            if endpointsInside[segmentID]:
+                angle = angles[segmentID]
+            else:  # the first or last points of the regression line were discarded
+                angle = getRegLineAngles(minX, maxX, pointsY[0], pointsY[-1])
+            rows["regression"][row] = regression
+            
+            if drawRegressionLines:
+                drawRegLine(inCopyDraw, regLine, width, height)
         
-        startPoint = regLine[1][0]  # y coordinate of the regression line starting point
-        stopPoint = regLine[1][-1]  # y coordinate of the regression line starting point
-        
-        if drawRegressionLines:
-            for i in range(0, len(pointsY)):
-                # get coordinates that lie on this regression line and WITHIN the borders of the input picture
-                inPixCopy[min(max(0,pointsX[i]), width-1), min(max(0,pointsY[i]),height-1)] = (255,255,0)
-        
-        
-        # compute the angle of the regression line:
-        angle = 0
-        if minX != maxX:
-            hypotenuse = sqrt((maxX - minX)**2 + (stopPoint - startPoint)**2)
-            adjacent = abs(stopPoint - startPoint)
-            if stopPoint > startPoint: # both x and y coordinate increase; we have to rotate clockwise by angle
-                angle = -degrees(acos(adjacent / hypotenuse))
-            elif stopPoint <= startPoint: # rotate counter-clockwise by angle to make segment upright
-                angle = degrees(acos(adjacent / hypotenuse))
-        
-        segmentID = segmentsByIDlist_sorted[segmentIndex][0]
-        numOfPixels = len(segmentsByIDlist_sorted[segmentIndex][1]) - 1
-        # bboxN contains the absolute coordinates of the segment's not-rotated bounding box and should be used to determine the segment's position in the input image.
-        bboxN = [minX, minY, maxX, maxY]
-        segmentParams.append([segmentID, regLine, angle, bboxN, degree, numOfPixels, regression])
-    return segmentParams
+        rows["angle"][row] = angle
+        rows["strokeClass"][row] = segments.STROKE_UNCLASSIFIED
+        regLineLengths[row] = len(regLine[0])
+        regLines.append(regLine)
+    
+    regLineOffsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(regLineLengths, out=regLineOffsets[1:])
+    regLineX = np.concatenate([regLine[0] for regLine in regLines] + [np.zeros(0, dtype=np.int32)]).astype(np.int32)
+    regLineY = np.concatenate([regLine[1] for regLine in regLines] + [np.zeros(0, dtype=np.int32)]).astype(np.int32)
+    return segments.SegmentTable(rows, regLineOffsets, regLineX, regLineY, len(segmentIndex))
 
 
 def euclidDist(p1, p2):
     return sqrt((p1[0] - p2[0])**2 + (p1[1] - p2[1])**2)
 
 
-# compute a list of random coordinates within this segment where to place complex brushstrokes
-# segment is a list of coordinate tuples of this segment
-def getStrokePositions(segment, stroke_density, minX, minY, maxX, maxY):
-    coordinates = []
-    for x in range(minX, maxX + 1, stroke_density):
-        for y in range(minY, maxY + 1, stroke_density):
-            
-            if (x, y) in segment:
-                coordinates.append([x, y])
-    random.shuffle(coordinates)
-    return coordinates
-
-
-
-# This function returns the difference between the color of a segment and the colors of its neighboring pixels (the four pixels lying just outside the segment's unrotated bounding box)
-def differenceToNeighbors(segmentID, segmentsByIDlistNP, inPix, minX, minY, maxX, maxY):
-    segmentRepresentative = segmentsByIDlistNP[segmentID][0]
-    segmentColor = np.asarray(inPix[segmentRepresentative[0], segmentRepresentative[1]])
-    diffN = np.sum(abs(segmentColor - np.asarray(inPix[minX, minY]))) + np.sum(abs(segmentColor - np.asarray(inPix[maxX, minY]))) + np.sum(abs(segmentColor - np.asarray(inPix[minX, maxY]))) + np.sum(abs(segmentColor - np.asarray(inPix[maxX, maxY]))) # accumulate color distances to the neighbor pixels
-    return diffN
-
-
-def setParameters(width, height, verbose, randSizes=100, longStrokes=False, strokeWidth=None, strokeHeight=None, strokeDensity=None):
+# compute an array of random coordinates [x, y] within this segment where to place complex brushstrokes
+# the grid points with spacing stroke_density inside the segment's bounding box are looked up in the label array segmentsNP, those belonging to segmentID are kept and shuffled with rng
+def getStrokePositions(segmentsNP, segmentID, stroke_density, minX, minY, maxX, maxY, rng=random):
+    grid = segmentsNP[minY:maxY + 1:stroke_density, minX:maxX + 1:stroke_density]
+    gridX, gridY = np.nonzero(grid.T == segmentID)  # column by column, like the former x/y loop
+    coordinates = np.column_stack((minX + gridX * stroke_density, minY + gridY * stroke_density))
+    permutation = list(range(0, len(coordinates)))
+    rng.shuffle(permutation)
+    return coordinates[permutation]
+
+
+
+# fullSize: for a preview (see convertImage()), the (width, height) of the full-size image. The stroke sizes and density are then computed for the full-size image and scaled down to width x height,
+# so the preview looks like a miniature of the full-size result, apart from strokeScale, the factor by which the preview's strokes are enlarged (see getPreviewStrokeScale()).
+def setParameters(width, height, verbose, randSizes=100, longStrokes=False, strokeWidth=None, strokeHeight=None, strokeDensity=None, fullSize=None, strokeScale=1):
+    if fullSize != None:
+        previewScale = (fullSize[0] + fullSize[1]) / (width + height)
+        complex_sizeX, complex_sizeY, stroke_density = setParameters(fullSize[0], fullSize[1], False, randSizes, longStrokes, strokeWidth, strokeHeight, strokeDensity)
+        complex_sizeX, complex_sizeY, stroke_density = [max(1, int(round(size * strokeScale / previewScale))) for size in (complex_sizeX, complex_sizeY, stroke_density)]
+        if verbose:
+            print("preview, downscaled by "+str(round(previewScale, 2))+", strokes enlarged by "+str(round(strokeScale, 2))
+                  +"\nstrokeWidth: "+str(complex_sizeX)
+                  +"\nstrokeHeight: "+str(complex_sizeY)
+                  +"\nstrokeDensity: "+str(stroke_density))
+        return complex_sizeX, complex_sizeY, stroke_density
+    
     # stroke width and height:
     if width > height:
         factor = 0.85
@@ -272,8 +397,8 @@ def setParameters(width, height, verbose, randSizes=100, longStrokes=False, stro
     return complex_sizeX, complex_sizeY, stroke_density
 
 
-def randStrokesParams(randSizes, complex_sizeX, complex_sizeY, stroke_density):
-    scaleFactor = randint(randSizes, 100)
+def randStrokesParams(randSizes, complex_sizeX, complex_sizeY, stroke_density, rng=random):
+    scaleFactor = rng.randint(randSizes, 100)
     complex_sizeX = max(1, (complex_sizeX * scaleFactor) // 100)
     complex_sizeY = max(1, (complex_sizeY * scaleFactor) // 100)
     stroke_density = max(1, (stroke_density * scaleFactor) // 100)
@@ -290,138 +415,222 @@ def makeMoreVivid(startColors, endColors):
     return startColors, endColors
 
 
-# sample the colors from the positions in the input image where brushstroke is to be placed:
-def sampleStartEndColors(inPix, X, Y, width, height, complex_sizeXrand, complex_sizeYrand):
+# sample the colors from the positions in the input image where the brushstrokes are to be placed, for all coordinates returned by getStrokePositions() at once:
+# inPixNP is the input image as an array of shape (height, width, 3)
+# startColors[i] and endColors[i] are the (2, 3) color arrays for the brushstroke at coordinates[i]
+def sampleStartEndColors(inPixNP, coordinates, width, height, complex_sizeXrand, complex_sizeYrand):
     halfSizeX = complex_sizeXrand // 2
     halfSizeY = complex_sizeYrand // 2
-    upperleftCornerX = max(0, X - halfSizeX)
-    upperleftCornerY = max(0, Y - halfSizeY)
-    scolor1 = np.array(inPix[upperleftCornerX, upperleftCornerY])
-    scolor2 = np.array(inPix[min(width-1, upperleftCornerX + complex_sizeXrand), upperleftCornerY])
-    startColors = np.array([scolor1, scolor2])
-    
-    ecolor1 = np.array(inPix[upperleftCornerX, min(height-1, upperleftCornerY + complex_sizeYrand)])
-    ecolor2 = np.array(inPix[min(width-1, upperleftCornerX + complex_sizeXrand), min(height-1, upperleftCornerY + complex_sizeYrand)])
-    endColors = np.array([ecolor1, ecolor2])
+    upperleftCornerX = np.maximum(0, coordinates[:, 0] - halfSizeX)
+    upperleftCornerY = np.maximum(0, coordinates[:, 1] - halfSizeY)
+    lowerrightCornerX = np.minimum(width-1, upperleftCornerX + complex_sizeXrand)
+    lowerrightCornerY = np.minimum(height-1, upperleftCornerY + complex_sizeYrand)
+    startColors = np.stack((inPixNP[upperleftCornerY, upperleftCornerX], inPixNP[upperleftCornerY, lowerrightCornerX]), axis=1).astype(int)
+    endColors = np.stack((inPixNP[lowerrightCornerY, upperleftCornerX], inPixNP[lowerrightCornerY, lowerrightCornerX]), axis=1).astype(int)
     return startColors, endColors
 
 
-# segmentsByIDlist: a list where the index is the segmentID and the element behind this index is a list of all tuples (x,y) where x,y are coordinates of a pixel belonging to this regionID
+# Sets the column strokeClass of the rows of segmentTable that have a regression line (see segments.STROKE_CLASSES) for the given stroke options:
+# segments of at most smallSegment_maxSize pixels get a simple brush stroke, unless they are hairlines (their stroke would be one pixel wide or long)
+# or the contrast of their color to their neighbours (see segments.RegionAdjacencyGraph, computed only if there are such segments) is lower than colDiff.
+# Segments of more than largeSegment_minSize pixels get complex brush strokes, ground ones if ground is set and they reach into the bottom 10% of the image. The others are not painted.
+# As in the former segment parameter lists, the sizes compared are the numbers of pixels minus one.
+# blockRows: the number of rows of the label array to read at once for the region adjacency graph
+def classifySegments(segmentTable, segmentIndex, height, smallSegment_maxSize, largeSegment_minSize, colDiff=500, ground=False, blockRows=256):
+    rows = segmentTable.rows
+    classified = np.nonzero(rows["strokeClass"] != segments.STROKE_NONE)[0]
+    numOfPixels = rows["area"][classified] - 1
+    first, last = segmentTable.regLineOffsets[classified], segmentTable.regLineOffsets[classified + 1] - 1
+    regLineX, regLineY = segmentTable.regLineX.astype(np.float64), segmentTable.regLineY.astype(np.float64)
+    regLineLen = np.rint(np.sqrt((regLineX[first] - regLineX[last])**2 + (regLineY[first] - regLineY[last])**2)).astype(np.int64)  # like round(euclidDist()) of the ends of the regression line
+    simple_sizeY = np.maximum(1, regLineLen)
+    simple_sizeX = np.maximum(1, numOfPixels // simple_sizeY)
+    
+    small = numOfPixels <= smallSegment_maxSize
+    hairline = small & ((simple_sizeX == 1) | (simple_sizeY == 1))
+    simple = small & ~hairline
+    strokeClasses = np.full(len(classified), segments.STROKE_UNPAINTED, dtype=np.int8)
+    strokeClasses[hairline] = segments.STROKE_HAIRLINE
+    if np.any(simple):
+        contrast = segments.RegionAdjacencyGraph(segmentIndex, segmentTable.byID("meanColor"), blockRows).contrast()[rows["segmentID"][classified]]
+        strokeClasses[simple] = np.where(contrast[simple] >= colDiff, segments.STROKE_SIMPLE, segments.STROKE_SKIPPED)
+    large = ~small & (numOfPixels > largeSegment_minSize)
+    strokeClasses[large] = segments.STROKE_COMPLEX
+    if ground:
+        strokeClasses[large & (rows["maxY"][classified] > height * 0.9)] = segments.STROKE_GROUND  # a large segment at the bottom of the image. We assume it's the ground.
+    rows["strokeClass"][classified] = strokeClasses
+
+
+# the number of stroke positions of a segment whose colors planStrokes() samples at once. The pages of a memory-mapped image it reads are released between them (see outOfCore.paintSpooled()).
+SAMPLED_POSITIONS = 1000
+
+# the names under which a profile counts the segments of each stroke class
+PROFILED_STROKE_CLASSES = {segments.STROKE_HAIRLINE: "segments.hairline", segments.STROKE_SIMPLE: "segments.simple", segments.STROKE_SKIPPED: "segments.skippedByColDiff", segments.STROKE_UNPAINTED: "segments.unpainted", segments.STROKE_COMPLEX: "segments.complex", segments.STROKE_GROUND: "segments.ground"}
+
+
+# Plans the brush strokes of all segments in painting order and yields them one by one as tuples (strokeType, X, Y, params, strokeSeed), to be painted by brushstroke.paintStroke():
+#   ("simple", X, Y, (sizeX, sizeY, angle, color, regLine), strokeSeed) or ("complex", X, Y, (sizeX, sizeY, startColors, endColors, angleStart, angleStop, groundSegment), strokeSeed)
+# If seed is None, all random numbers come from the random module and strokeSeed is None. The strokes are planned lazily, so painting each stroke before the next one is planned draws the random numbers in the same order as painting while planning.
+# Otherwise every segment is planned with its own random stream and every stroke gets the seed of its own stream (see getStreamSeed()), so the result neither depends on the order in which the strokes are painted nor on the process painting them.
+# The segments are classified first (see classifySegments()). The segmentIDs of the hairline segments, for which no brush strokes can be generated, are appended to smallestSegments.
+# segmentTable: the segments.SegmentTable of the felzenszwalb label array
+# segmentIndex: the segments.SegmentIndex of the felzenszwalb label array, giving the coordinates of all pixels belonging to each segmentID
+# inPix, inPixNP: the (saturated) input image as pixel access object and as array
+# profile: a profiling.Profile counting the segments of each class and the planned strokes, or None
+# directedRotate: if True, each complex brush stroke is rotated along the structures of the image at its position (see orientation.OrientationField, computed for the first complex segment), otherwise randomly
+# blockRows: the number of rows of the label array (and of the image) to read at once for the contrast of the small segments to their neighbours (see segments.RegionAdjacencyGraph) and for the orientation field
+def planStrokes(segmentTable, segmentIndex, inPix, inPixNP, width, height, smallestSegments, complex_sizeX, complex_sizeY, stroke_density, smallSegment_maxSize, largeSegment_minSize, randSizes=100, directedRotate=False, colDiff=500, ground=False, highlight=False, seed=None, profile=None, blockRows=256):
+    
+    classifySegments(segmentTable, segmentIndex, height, smallSegment_maxSize, largeSegment_minSize, colDiff, ground, blockRows)
+    rows = segmentTable.rows
+    segmentIDs, strokeClasses, angles, areas = rows["segmentID"].tolist(), rows["strokeClass"].tolist(), rows["angle"].tolist(), rows["area"].tolist()
+    minXs, minYs, maxXs, maxYs = rows["minX"].tolist(), rows["minY"].tolist(), rows["maxX"].tolist(), rows["maxY"].tolist()
+    orientationField = None
+    # iterate over the segments from largest to smallest, paint the largest segments with complex brushstrokes, the smallest segments with simple brushstrokes, omit the middle-sized ones (all the segments were colored during segmentation anyway, so this saves time)
+    for row in range(0, len(rows)):
+        segmentID, strokeClass, angle = segmentIDs[row], strokeClasses[row], angles[row]
+        if profile != None and strokeClass in PROFILED_STROKE_CLASSES:
+            profile.count(PROFILED_STROKE_CLASSES[strokeClass])
+        
+        if strokeClass == segments.STROKE_HAIRLINE:
+            smallestSegments.append(segmentID)
+        
+        #paint a simple brushstroke:
+        elif strokeClass == segments.STROKE_SIMPLE:  # the color of this small segment is significantly different from the color of surrounding segments
+            regLine = segmentTable.regLine(row)
+            regLineStart = (int(regLine[0][0]), int(regLine[1][0]))  # coordinates of the regression line starting point
+            regLineStop = (int(regLine[0][-1]), int(regLine[1][-1])) # coordinates of the regression line stopping point
+            simple_sizeY = max(1, int(round(euclidDist(regLineStart, regLineStop))))  # we want the brush stroke to be the same length as the regression line of its segment
+            simple_sizeX = max(1, (areas[row] - 1) // simple_sizeY)
+            X, Y = regLineStart
+            color = inPix[X, Y]
+            strokeSeed = None if seed == None else getStreamSeed(seed, segmentID, 1)
+            if profile != None:
+                profile.count("strokes.simple")
+            yield ("simple", X, Y, (simple_sizeX, simple_sizeY, angle, color, regLine), strokeSeed)
+        
+        # paint a complex brushstroke:
+        elif strokeClass == segments.STROKE_COMPLEX or strokeClass == segments.STROKE_GROUND:
+            groundSegment = strokeClass == segments.STROKE_GROUND
+            minX, minY, maxX, maxY = minXs[row], minYs[row], maxXs[row], maxYs[row]  # the not-rotated bounding box
+            segmentRng = random if seed == None else random.Random(getStreamSeed(seed, segmentID, 0))
+            
+            if randSizes < 100: # brush strokes are supposed to have random sizes
+                complex_sizeXrand, complex_sizeYrand, stroke_densityrand = randStrokesParams(randSizes, complex_sizeX, complex_sizeY, stroke_density, segmentRng)
+            else:
+                complex_sizeXrand, complex_sizeYrand, stroke_densityrand = complex_sizeX, complex_sizeY, stroke_density
+                if groundSegment:
+                    stroke_densityrand = int(max(1, stroke_density * 0.4))
+            coordinates = getStrokePositions(segmentIndex.labels, segmentID, stroke_densityrand, minX, minY, maxX, maxY, segmentRng)
+            if profile != None:
+                profile.count("strokes.complex", len(coordinates))
+            
+            if directedRotate:
+                if orientationField is None:
+                    orientationField = orientation.OrientationField(inPixNP, max(complex_sizeX, complex_sizeY), blockRows)
+                anglesStart = (-np.trunc(orientationField.anglesAt(coordinates)).astype(int) - 20).tolist()  # the angles of the structures at the stroke positions, like the former angle of the segment
+            else:
+                angleStart = segmentRng.randint(-90, 90)
+                angleStop = angleStart + 40
+            if len(coordinates) > 0:
+                positions = coordinates.tolist()
+                for posIndex in range(0, len(positions)):
+                    if posIndex % SAMPLED_POSITIONS == 0:
+                        # sample the colors where the next brushstrokes are to be placed:
+                        startColorsAll, endColorsAll = sampleStartEndColors(inPixNP, coordinates[posIndex:posIndex + SAMPLED_POSITIONS], width, height, complex_sizeXrand, complex_sizeYrand)
+                    X, Y = positions[posIndex]
+                    if directedRotate:
+                        angleStart = anglesStart[posIndex]
+                        angleStop = angleStart + 40
+                    startColors = startColorsAll[posIndex % SAMPLED_POSITIONS].copy()
+                    endColors = endColorsAll[posIndex % SAMPLED_POSITIONS].copy()
+                    
+                    # make every 5th brush stroke in otherwise homogenous regions look more vivid:
+                    if highlight and posIndex % 5 == 4:
+                        startColors, endColors = makeMoreVivid(startColors, endColors)
+                    
+                    strokeSeed = None if seed == None else getStreamSeed(seed, segmentID, posIndex + 1)
+                    yield ("complex", X, Y, (complex_sizeXrand, complex_sizeYrand, startColors, endColors, angleStart, angleStop, groundSegment), strokeSeed)
+
+
+# segmentIndex: the segments.SegmentIndex of the felzenszwalb label array, giving the coordinates of all pixels belonging to each segmentID
+# inPix, inPixNP: the (saturated) input image as pixel access object and as array
 # fill the output image with brush strokes and save it
-# segmentParams as a list of elements of the form [segmentID, regLine, angle, bbox, degree]
-def paintImg_with_brushstrokes(outfile, outIm, outPix, width, height, segmentParams, segmentsByIDlist, inPix, verbose, randSizes=100, longStrokes=False, directedRotate=False, strokeWidth=None, strokeHeight=None, strokeDensity=None, noHairlines=False, noMargins=False, segBound=None, colDiff=500, ground=False, highlight=False, colorify=0, otherfiles=False, felzScale=None, felzSigma=None, felzMinsize=None, webinterface=False):
+# the brush strokes are composited on a canvas.Canvas copy of outIm, the painted image is returned
+# segmentTable: the segments.SegmentTable of the felzenszwalb label array, its stroke classes are set for the stroke options (see classifySegments())
+# renderJobs: if greater than 1, the canvas is split into tiles which are painted by that many processes (see tiling.py)
+# seed: if not None, the random numbers of every segment and brush stroke are drawn from their own streams derived from seed (see planStrokes()), so serial and tiled renders give the same image.
+#   Without a seed, the tiled renders give every stroke its own random seed as well, so their result differs from a serial run, but not between different numbers of renderJobs > 1.
+# fullSize, strokeScale: for a preview, the (width, height) of the full-size image the parameters refer to and the enlargement of the strokes (see setParameters())
+# profile: a profiling.Profile recording the painting stages, or None
+# outCanvas: the canvas.Canvas of the background to paint on, instead of one made from outIm (which may then be None)
+# lean: if True (and not webinterface), the canvas is written to outfile in bands of LEAN_BAND_PIXELS pixels instead of being converted to a PIL image, and the image of the file is returned
+def paintImg_with_brushstrokes(outfile, outIm, outPix, width, height, segmentTable, segmentIndex, inPix, inPixNP, verbose, randSizes=100, longStrokes=False, directedRotate=False, strokeWidth=None, strokeHeight=None, strokeDensity=None, noHairlines=False, noMargins=False, segBound=None, colDiff=500, ground=False, highlight=False, colorify=0, otherfiles=False, felzScale=None, felzSigma=None, felzMinsize=None, webinterface=False, vectorized=True, cacheTemplates=True, directRaster=True, resample="bicubic", renderJobs=1, seed=None, fullSize=None, strokeScale=1, profile=None, outCanvas=None, lean=False):
     
     # set variables according to parameters passed down from main:
-    complex_sizeX, complex_sizeY, stroke_density = setParameters(width, height, verbose, randSizes, longStrokes, strokeWidth, strokeHeight, strokeDensity)
+    complex_sizeX, complex_sizeY, stroke_density = setParameters(width, height, verbose, randSizes, longStrokes, strokeWidth, strokeHeight, strokeDensity, fullSize, strokeScale)
+    if fullSize != None and segBound != None:
+        segBound = (segBound * width * height) // (fullSize[0] * fullSize[1])  # segBound is a number of pixels of the full-size image
+    templateCache = brushstroke.templateCache if cacheTemplates else None  # shape templates of the complex brushstrokes
+    if outCanvas == None:
+        outCanvas = canvas.Canvas(outIm)
     
-    segmentsByIDlistNP = np.asarray(segmentsByIDlist) # only used by differenceToNeighbors()
     smallSegment_maxSize = segBound if segBound != None else (width * height) // 5000
     largeSegment_minSize = segBound if segBound != None else (width * height) // 5000  # increase constant for more complex strokes.
     if verbose:
         print("segBound: "+str(smallSegment_maxSize))
     
-    # iterate over the segments from largest to smallest, paint the largest segments with complex brushstrokes, the smallest segments with simple brushstrokes, omit the middle-sized ones (all the segments were colored during segmentation anyway, so this saves time)
-    
     smallestSegments = []
-    smallSignificantSegments = []
-    firstTimeUnderSmallSegmentMaxSize = True
-    # density with which complex brushstrokes will be placed within their segments:
-    
-    for segment in range(0, len(segmentParams)):
-        segmentID, regLine, angle, bboxN, degree, numOfPixels, regression = segmentParams[segment]
-        if bboxN == None:
-            continue
-        
-        regLineStart = (regLine[0][0], regLine[1][0])  # coordinates of the regression line starting point
-        regLineStop = (regLine[0][-1], regLine[1][-1]) # coordinates of the regression line stopping point
-        regLineLen = int(round(euclidDist(regLineStart, regLineStop)))
-        minX, minY, maxX, maxY = bboxN  # the not-rotated bounding box
-    
-    
-        #paint a simple brushstroke:
-        if numOfPixels <= smallSegment_maxSize:
-            simple_sizeY = max(1,regLineLen)  # we want the brush stroke to be the same length as the regression line of its segment
-            simple_sizeX = max(1, numOfPixels // simple_sizeY)
-            if simple_sizeX == 1 or simple_sizeY == 1: # hairline segment
-                smallestSegments.append(segmentID)
-            else:
-                diffN = differenceToNeighbors(segmentID, segmentsByIDlistNP, inPix, minX, minY, maxX, maxY)
-                if diffN >= colDiff:  # the color of this small segment is significantly different from the color of surrounding segments
-                    X = regLine[0][0]
-                    Y = regLine[1][0]
-                    color = inPix[X, Y]
-                    brushstroke.simple_brushstroke(outIm, X, Y, simple_sizeX, simple_sizeY, angle, color, regLine)
-        
-        # paint a complex brushstroke:
-        elif numOfPixels > largeSegment_minSize:
-            if ground and maxY > height * 0.9:
-                groundSegment = True  # this is a large segment at the bottom of the image. We assume it's the ground.
-            else:
-                groundSegment = False
-            
-            if randSizes < 100:
-                complex_sizeXrand, complex_sizeYrand, stroke_densityrand = randStrokesParams(randSizes, complex_sizeX, complex_sizeY, stroke_density)
-                coordinates = getStrokePositions(segmentsByIDlist[segmentID], stroke_densityrand, minX, minY, maxX, maxY) # segmentsByIDlist to be replaced by segmentsByIDlist_sorted
-            elif groundSegment:
-                coordinates = getStrokePositions(segmentsByIDlist[segmentID], int(max(1, stroke_density * 0.4)), minX, minY, maxX, maxY)
-            else:
-                coordinates = getStrokePositions(segmentsByIDlist[segmentID], stroke_density, minX, minY, maxX, maxY) # segmentsByIDlist to be replaced by segmentsByIDlist_sorted
-            
-            if coordinates != None:
-                if directedRotate:
-                    angleStart = -1*int(angle) - 20
-                    angleStop = angleStart + 40
-                else:
-                    angleStart = randint(-90, 90)
-                    angleStop = angleStart + 40
-                for posIndex in range(0, len(coordinates)):
-                    X, Y = coordinates[posIndex]
-                    # sample the colors where brushstroke is to be placed:
-                    if randSizes < 100: # brush strokes are supposed to have random sizes
-                        startColors, endColors = sampleStartEndColors(inPix, X, Y, width, height, complex_sizeXrand, complex_sizeYrand)
-                        
-                        # make every 5th brush stroke in otherwise homogenous regions look more vivid:
-                        if highlight and posIndex % 5 == 4:
-                            startColors, endColors = makeMoreVivid(startColors, endColors)
-                        
-                        brushstroke.complex_brushstroke(outIm, X, Y, complex_sizeXrand, complex_sizeYrand, startColors, endColors, angleStart, angleStop, arcType="log", groundSegment=groundSegment, colorify=colorify, noMargins=noMargins)
-                    else:
-                        startColors, endColors = sampleStartEndColors(inPix, X, Y, width, height, complex_sizeX, complex_sizeY)
-                        
-                        # make every 5th brush stroke in otherwise homogenous regions look more vivid:
-                        if highlight and posIndex % 5 == 4:
-                            startColors, endColors = makeMoreVivid(startColors, endColors)
-                        
-                        brushstroke.complex_brushstroke(outIm, X, Y, complex_sizeX, complex_sizeY, startColors, endColors, angleStart, angleStop, arcType="log", groundSegment=groundSegment, colorify=colorify, noMargins=noMargins)
+    strokes = planStrokes(segmentTable, segmentIndex, inPix, inPixNP, width, height, smallestSegments, complex_sizeX, complex_sizeY, stroke_density, smallSegment_maxSize, largeSegment_minSize, randSizes=randSizes, directedRotate=directedRotate, colDiff=colDiff, ground=ground, highlight=highlight, seed=seed, profile=profile)
+    with profiling.stage(profile, "strokes"):  # planning and painting
+        if renderJobs > 1:
+            tiling.paintTiled(outCanvas, strokes, renderJobs, verbose, colorify=colorify, noMargins=noMargins, vectorized=vectorized, cacheTemplates=cacheTemplates, directRaster=directRaster, resample=resample, profile=profile)
+        else:
+            for stroke in strokes:
+                if profile != None:
+                    start = time.time()
+                brushstroke.paintStroke(outCanvas, stroke, colorify=colorify, noMargins=noMargins, vectorized=vectorized, templateCache=templateCache, directRaster=directRaster, resample=resample, profile=profile)
+                if profile != None:
+                    profile.addTime(stroke[0] + "Strokes", time.time() - start)
     
     # now color in the smallest, hairline thin areas for which no brushstrokes could be generated:
-    if not noHairlines:
-        for segmentID in smallestSegments: # segmentsByIDlist to be replaced by segmentsByIDlist_sorted
-            color = inPix[segmentsByIDlist[segmentID][0][0], segmentsByIDlist[segmentID][0][1]]
-            for p in range(0, len(segmentsByIDlist[segmentID])):
-                outPix[segmentsByIDlist[segmentID][p][0], segmentsByIDlist[segmentID][p][1]] = color
-    
-    if not webinterface:
-        imgIO.savePixelAccessImg(outfile, outIm) # png
+    with profiling.stage(profile, "hairlines"):
+        if not noHairlines and smallestSegments:
+            xs, ys, segmentIDs = segmentIndex.pixelsOf(smallestSegments)  # only the pixels of the hairlines, they are a small part of the image
+            outCanvas.fillColors(xs, ys, segmentTable.byID("color")[segmentIDs])
+            if profile != None:
+                profile.count("pixelsFilled", len(xs))
+    
+    if verbose and templateCache != None and renderJobs <= 1:
+        print("stroke template cache: "+str(templateCache.stats()))
+    
+    with profiling.stage(profile, "save"):
+        if lean and not webinterface:  # without a PIL copy of the canvas, the image is loaded from the file when it is used
+            bandRows = max(1, LEAN_BAND_PIXELS // width)
+            imgIO.savePNGBands(outfile, width, height, outCanvas.mode, (outCanvas.pixels[top:top + bandRows] for top in range(0, height, bandRows)))
+            return Image.open(outfile)
+        outIm = outCanvas.toImage()
+        if not webinterface:
+            imgIO.savePixelAccessImg(outfile, outIm) # png
     return outIm
 
 
+LEAN_BAND_PIXELS = 2**18  # about 20 MB for the filtering of imgIO.savePNGBands()
+
+
+
+
+# returns the seed of an independent random stream for segment segmentID of an image rendered with seed: stream 0 is used for planning the segment's brush strokes, stream i for its i-th brush stroke.
+# The seeds are derived with numpy's SeedSequence, spawned by (segmentID, stream).
+def getStreamSeed(seed, segmentID, stream):
+    return int(np.random.SeedSequence(seed, spawn_key=(int(segmentID), stream)).generate_state(1, np.uint64)[0])
+
+
 # data structures:
-# in segmentsByIDlist_sorted, the segments are sorted by the number of pixels they contain from largest to smallest. Each element of the segmentsByIDlist_sorted list is a list of the form [segmentID, [list of pixel coordinates]]
-# in segmentsByIDlist, the segmentID's are the list keys and the list of pixel coordinates for each segmentID is its value
-def sortSegmentsBySize(segmentsByIDlist):
-    listlen = len(segmentsByIDlist)
-    sizes_and_IDs = [[] for i in range(0, listlen)] # list of [numOfPixels, segmentID]
-    segmentsByIDlist_sorted = list(sizes_and_IDs) # list copy
-    
-    for i in range(0, listlen):
-        sizes_and_IDs[i] = [len(segmentsByIDlist[i]), i]
-    sizes_and_IDs.sort(reverse=True)  # sort inplace by first element (numOfPixels), descending
-    
-    for i in range(0, listlen):
-        segmentsByIDlist_sorted[i] = [sizes_and_IDs[i][1], segmentsByIDlist[sizes_and_IDs[i][1]]]
-    
-    return segmentsByIDlist_sorted
+# segmentIndex (a segments.SegmentIndex) gives the pixel coordinates and the number of pixels of each segmentID
+# the returned array contains the segmentIDs sorted by the number of pixels their segments contain from largest to smallest (segments of equal size by descending segmentID)
+def sortSegmentsBySize(segmentIndex):
+    return segmentIndex.sortedBySize()
 
 
 def saturateImage(inIm, filename, saturation=2.5, otherfiles=False):
@@ -434,45 +643,129 @@ def saturateImage(inIm, filename, saturation=2.5, otherfiles=False):
 
 
 # calling this function will start the 'afremize' process. The only obligatory argument is the input file name, 'infile'
-def convertImage(infile, inIm=None, path="", input_dir="", output_dir="", verbose=False, strokeWidth=100, strokeHeight=100, randSizes=100, longStrokes=False, directedRotate=False, strokeDensity=70, background='blur', noHairlines=False, noMargins=False, segBound=100, colDiff=500, ground=False, saturation=2.5, highlight=False, colorify=0, otherfiles=False, felzScale=50, felzSigma=4.5, felzMinsize=10, webinterface=False):
-    
-    warnings.simplefilter('ignore', np.RankWarning) # ignore warnings when the polyfit function doesn't get enough data
-    if inIm == None:
-        inIm, inPix = imgIO.loadImgAsPixelAccess(path + input_dir + infile)
-    else:
-        inPix = inIm.load()
-    width, height = inIm.size
-    
-    if inIm.mode != 'RGB':
-        inIm = inIm.convert('RGB')
+# seed: makes the result reproducible, independent of the number of renderJobs, see paintImg_with_brushstrokes()
+# preview: if True, the image is segmented and painted at a reduced size, with the stroke sizes of the full-size image scaled down accordingly. Both are chosen so that this takes about previewLatency seconds (see getPreviewScale() and getPreviewStrokeScale()).
+#   The preview is saved as FILE_preview.png in path + output_dir, like the output image (unless webinterface is set), and returned together with its plan, i.e. (previewIm, plan). It cannot be combined with memoryBudget.
+# plan: the plan returned by a preview of the same image. The full-size image is then painted on the preview's segmentation, scaled up, instead of segmenting the image again.
+# segCache: a segCache.SegmentationCache. The segmentation (label array and segment parameters) is taken from it if the same pixels were segmented with the same saturation and felzenszwalb parameters before, and stored in it otherwise.
+# memoryBudget: if not None, the image is converted out of core within about that many bytes of memory, with its large arrays in temporary files within workDir (see outOfCore.py)
+# profile: if not None, the name of a file the profile of the conversion is written to as JSON (see profiling.py): the wall and CPU time and the peak memory of every stage,
+#   the number of segments of each class, of strokes and of pixels written, and the time spent rotating and pasting strokes and setting up their color splines (not for out-of-core conversions)
+# lean: if True, the image is converted with as little memory as possible, giving the same output image: only one copy of the (saturated) input image is kept, as array, the labels are int32,
+#   the background is painted on without a PIL copy of it, and the output image is written band by band (see paintImg_with_brushstrokes()). With verbose, the peak memory of every stage is printed.
+def convertImage(infile, inIm=None, path="", input_dir="", output_dir="", verbose=False, strokeWidth=100, strokeHeight=100, randSizes=100, longStrokes=False, directedRotate=False, strokeDensity=70, background='blur', noHairlines=False, noMargins=False, segBound=100, colDiff=500, ground=False, saturation=2.5, highlight=False, colorify=0, otherfiles=False, felzScale=50, felzSigma=4.5, felzMinsize=10, webinterface=False, vectorized=True, cacheTemplates=True, directRaster=True, resample="bicubic", renderJobs=1, seed=None, preview=False, previewLatency=PREVIEW_LATENCY, plan=None, segCache=None, memoryBudget=None, workDir=None, profile=None, lean=False):
+    
+    if memoryBudget != None:
+        if preview:
+            raise ValueError("a preview cannot be converted out of core (with a memoryBudget)")
+        import outOfCore  # imported here, it imports afremize itself
+        return outOfCore.convertImage(infile, inIm=inIm, path=path, input_dir=input_dir, output_dir=output_dir, verbose=verbose, strokeWidth=strokeWidth, strokeHeight=strokeHeight, randSizes=randSizes, longStrokes=longStrokes, directedRotate=directedRotate, strokeDensity=strokeDensity, background=background, noHairlines=noHairlines, noMargins=noMargins, segBound=segBound, colDiff=colDiff, ground=ground, saturation=saturation, highlight=highlight, colorify=colorify, felzScale=felzScale, felzSigma=felzSigma, felzMinsize=felzMinsize, vectorized=vectorized, cacheTemplates=cacheTemplates, directRaster=directRaster, resample=resample, renderJobs=renderJobs, seed=seed, memoryBudget=memoryBudget, workDir=workDir)
+    
+    recorder = None if profile == None and not (lean and verbose) else profiling.Profile(timeHotPaths=profile != None)
+    
+    with profiling.stage(recorder, "load"):
+        if inIm == None:
+            inIm, inPix = imgIO.loadImgAsPixelAccess(path + input_dir + infile)
+        else:
+            inPix = inIm.load()
+        width, height = inIm.size
+        
+        if inIm.mode != 'RGB':
+            inIm = inIm.convert('RGB')
+        
+        fullSize = None
+        strokeScale = 1
+        if preview:  # continue with a downscaled copy, all size parameters still refer to the full-size image
+            previewScale = getPreviewScale(width, height, previewLatency)
+            strokeScale = getPreviewStrokeScale(width, height, previewLatency, randSizes, longStrokes, strokeWidth, strokeHeight, strokeDensity)
+            fullSize = (width, height)
+            width, height = max(1, int(round(width / previewScale))), max(1, int(round(height / previewScale)))
+            inIm = inIm.resize((width, height), Image.BOX)
+            inPix = inIm.load()
+            # min_size is an area in pixels. Reducing sigma by sqrt(previewScale) keeps the number of large segments (those painted with complex brush strokes) close to the one of the full-size segmentation:
+            felzSigma = felzSigma / sqrt(previewScale)
+            felzMinsize = max(1, int(felzMinsize / previewScale**2))
+    if recorder != None:
+        recorder.info["file"] = infile
+        recorder.info["size"] = [width, height]
+        recorder.info["preview"] = preview
+        recorder.info["renderJobs"] = renderJobs
     
     drawRegressionLines = otherfiles
     if drawRegressionLines:
         inImCopy = inIm.copy()
-        inPixCopy = inImCopy.load()
     else:
         inImCopy = None
-        inPixCopy = None
-    
-    filename, outfile = getOutfileName(path, output_dir, infile)
-    outIm, outPix = imgIO.createWhiteImg(width, height)
-    inIm, inPix = saturateImage(inIm, filename, saturation=saturation, otherfiles=otherfiles)
-    inPixNP = np.array(inIm)
     
-    segmentsNP, segmentsByIDlist = clustering(inPixNP, width, height, scale=felzScale, sigma=felzSigma, min_size=felzMinsize)
+    filename = getOutfileName(path, output_dir, infile)[0]
+    with profiling.stage(recorder, "saturateImage"):
+        inIm, inPix = saturateImage(inIm, filename, saturation=saturation, otherfiles=otherfiles)
+        inPixNP = np.array(inIm)
+        if lean:  # keep the saturated image only as the array
+            inIm = None
+            inPix = imgIO.ArrayPixelAccess(inPixNP)
+    
+    cacheKey = None
+    cached = None
+    if plan is not None:  # reuse the segmentation of the preview
+        with profiling.stage(recorder, "scaleSegmentation"):
+            segmentsNP, segmentIndex = scaleSegmentation(plan, width, height)
+    else:
+        if segCache != None:
+            with profiling.stage(recorder, "segCache.load"):
+                cacheKey = segCache.getKey(inPixNP, saturation, felzScale, felzSigma, felzMinsize)
+                cached = segCache.load(cacheKey)
+        if cached is None:
+            with profiling.stage(recorder, "clustering"):
+                segmentsNP, segmentIndex = clustering(inPixNP, width, height, scale=felzScale, sigma=felzSigma, min_size=felzMinsize, lean=lean)
+        else:
+            segmentsNP, segmentIndex, segmentTable = cached
+            if verbose:
+                print("segmentation taken from the cache")
+    
+    if cached is None:
+        with profiling.stage(recorder, "getSegmentTable"):
+            segmentTable = getSegmentTable(segmentIndex, inPixNP, drawRegressionLines, inImCopy, width, height)
+        if cacheKey != None:
+            with profiling.stage(recorder, "segCache.store"):
+                segCache.store(cacheKey, segmentsNP, segmentIndex, segmentTable)
+    elif drawRegressionLines:
+        inCopyDraw = ImageDraw.Draw(inImCopy)
+        for row in np.nonzero(~np.isnan(segmentTable.rows["regression"][:, 0]))[0]:
+            drawRegLine(inCopyDraw, segmentTable.regLine(row), width, height)
     if otherfiles:
-        saveClusteredImage(inPix, segmentsByIDlist, width, height, filename) # optional
-    
-    segmentsByIDlist_sorted = sortSegmentsBySize(segmentsByIDlist) # sort the segments by their length, prepend regionID to each segment
-    
-    segmentParams = getSegmentParams(segmentsByIDlist_sorted, inPix, drawRegressionLines, inImCopy, inPixCopy, width, height)
+        saveClusteredImage(segmentTable.byID("color"), segmentIndex, filename) # optional
+    if recorder != None:
+        recorder.count("segments", len(segmentTable))
+        recorder.count("segments.withoutRegression", int(np.count_nonzero(segmentTable.rows["strokeClass"] == segments.STROKE_NONE)))  # too small, or no regression line within the image
     
     if drawRegressionLines:
         inImCopy.save(filename + "_regLines.png")
     
-    outIm, outPix = colorBackground(inIm, inPix, segmentsByIDlist, outIm, outPix, background)
+    with profiling.stage(recorder, "colorBackground"):
+        outIm, outPix = (None, None) if background in ("blur", "cluster") else imgIO.createWhiteImg(width, height)  # the blurred or clustered image replaces it
+        outIm, outPix = colorBackground(inIm, inPixNP, segmentIndex, segmentTable, outIm, outPix, background)
+        outCanvas = None
+        if lean:  # paint on the array of the background only
+            outCanvas = canvas.Canvas(outIm)
+            outIm, outPix = None, None
     
     
-    outIm = paintImg_with_brushstrokes(outfile, outIm, outPix, width, height, segmentParams, segmentsByIDlist, inPix, verbose, randSizes=randSizes, longStrokes=longStrokes, directedRotate=directedRotate, strokeWidth=strokeWidth, strokeHeight=strokeHeight, strokeDensity=strokeDensity, noHairlines=noHairlines, noMargins=noMargins, segBound=segBound, colDiff=colDiff, ground=ground, highlight=highlight, colorify=colorify, otherfiles=otherfiles, felzScale=felzScale, felzSigma=felzSigma, felzMinsize=felzMinsize, webinterface=webinterface) # segmentsByIDlist to be replaced by segmentsByIDlist_sorted
+    # the output file is reserved only now, and removed again if painting fails (the web interface does not save it)
+    outfile = getOutfileName(path, output_dir, infile, "_preview" if preview else "__out", reserve=not webinterface)[1]
+    try:
+        outIm = paintImg_with_brushstrokes(outfile, outIm, outPix, width, height, segmentTable, segmentIndex, inPix, inPixNP, verbose, randSizes=randSizes, longStrokes=longStrokes, directedRotate=directedRotate, strokeWidth=strokeWidth, strokeHeight=strokeHeight, strokeDensity=strokeDensity, noHairlines=noHairlines, noMargins=noMargins, segBound=segBound, colDiff=colDiff, ground=ground, highlight=highlight, colorify=colorify, otherfiles=otherfiles, felzScale=felzScale, felzSigma=felzSigma, felzMinsize=felzMinsize, webinterface=webinterface, vectorized=vectorized, cacheTemplates=cacheTemplates, directRaster=directRaster, resample=resample, renderJobs=renderJobs, seed=seed, fullSize=fullSize, strokeScale=strokeScale, profile=recorder, outCanvas=outCanvas, lean=lean)
+    except BaseException:
+        if not webinterface:
+            os.remove(outfile)
+        raise
     
+    if otherfiles:
+        segmentTable.save(filename + "_segments.npz")  # with the stroke classes of this conversion
+    if lean and verbose:
+        recorder.printStages()
+    if profile != None:
+        recorder.write(profile)
+    if preview:
+        return outIm, segmentsNP
     return outIm
@@ -0,0 +1,322 @@
+# Copyright (C) 2015 Jana Cavojska
+# This file is part of 'Afremize'.
+
+# 'Afremize' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+
+# 'Afremize' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with 'Afremize'.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+import random
+import os
+import sys
+import time
+import json
+import multiprocessing
+import platform
+import shutil
+import subprocess
+import tempfile
+from collections import OrderedDict
+from optparse import OptionParser
+from PIL import Image
+
+# own imports:
+import afremize
+import brushstroke
+import canvas
+import imgIO
+
+
+# Benchmark of the conversion pipeline, timing every stage separately, on the pictures of the Gallery and on synthetic pictures of 1, 4, 16 and 64 megapixels generated with fixed seeds.
+# The pipeline is the one of afremize.convertImage() with the default options of main.py, and the random numbers are seeded, so that all runs do the same work.
+# Every run appends one line of JSON to the history file, and --compare lists the stage times of two runs and flags the stages which got slower:
+#
+#     python benchmark.py                                     # all pictures (the 64 megapixel picture needs about 25 GB of memory)
+#     python benchmark.py --sizes=1,4 --gallery=Dorm.jpg --repeat=5
+#     python benchmark.py --compare=last                      # the last two runs
+#     python benchmark.py --compare=RUN_A,RUN_B --threshold=10
+#     python benchmark.py --checkMemory                       # the peak memory of out-of-core conversions of 2 and 8 megapixels
+
+STAGES = ["saturateImage", "clustering", "getSegmentTable", "colorBackground", "planStrokes", "simpleStrokes", "complexStrokes", "hairlines", "save"]
+SYNTHETIC_SIZES = [1, 4, 16, 64]  # megapixels
+CHECKED_MEMORY_SIZES = [2, 8]  # megapixels of the synthetic pictures converted by checkMemory()
+GALLERY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "Gallery")
+
+
+# returns the file names of the pictures of the Gallery, without the converted ones (FILE__out.jpg)
+def galleryImages(galleryDir=GALLERY_DIR):
+    return [name for name in sorted(os.listdir(galleryDir)) if name.lower().endswith((".jpg", ".jpeg", ".png")) and "__out" not in name]
+
+
+# Runs the pipeline of afremize.convertImage() on the RGB image inIm, with the default options of main.py and the random numbers drawn from seed, and saves the painted image to outfile.
+# Returns the seconds spent in each of STAGES and the numbers of segments, strokes and hairline segments.
+def benchmarkImage(inIm, outfile, seed=0):
+    random.seed(seed)
+    np.random.seed(seed % 2**32)
+    brushstroke.templateCache.clear()  # every picture starts with an empty template cache, as in a new process
+    seconds = OrderedDict((stage, 0.0) for stage in STAGES)
+    counts = OrderedDict()
+    width, height = inIm.size
+
+    start = time.time()
+    saturatedIm, inPix = afremize.saturateImage(inIm, "", saturation=2.5)
+    inPixNP = np.array(saturatedIm)
+    seconds["saturateImage"] = time.time() - start
+
+    start = time.time()
+    segmentsNP, segmentIndex = afremize.clustering(inPixNP, width, height)
+    seconds["clustering"] = time.time() - start
+    counts["segments"] = len(segmentIndex)
+
+    start = time.time()
+    segmentTable = afremize.getSegmentTable(segmentIndex, inPixNP, False, None, width, height)
+    seconds["getSegmentTable"] = time.time() - start
+
+    start = time.time()
+    outIm, outPix = imgIO.createWhiteImg(width, height)
+    outIm, outPix = afremize.colorBackground(saturatedIm, inPixNP, segmentIndex, segmentTable, outIm, outPix, "blur")
+    seconds["colorBackground"] = time.time() - start
+
+    start = time.time()
+    complex_sizeX, complex_sizeY, stroke_density = afremize.setParameters(width, height, False)
+    segBound = (width * height) // 5000
+    smallestSegments = []
+    strokes = list(afremize.planStrokes(segmentTable, segmentIndex, inPix, inPixNP, width, height, smallestSegments, complex_sizeX, complex_sizeY, stroke_density, segBound, segBound, seed=seed))
+    seconds["planStrokes"] = time.time() - start
+
+    outCanvas = canvas.Canvas(outIm)
+    counts["simpleStrokes"] = 0
+    counts["complexStrokes"] = 0
+    for stroke in strokes:
+        start = time.time()
+        brushstroke.paintStroke(outCanvas, stroke, templateCache=brushstroke.templateCache)
+        seconds[stroke[0] + "Strokes"] += time.time() - start
+        counts[stroke[0] + "Strokes"] += 1
+
+    start = time.time()
+    xs, ys, segmentIDs = segmentIndex.pixelsOf(smallestSegments)
+    outCanvas.fillColors(xs, ys, segmentTable.byID("color")[segmentIDs])
+    seconds["hairlines"] = time.time() - start
+    counts["hairlines"] = len(smallestSegments)
+
+    start = time.time()
+    imgIO.savePixelAccessImg(outfile, outCanvas.toImage())
+    seconds["save"] = time.time() - start
+    return seconds, counts
+
+
+# returns the short hash of the git commit the source files are checked out from, or None
+def getCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Benchmarks the Gallery pictures gallery (file names) and the synthetic pictures of the given sizes (in megapixels), each repeat times keeping the fastest time of every stage.
+# Returns the record of the run for the history file.
+def runBenchmark(gallery, sizes, repeat=3, seed=0, galleryDir=GALLERY_DIR, verbose=True):
+    record = OrderedDict()
+    record["run"] = time.strftime("%Y%m%d-%H%M%S")
+    record["commit"] = getCommit()
+    record["host"] = platform.node()
+    record["python"] = platform.python_version()
+    record["numpy"] = np.__version__
+    record["repeat"] = repeat
+    record["seed"] = seed
+    record["images"] = OrderedDict()
+
+    pictures = [(name, lambda name=name: Image.open(os.path.join(galleryDir, name)).convert("RGB")) for name in gallery]
+    pictures += [("synthetic_" + str(size) + "MP", lambda size=size: imgIO.syntheticImage(size, seed)) for size in sizes]
+    outfile = os.path.join(tempfile.gettempdir(), "afremize_benchmark_" + str(os.getpid()) + ".png")
+    try:
+        for name, loadImage in pictures:
+            inIm = loadImage()
+            best = None
+            for i in range(0, repeat):
+                seconds, counts = benchmarkImage(inIm, outfile, seed)
+                best = seconds if best == None else OrderedDict((stage, min(best[stage], seconds[stage])) for stage in STAGES)
+            record["images"][name] = OrderedDict([("size", list(inIm.size)), ("seconds", best), ("total", sum(best.values())), ("counts", counts)])
+            if verbose:
+                print(name + " (" + str(inIm.size[0]) + "x" + str(inIm.size[1]) + "): " + str(round(sum(best.values()), 2)) + " s\n  " + ", ".join(stage + " " + str(round(best[stage], 3)) for stage in STAGES))
+            del inIm
+    finally:
+        if os.path.exists(outfile):
+            os.remove(outfile)
+    return record
+
+
+def loadHistory(historyFile):
+    with open(historyFile) as f:
+        return [json.loads(line, object_pairs_hook=OrderedDict) for line in f if line.strip()]
+
+
+def appendHistory(historyFile, record):
+    with open(historyFile, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+# Compares the runs old and new (records of the history file) and prints the stage times of the pictures benchmarked in both runs.
+# A stage (or the total) is flagged as a regression if it got slower by more than threshold percent and by more than minSeconds (shorter stages fluctuate too much). Returns the number of regressions.
+def compareRuns(old, new, threshold=25, minSeconds=0.2):
+    print("comparing run " + old["run"] + " (commit " + str(old["commit"]) + ") with run " + new["run"] + " (commit " + str(new["commit"]) + ")")
+    regressions = 0
+    for name in new["images"]:
+        if name not in old["images"]:
+            continue
+        oldImage, newImage = old["images"][name], new["images"][name]
+        print("\n" + name + ":")
+        rows = [(stage, oldImage["seconds"].get(stage), newImage["seconds"].get(stage)) for stage in STAGES] + [("total", oldImage["total"], newImage["total"])]
+        for stage, oldSeconds, newSeconds in rows:
+            if oldSeconds == None or newSeconds == None:
+                continue
+            change = (newSeconds - oldSeconds) / max(oldSeconds, 1e-9) * 100
+            flag = ""
+            if change > threshold and newSeconds - oldSeconds > minSeconds:
+                flag = "REGRESSION"
+                regressions += 1
+            elif change < -threshold and oldSeconds - newSeconds > minSeconds:
+                flag = "faster"
+            print("  %-20s %9.3f s %9.3f s %+8.1f %%  %s" % (stage, oldSeconds, newSeconds, change, flag))
+        if oldImage["counts"] != newImage["counts"]:
+            print("  the runs did different work: " + json.dumps(oldImage["counts"]) + " vs. " + json.dumps(newImage["counts"]))
+    print("\n" + str(regressions) + " regressions")
+    return regressions
+
+
+CHECKED_STROKE_SIZES = [(3, 1), (3, 2), (8, 1), (8, 2), (8, 3), (22, 22), (40, 13), (13, 60)]  # (sizeX, sizeY), including the strokes of one and two rows the arc functions special-case
+
+
+# Paints complex brush strokes of all CHECKED_STROKE_SIZES (plain and ground ones, with the log arc of brushstroke.paintStroke(), with and without a stroke template cache)
+# with the vectorized rasterizer and with the per-pixel reference implementation, which have to give the same pixels, and prints the strokes that differ or fail in either of them. Returns their number.
+def checkStrokes(seed=0):
+    failures = 0
+    colorRng = np.random.RandomState(seed)
+    for sizeX, sizeY in CHECKED_STROKE_SIZES:
+        for groundSegment in (False, True):
+            for cached in (False, True):
+                startColors, endColors = colorRng.randint(0, 256, (2, 2, 3))
+                stroke = "sizeX " + str(sizeX) + ", sizeY " + str(sizeY) + (", ground" if groundSegment else "") + (", cached templates" if cached else "")
+                pixels = []
+                for vectorized in (True, False):
+                    side = 4 * (sizeX + sizeY) + 8
+                    outCanvas = canvas.Canvas(Image.new("RGB", (side, side), (255, 255, 255)))
+                    templateCache = brushstroke.StrokeTemplateCache() if cached else None
+                    try:
+                        brushstroke.complex_brushstroke(outCanvas, side // 2, side // 2, sizeX, sizeY, startColors.copy(), endColors.copy(), arcType="log", groundSegment=groundSegment, vectorized=vectorized, templateCache=templateCache, rng=random.Random(seed))
+                    except Exception as error:
+                        print("the " + ("vectorized" if vectorized else "per-pixel") + " rasterizer fails: " + stroke + ": " + type(error).__name__ + ": " + str(error))
+                        break
+                    pixels.append(np.array(outCanvas.toImage()))
+                if len(pixels) < 2 or not np.array_equal(pixels[0], pixels[1]):
+                    failures += 1
+                    if len(pixels) == 2:
+                        print("the strokes differ: " + stroke)
+    print(str(failures) + " of " + str(len(CHECKED_STROKE_SIZES) * 4) + " strokes differ between the vectorized and the per-pixel rasterizer or fail")
+    return failures
+
+
+# converts the picture infile out of core with memoryBudget MB and the default options of main.py, run in a new process by checkMemory(). Returns the peak memory of the process in MB.
+def getPeakMemory(infile, memoryBudget, seed=0):
+    import resource  # imported here, there is none on Windows
+    afremize.convertImage(os.path.basename(infile), path=os.path.dirname(infile) + os.sep, memoryBudget=memoryBudget * 1024**2, seed=seed, strokeWidth=None, strokeHeight=None, strokeDensity=None, segBound=None)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024  # bytes on macOS, kB elsewhere
+
+
+# Checks that the memory of out-of-core conversions stays bounded by their budget as the pictures grow: converts synthetic pictures of the given sizes (in megapixels, saved as PPM files, which are mapped and not decoded)
+# with memoryBudget MB, each in a new process, and prints their peak memory. Returns the number of pictures whose peak memory exceeds that of the smallest one by more than tolerance percent.
+def checkMemory(sizes=CHECKED_MEMORY_SIZES, memoryBudget=64, tolerance=25, seed=0):
+    directory = tempfile.mkdtemp(prefix="afremize_memory_")
+    pool = multiprocessing.get_context("spawn").Pool(1, maxtasksperchild=1)  # a new process per picture, without the memory of this one
+    try:
+        peaks = []
+        for size in sorted(sizes):
+            infile = os.path.join(directory, "synthetic_" + str(size) + "MP.ppm")
+            imgIO.syntheticImage(size, seed).save(infile)
+            peaks.append(pool.apply(getPeakMemory, (infile, memoryBudget, seed)))
+            print("%gMP: peak memory %.0f MB with a budget of %d MB" % (size, peaks[-1], memoryBudget))
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(directory, ignore_errors=True)
+    failures = sum(1 for peak in peaks[1:] if peak > peaks[0] * (1 + tolerance / 100))
+    print(str(failures) + " of " + str(len(peaks) - 1) + " larger pictures take more than " + str(tolerance) + "% more memory than the smallest one")
+    return failures
+
+
+if __name__ == "__main__":
+
+    parser = OptionParser()
+    parser.add_option("--gallery",
+                      dest="gallery",
+                      help="Comma separated file names of the Gallery pictures to benchmark, or 'none'. [default: all pictures of the Gallery]")
+    parser.add_option("--sizes",
+                      dest="sizes", default=",".join(str(size) for size in SYNTHETIC_SIZES),
+                      help="Comma separated sizes of the synthetic pictures in megapixels, or 'none'. [default: %default]")
+    parser.add_option("--repeat",
+                      dest="repeat", default=3,
+                      help="Number of conversions of every picture, the fastest time of every stage is kept. [default: %default]")
+    parser.add_option("--seed",
+                      dest="seed", default=0,
+                      help="Seed of the synthetic pictures and of the random numbers of the conversions. [default: %default]")
+    parser.add_option("--history",
+                      dest="history", default="benchmark_history.jsonl",
+                      help="History file, every run is appended to it as a line of JSON. [default: %default]")
+    parser.add_option("--compare",
+                      dest="compare",
+                      help="Compare two runs of the history file instead of benchmarking: RUN_A,RUN_B, or 'last' for the last two runs. Exits with status 1 if there are regressions.")
+    parser.add_option("--checkStrokes",
+                      action="store_true", dest="checkStrokes", default=False,
+                      help="Check that the vectorized and the per-pixel rasterizer paint the same complex brush strokes (of several sizes, down to one row) instead of benchmarking. Exits with status 1 if they differ.")
+    parser.add_option("--checkMemory",
+                      action="store_true", dest="checkMemory", default=False,
+                      help="Check that the peak memory of out-of-core conversions (see --memoryBudget of main.py) of synthetic pictures of " + " and ".join(str(size) for size in CHECKED_MEMORY_SIZES) + " megapixels stays the same instead of benchmarking. Exits with status 1 if it grows with the picture by more than --threshold percent.")
+    parser.add_option("--memoryBudget",
+                      dest="memoryBudget", default=64,
+                      help="Memory budget in MB of the conversions of --checkMemory. [default: %default]")
+    parser.add_option("--threshold",
+                      dest="threshold", default=25,
+                      help="Percentage by which a stage has to get slower to be flagged as a regression by --compare, and by which the peak memory may grow with --checkMemory. [default: %default]")
+
+    (options, args) = parser.parse_args()
+
+    if options.checkStrokes:
+        sys.exit(1 if checkStrokes(int(options.seed)) > 0 else 0)
+
+    if options.checkMemory:
+        sys.exit(1 if checkMemory(CHECKED_MEMORY_SIZES, int(options.memoryBudget), float(options.threshold), int(options.seed)) > 0 else 0)
+
+    if options.compare != None:
+        history = loadHistory(options.history)
+        if options.compare == "last":
+            if len(history) < 2:
+                sys.exit("the history file " + options.history + " contains less than two runs")
+            old, new = history[-2], history[-1]
+        else:
+            runs = dict((record["run"], record) for record in history)
+            compared = options.compare.split(",")
+            if len(compared) != 2:
+                sys.exit("--compare expects RUN_A,RUN_B or 'last', not " + options.compare)
+            for run in compared:
+                if run not in runs:
+                    sys.exit("the history file " + options.history + " contains no run " + run)
+            old, new = runs[compared[0]], runs[compared[1]]
+        sys.exit(1 if compareRuns(old, new, float(options.threshold)) > 0 else 0)
+
+    gallery = galleryImages() if options.gallery == None else [name for name in options.gallery.split(",") if name not in ("", "none")]
+    sizes = [float(size) for size in options.sizes.split(",") if size not in ("", "none")]
+    sizes = [int(size) if size == int(size) else size for size in sizes]
+    record = runBenchmark(gallery, sizes, max(1, int(options.repeat)), int(options.seed))
+    appendHistory(options.history, record)
+    print("run " + record["run"] + " appended to " + options.history)
@@ -17,45 +17,39 @@ from __future__ import division
 from __future__ import print_function
 import numpy as np
 from PIL import Image
-from scipy.interpolate import interp1d
-from random import randint
 import random
 from math import log, floor, ceil, sin, cos, radians, sqrt
-from skimage.segmentation import felzenszwalb
+from collections import OrderedDict
+import zlib
 
 # own imports:
 import imgIO
+import profiling
 
 
 # returns an ndarray of offsets from the left margin of a brush stroke that form an arc
 def createCosArc(sizeY, bulgeSize):
     if sizeY == 1:
-        return np.zeros(1)
+        return np.zeros(1, dtype=int)
     if sizeY == 2:
-        return np.zeros(2)
+        return np.zeros(2, dtype=int)
     startdegr = -90
     stopdegr = 90
-    arc = np.zeros(sizeY)
-    middle = sizeY // 2
     stepsize = max((abs(startdegr) + stopdegr) / sizeY, 0.00000001)
-    degrees = np.zeros(sizeY) # degrees contains the x values, arc the correspnding cos(x) values
+    # degrees contains the x values, arc the correspnding cos(x) values. Summed up step by step to get the same degrees as repeated addition would
+    degrees = np.full(sizeY, stepsize)
     degrees[0] = startdegr
-    for i in range(1, len(degrees)):
-        degrees[i] = degrees[i-1] + stepsize
-    i = 0
-    # degr is a value between 0 and 1 (between cos(startdegr) and cos(stopdegr))
-    for degr in degrees:
-        arc[i] = floor(cos(radians(degr)) * bulgeSize)
-        i = i + 1
+    degrees = np.cumsum(degrees)
+    arc = np.floor(np.cos(np.radians(degrees)) * bulgeSize)
     return arc.astype(int)
 
 
 # returns an ndarray of offsets from the left margin of a brush stroke that form an log curve-shaped arc
 def createLogArc(sizeY, bulgeSize):
     if sizeY == 1:
-        return np.zeros(1)
+        return np.zeros(1, dtype=int)
     if sizeY == 2:
-        return np.zeros(2)
+        return np.zeros(2, dtype=int)
     arc = np.zeros(sizeY)
     stepsize = 10 / sizeY # we use values between log(1) and log(11)
     logparam = 1.1
@@ -68,40 +62,69 @@ def createLogArc(sizeY, bulgeSize):
     return arc.astype(int)
 
 
-# for each given x value the corresponding value is computed (by interpolating from the given y values)
+# inverses of the matrices of the equations for the second derivatives of not-a-knot cubic splines through n equidistant knots, by n (see createPolynomialCubic())
+splineMatrices = {}
+
+
+def getSplineMatrix(n):
+    if n not in splineMatrices:
+        matrix = np.zeros((n, n))
+        matrix[0, 0:3] = (1, -2, 1)  # not-a-knot: the third derivative is continuous at the second knot ...
+        matrix[n - 1, n - 3:n] = (1, -2, 1)  # ... and at the second last one
+        for i in range(1, n - 1):
+            matrix[i, i - 1:i + 2] = (1, 4, 1)  # the first derivative is continuous at the inner knots
+        splineMatrices[n] = np.linalg.inv(matrix)
+    return splineMatrices[n]
+
+
+# for each given x value the corresponding value is computed (by interpolating from the given y values), with the not-a-knot cubic spline of scipy's interp1d(kind='cubic')
+# y: at least 4 values, or an array of several columns of values, which are interpolated all at once
 def createPolynomialCubic(x, y):
-    shortx = np.linspace(0, len(x), num=len(y), endpoint=True) # because we cannot interpolate if x and y are not of the same length
-    f = interp1d(shortx, y, kind='cubic') # perform cubic spline interpolation
-    template = f(x)
+    y = np.asarray(y, dtype=float)
+    x = np.asarray(x, dtype=float)
+    n = len(y)
+    knots = np.linspace(0, len(x), num=n, endpoint=True) # because we cannot interpolate if x and y are not of the same length
+    h = len(x) / (n - 1)  # distance between the knots
+    curvature = np.zeros(y.shape)
+    curvature[1:n - 1] = 6 * (y[0:n - 2] - 2 * y[1:n - 1] + y[2:n]) / h**2
+    secondDerivatives = getSplineMatrix(n).dot(curvature)
+    # the polynomial of the interval [knots[i], knots[i + 1]], in powers of t = x - knots[i]:
+    i = np.clip(np.searchsorted(knots, x, side='right') - 1, 0, n - 2)
+    t = (x - knots[i]).reshape((-1,) + (1,) * (y.ndim - 1))
+    slope = (y[i + 1] - y[i]) / h - h * (2 * secondDerivatives[i] + secondDerivatives[i + 1]) / 6
+    template = y[i] + t * (slope + t * (secondDerivatives[i] / 2 + t * (secondDerivatives[i + 1] - secondDerivatives[i]) / (6 * h)))
     return template
 
 
+# as createPolynomialCubic(), with linear interpolation (computed by np.interp(), as scipy's interp1d does it)
 def createPolynomialLinear(x, y):
-    shortx = np.linspace(0, len(x), num=len(y), endpoint=True) # because we cannot interpolate if x and y are not of the same length
-    f = interp1d(shortx, y) # perform linear spline interpolation
-    template = f(x)
-    return template
+    y = np.asarray(y, dtype=float)
+    knots = np.linspace(0, len(x), num=len(y), endpoint=True)
+    if y.ndim == 1:
+        return np.interp(x, knots, y)
+    return np.stack([np.interp(x, knots, y[:, column]) for column in range(0, y.shape[1])], axis=1)
 
 
 # create a random curve to use as template for cutting of parts of brush stroke
-def buildCutoffTemplates(sizeX, sizeY):
+# rng: source of the random numbers, the random module or a random.Random instance
+def buildCutoffTemplates(sizeX, sizeY, rng=random):
     xtempl = range(0, sizeX)
     stop1 = max(1, int(sizeY*0.2))
-    tmp1 = randint(int(sizeY*0.1), max(1, int(sizeY*0.3)))
-    tmp2 = randint(int(sizeY*0.05), stop1)
-    tmp3 = randint(int(sizeY*0.05), stop1)
-    tmp4 = randint(int(sizeY*0.05), stop1)
-    tmp5 = randint(int(sizeY*0.1), stop1)
+    tmp1 = rng.randint(int(sizeY*0.1), max(1, int(sizeY*0.3)))
+    tmp2 = rng.randint(int(sizeY*0.05), stop1)
+    tmp3 = rng.randint(int(sizeY*0.05), stop1)
+    tmp4 = rng.randint(int(sizeY*0.05), stop1)
+    tmp5 = rng.randint(int(sizeY*0.1), stop1)
     ytempl = [tmp1, tmp2, tmp3, tmp4, tmp5]
     upperTemplate = createPolynomialCubic(xtempl, ytempl)
     
     stop2 = max(1, int(sizeY*0.03))
-    tmp1 = randint(int(sizeY*0.15), int(sizeY*0.2))
-    tmp2 = randint(0, stop2)
-    tmp3 = randint(0, stop2)
-    tmp4 = randint(0, stop2)
-    tmp5 = randint(0, stop2)
-    tmp6 = randint(int(sizeY*0.15), int(sizeY*0.2))
+    tmp1 = rng.randint(int(sizeY*0.15), int(sizeY*0.2))
+    tmp2 = rng.randint(0, stop2)
+    tmp3 = rng.randint(0, stop2)
+    tmp4 = rng.randint(0, stop2)
+    tmp5 = rng.randint(0, stop2)
+    tmp6 = rng.randint(int(sizeY*0.15), int(sizeY*0.2))
     ytempl = [tmp1, tmp2, tmp3, tmp4, tmp5, tmp6]
     lowerTemplate = createPolynomialCubic(xtempl, ytempl)
     return abs(upperTemplate.astype(int)), abs(lowerTemplate.astype(int))
@@ -146,42 +169,35 @@ def computeYcolorGradient(y, sizeY, sizeYedge, startColors_x, endColors_x, gradi
 
 # create a vector 'colors' of length sizeXedge of RGBA values with smooth color transitions (unlike in the original color vector 'seed')
 def interpolateColors(seed, sizeXedge):
-    # from the given startColors, create a linear polynomial to smooth color transitions along x-axis:
+    # from the given startColors, create a linear polynomial to smooth color transitions along x-axis, for all color channels at once:
     # we'll use linear interpolation because cubic interpolation needs at least 4 entries
-    colorsR = createPolynomialLinear(range(0, sizeXedge), seed[:,0]).astype(int)
-    colorsR = np.expand_dims(colorsR, 1) # transform array of shape (sizeXedge,) to (sizeXedge, 1)
-    colorsG = createPolynomialLinear(range(0, sizeXedge), seed[:,1]).astype(int)
-    colorsG = np.expand_dims(colorsG, 1)
-    colorsB = createPolynomialLinear(range(0, sizeXedge), seed[:,2]).astype(int)
-    colorsB = np.expand_dims(colorsB, 1)
-    colorsA = np.zeros([sizeXedge, 1], dtype=int)
-    colorsA = colorsA + 255
-    # now put the color channels back together:
-    colors = np.append(colorsR, colorsG, axis=1)
-    colors = np.append(colors, colorsB, axis=1)
-    colors = np.append(colors, colorsA, axis=1)
+    colors = np.empty([sizeXedge, 4], dtype=int)
+    colors[:, 0:3] = createPolynomialLinear(range(0, sizeXedge), seed[:, 0:3]).astype(int)
+    colors[:, 3] = 255
     return colors
 
 
-def getStreakGradientPoints(streakWidth, streakWidthMin, streakWidthMax, gradientStart, gradientStop, sizeYedge):
+# sizeYedge: the height of the visible part of the column, which is negative where the upper and lower cutoffs overlap (the column stays unpainted then)
+def getStreakGradientPoints(streakWidth, streakWidthMin, streakWidthMax, gradientStart, gradientStop, sizeYedge, rng=random):
+    sizeYedge = max(0, sizeYedge)
     if streakWidth == 0:
-        gradientStart = randint(0, (4*sizeYedge)//5) # distance from upper margin at which gradient starts
+        gradientStart = rng.randint(0, (4*sizeYedge)//5) # distance from upper margin at which gradient starts
         gradientStop = 0 # distance from lower margin at which gradient stops
         streakWidth = streakWidth + 1
     # we have either not yet reached streakWidthMin or we just continue to enlarge streak just by chance:
-    elif streakWidth < streakWidthMin or random.choice([True, False]):
+    elif streakWidth < streakWidthMin or rng.choice([True, False]):
         # increase by 1, descrease by 1 or do not change:
-        gradientStart = min(255,max(0, gradientStart - random.choice([-2,0,2])))
-        gradientStop = min(255,max(0, gradientStop - random.choice([-2,0,2])))
+        gradientStart = min(255,max(0, gradientStart - rng.choice([-2,0,2])))
+        gradientStop = min(255,max(0, gradientStop - rng.choice([-2,0,2])))
         if (gradientStart + gradientStop) == sizeYedge:
             gradientStart = max(gradientStart - 1, 0)
             gradientStop = max(gradientStop - 1, 0)
         streakWidth = streakWidth + 1
     else: # this is responsible for the thin long streaks with width 1 between the broader streaks:
-        gradientStart = randint(0, (4*sizeYedge)//5)
+        gradientStart = rng.randint(0, (4*sizeYedge)//5)
         gradientStop = 0
         streakWidth = 0
-        streakWidthMin = randint(1, max(1,streakWidthMax))
+        streakWidthMin = rng.randint(1, max(1,streakWidthMax))
     
     # to not group the hairlines into streaks, uncomment the following two lines:
     #gradientStart = randint(0, sizeYedge-1)
@@ -189,19 +205,226 @@ def getStreakGradientPoints(streakWidth, streakWidthMin, streakWidthMax, gradien
     return gradientStart, gradientStop, streakWidth, streakWidthMin
 
 
+# Bounded cache of the shape templates of complex brush strokes.
+# Most strokes of an image share the same (sizeX, sizeY, arcType, groundSegment), so instead of building the arc and two cubic cutoff splines for every stroke, a pool of pre-generated random template variants is kept per shape key and each stroke picks one of them at random.
+# The variants of a key are generated from their own random.Random seeded by the key, so they do not depend on the order in which strokes ask for them. When more than maxEntries keys are cached, the least recently used key is evicted.
+class StrokeTemplateCache(object):
+
+    def __init__(self, maxEntries=256, variants=8):
+        self.maxEntries = maxEntries
+        self.variants = variants
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # returns the arc and one randomly chosen (upperTemplate, lowerTemplate) variant for this shape. sizeX, sizeY and bulgeSize are the final sizes used by complex_brushstroke() (i.e. after the ground segment adjustments)
+    # rng picks the variant, just like it would have drawn the random template points. profile: a profiling.Profile timing the spline setup of new entries, or None
+    def get(self, sizeX, sizeY, bulgeSize, arcType, groundSegment, rng=random, profile=None):
+        key = (sizeX, sizeY, bulgeSize, arcType, groundSegment)
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            entry = buildStrokeTemplates(sizeX, sizeY, bulgeSize, arcType, groundSegment, self.variants, random.Random(zlib.crc32(repr(key).encode('ascii'))), profile)
+            while len(self.entries) >= self.maxEntries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.hits += 1
+        self.entries[key] = entry  # (re)insert as the most recently used key
+        arc, templates = entry
+        upperTemplate, lowerTemplate = templates[rng.randint(0, len(templates) - 1)]
+        return arc, upperTemplate, lowerTemplate
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": len(self.entries)}
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+# builds the cache entry for StrokeTemplateCache.get(): the arc and a list of numOfVariants (upperTemplate, lowerTemplate) pairs
+# profile: a profiling.Profile timing the setup of the cutoff splines, or None
+def buildStrokeTemplates(sizeX, sizeY, bulgeSize, arcType, groundSegment, numOfVariants, rng, profile=None):
+    if arcType == "log":
+        arc = createLogArc(sizeY, bulgeSize)
+    elif arcType == "cos":
+        arc = createCosArc(sizeY, bulgeSize)
+    templates = []
+    for i in range(0, numOfVariants):
+        if groundSegment:
+            capSize = rng.randint(int(sizeX * 0.3), int(sizeX * 0.5))
+            upperTemplate, lowerTemplate = build_simple_CutoffTemplates(sizeX, capSize)
+            templates.append((np.asarray(upperTemplate), np.asarray(lowerTemplate)))
+        else:
+            with profiling.hotPath(profile, "splineSetup"):
+                templates.append(buildCutoffTemplates(sizeX, sizeY, rng))
+    return arc, templates
+
+
+# returns the affine matrix (a, b, c, d, e, f) and the size (w, h) that Image.rotate(angle, expand=True) would use for an image of size width x height.
+# The matrix maps the (pixel center) coordinates of the rotated image back into the unrotated image: xin = a*x + b*y + c, yin = d*x + e*y + f
+def getRotationMatrix(width, height, angle):
+    angle = -radians(angle % 360.0)
+    a, b = round(cos(angle), 15), round(sin(angle), 15)
+    d, e = round(-sin(angle), 15), round(cos(angle), 15)
+    centerX, centerY = width / 2, height / 2
+    c = a * -centerX + b * -centerY + centerX
+    f = d * -centerX + e * -centerY + centerY
+    # expand: the rotated image gets the size of the bounding box of the rotated corners
+    xx = [a * x + b * y + c for x, y in ((0, 0), (width, 0), (width, height), (0, height))]
+    yy = [d * x + e * y + f for x, y in ((0, 0), (width, 0), (width, height), (0, height))]
+    newWidth = int(ceil(max(xx)) - floor(min(xx)))
+    newHeight = int(ceil(max(yy)) - floor(min(yy)))
+    shiftX, shiftY = -(newWidth - width) / 2, -(newHeight - height) / 2
+    c, f = a * shiftX + b * shiftY + c, d * shiftX + e * shiftY + f
+    return (a, b, c, d, e, f), (newWidth, newHeight)
+
+
+# PIL filters corresponding to the resample names accepted by rotateStroke()
+PIL_FILTERS = {"nearest": Image.NEAREST, "bilinear": Image.BILINEAR, "bicubic": Image.BICUBIC}
+
+
+# Rotates the upright brush stroke array stroke (shape (height, width, 4), uint8 RGBA) counter-clockwise by angle degrees and crops it to its visible pixels.
+# This gives the same sprite as Image.rotate(angle, resample, expand=True) followed by getbbox() and crop(), but in one pass: the bounding box of the rotated stroke is computed from the rotation matrix, and every pixel of that box is mapped back into stroke space and sampled there by a single affine transform.
+# The expanded rotated image is never allocated and never scanned.
+# resample: "nearest", "bilinear" or "bicubic"
+# returns the sprite (uint8 RGBA array) and the position of its upper left corner in the (uncropped) rotated image
+def rotateStroke(stroke, angle, resample="bicubic"):
+    height, width = stroke.shape[:2]
+    alpha = stroke[:, :, 3]
+    rows = np.flatnonzero(alpha.any(axis=1))
+    cols = np.flatnonzero(alpha.any(axis=0))
+    if len(rows) == 0:
+        return np.zeros((0, 0, 4), dtype=np.uint8), (0, 0)
+    turns = (angle % 360.0) / 90
+    if turns == int(turns):  # multiples of 90 degrees are exact transpositions, like in Image.rotate()
+        stroke = np.rot90(stroke, int(turns))
+        alpha = stroke[:, :, 3]
+        rows = np.flatnonzero(alpha.any(axis=1))
+        cols = np.flatnonzero(alpha.any(axis=0))
+        return stroke[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1], (int(cols[0]), int(rows[0]))
+    
+    matrix, (newWidth, newHeight) = getRotationMatrix(width, height, angle)
+    a, b, c, d, e, f = matrix
+    # forward map the corners of the visible part of the stroke. Together with the reach of the filter, they bound the region of the rotated image that can receive color:
+    det = a * e - b * d
+    cornersX = []
+    cornersY = []
+    for x, y in ((cols[0], rows[0]), (cols[-1] + 1, rows[0]), (cols[-1] + 1, rows[-1] + 1), (cols[0], rows[-1] + 1)):
+        cornersX.append(( e * (x - c) - b * (y - f)) / det)
+        cornersY.append((-d * (x - c) + a * (y - f)) / det)
+    left = max(0, int(floor(min(cornersX))) - 3)
+    top = max(0, int(floor(min(cornersY))) - 3)
+    right = min(newWidth, int(ceil(max(cornersX))) + 3)
+    bottom = min(newHeight, int(ceil(max(cornersY))) + 3)
+    
+    # sample only that region, by moving the origin of the transform to its upper left corner:
+    regionMatrix = (a, b, a * left + b * top + c, d, e, d * left + e * top + f)
+    strokeim = Image.fromarray(stroke)
+    if resample != "nearest":
+        strokeim = strokeim.convert("RGBa")  # interpolate with premultiplied alpha, as Image.rotate() does
+    region = strokeim.transform((right - left, bottom - top), Image.AFFINE, regionMatrix, PIL_FILTERS[resample])
+    if resample != "nearest":
+        region = region.convert("RGBA")
+    region = np.asarray(region)
+    
+    # crop away the remaining empty margin of the region:
+    visible = region[:, :, 3]
+    rows = np.flatnonzero(visible.any(axis=1))
+    cols = np.flatnonzero(visible.any(axis=0))
+    if len(rows) == 0:
+        return np.zeros((0, 0, 4), dtype=np.uint8), (0, 0)
+    return region[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1], (left + int(cols[0]), top + int(rows[0]))
+
+
+# the cache used by paintImg_with_brushstrokes() in afremize.py. It lives as long as the process, so a series of images with similar stroke sizes keeps profiting from it.
+templateCache = StrokeTemplateCache()
+
+
+# walks the streak state machine of getStreakGradientPoints() once per column and returns the gradientStart and gradientStop offsets of all columns as arrays
+# The random draws happen in the same order as in the per-pixel loop of complex_brushstroke(), so both rasterizers produce the same streaks.
+def getStreakGradientArrays(sizeYedges, streakWidthMin, streakWidthMax, gradientStart, rng=random):
+    sizeXedge = len(sizeYedges)
+    gradientStarts = np.zeros(sizeXedge, dtype=int)
+    gradientStops = np.zeros(sizeXedge, dtype=int)
+    streakWidth = 0
+    gradientStop = 0
+    for x in range(0, sizeXedge):
+        gradientStart, gradientStop, streakWidth, streakWidthMin = getStreakGradientPoints(streakWidth, streakWidthMin, streakWidthMax, gradientStart, gradientStop, sizeYedges[x], rng)
+        gradientStarts[x] = gradientStart
+        gradientStops[x] = gradientStop
+    return gradientStarts, gradientStops
+
+
+# Array version of the x/y loop in complex_brushstroke(): computes the colors of all pixels of the upright brush stroke at once and returns them as an (sizeY, strokeWidth, 4) uint8 array.
+# Every pixel gets the color computeYcolorGradient() would give it, and is written to column x + arc[y] just like in the per-pixel loop.
+# startColors, endColors: the interpolated (sizeXedge, 4) color vectors
+# gradientStarts, gradientStops: per-column results of getStreakGradientArrays()
+def rasterizeComplexStroke(strokeWidth, sizeY, sizeXedge, arc, upperTemplate, lowerTemplate, startColors, endColors, gradientStarts, gradientStops, whitenMargin):
+    stroke = np.zeros((sizeY, strokeWidth, 4), dtype=np.uint8)
+    if sizeXedge <= 0:
+        return stroke
+    upper = np.asarray(upperTemplate[:sizeXedge], dtype=int)
+    sizeYedges = sizeY - upper - np.asarray(lowerTemplate[:sizeXedge], dtype=int)
+    startColors = np.asarray(startColors[:sizeXedge], dtype=int)
+    endColors = np.asarray(endColors[:sizeXedge], dtype=int)
+    
+    ys = np.arange(sizeY)[:, None]
+    
+    # pixels that the upper and lower templates allow to be painted. Columns with a visible height of 1 only get a single pixel in row 0 (see below):
+    painted = (ys >= upper) & (ys < sizeYedges) & (sizeYedges != 1)
+    
+    # linear color gradient between gradientStart and sizeYedge - gradientStop:
+    progressStop = sizeYedges - gradientStops - gradientStarts
+    with np.errstate(divide='ignore', invalid='ignore'):
+        yprogress = (ys - gradientStarts) / progressStop
+    yprogress[:, progressStop == 0] = 0
+    RGBdists = startColors[:, :3] - endColors[:, :3]
+    gradient = startColors[None, :, :3] - (RGBdists[None, :, :] * yprogress[:, :, None]).astype(int)
+    
+    # now override the gradient by constant colors in the order computeYcolorGradient() checks its cases, the first matching case winning:
+    colors = gradient
+    colors = np.where((ys > sizeYedges - gradientStops)[:, :, None], endColors[None, :, :3], colors)
+    if whitenMargin:
+        whiteMarginSize = max(3, sizeY // 30)
+        blackMarginSize = max(1, whiteMarginSize // 10)
+        colors = np.where((ys > sizeYedges - whiteMarginSize)[:, :, None], np.minimum(255, endColors[None, :, :3] + 50), colors)  # whiten the area directly above the edge
+        colors = np.where((ys >= sizeYedges - blackMarginSize)[:, :, None], np.maximum(0, endColors[None, :, :3] - 50), colors)  # darken the edge
+    colors = np.where((ys < gradientStarts)[:, :, None], startColors[None, :, :3], colors)
+    
+    rows, cols = np.nonzero(painted)
+    stroke[rows, cols + arc[rows], :3] = np.clip(colors[rows, cols], 0, 255)
+    stroke[rows, cols + arc[rows], 3] = 255
+    
+    singleRowCols = np.nonzero(sizeYedges == 1)[0]
+    stroke[0, singleRowCols + arc[0], :3] = np.clip(startColors[0, :3], 0, 255)
+    stroke[0, singleRowCols + arc[0], 3] = 255
+    return stroke
+
+
+# outCanvas: the canvas.Canvas the brush stroke is painted on
 # startColors is a numpy array of shape (x,4) containing x many RGBA values to use from the top of the brush stroke
-def complex_brushstroke(outIm, X, Y, sizeX, sizeY, startColors, endColors, angleStart=-60, angleStop=10, arcType='log', groundSegment=False, colorify=0, noMargins=False):
+# vectorized: if False, the stroke is filled pixel by pixel via computeYcolorGradient() (slow reference implementation) instead of by rasterizeComplexStroke()
+# templateCache: a StrokeTemplateCache to take the arc and cutoff templates from. If None, they are built from scratch for this stroke.
+# directRaster: if True, the rotated stroke is sampled directly by rotateStroke(), otherwise PIL rotates, scans and crops the stroke image. resample is the filter used for the rotation.
+# rng: source of the random numbers, the random module or a random.Random instance
+# profile: a profiling.Profile timing the hot paths of the stroke (the setup of its cutoff splines, rotating and pasting it) and counting the pixels pasted, or None
+def complex_brushstroke(outCanvas, X, Y, sizeX, sizeY, startColors, endColors, angleStart=-60, angleStop=10, arcType='log', groundSegment=False, colorify=0, noMargins=False, vectorized=True, templateCache=None, directRaster=True, resample="bicubic", rng=random, profile=None):
     
     if colorify > 0:
         for i in range(0, len(startColors)):
             maxChannel = startColors[i].argmax()
-            if random.choice([True, False]):
+            if rng.choice([True, False]):
                 startColors[i][maxChannel] = min(255, startColors[i][maxChannel] + colorify)
             else:
                 startColors[i][maxChannel] = max(0, startColors[i][maxChannel] - colorify)
         for i in range(0, len(endColors)):
             maxChannel = startColors[i].argmax()
-            if random.choice([True, False]):
+            if rng.choice([True, False]):
                 endColors[i][maxChannel] = min(255, endColors[i][maxChannel] + colorify)
             else:
                 endColors[i][maxChannel] = max(0, endColors[i][maxChannel] - colorify)
@@ -210,76 +433,99 @@ def complex_brushstroke(outIm, X, Y, sizeX, sizeY, startColors, endColors, angle
     if groundSegment:
         sizeX = max(1, int(sizeX * 0.4))
         sizeY = max(1, int(sizeY * 2))
-        angle = randint(80,100)
-        capSize = randint(int(sizeX * 0.3), int(sizeX * 0.5))
-        upperTemplate, lowerTemplate = build_simple_CutoffTemplates(sizeX, capSize)
+        angle = rng.randint(80,100)
         bulgeSize = int(sizeX * (3/5))
         if arcType == "cos":
             bulgeSize = int(sizeX * (2/5))
+        if templateCache != None:
+            arc, upperTemplate, lowerTemplate = templateCache.get(sizeX, sizeY, bulgeSize, arcType, groundSegment, rng, profile)
+        else:
+            capSize = rng.randint(int(sizeX * 0.3), int(sizeX * 0.5))
+            upperTemplate, lowerTemplate = build_simple_CutoffTemplates(sizeX, capSize)
         whitenMargin = False
     else:
-        angle = randint(angleStart, angleStop)  # rotate each brushstroke clockwise by -10 to 60 degrees
-        upperTemplate, lowerTemplate = buildCutoffTemplates(sizeX, sizeY)
+        angle = rng.randint(angleStart, angleStop)  # rotate each brushstroke clockwise by -10 to 60 degrees
         bulgeSize = int(sizeX * (2/5))
         if arcType == "cos":
             bulgeSize = int(sizeX * (1/5))
+        if templateCache != None:
+            arc, upperTemplate, lowerTemplate = templateCache.get(sizeX, sizeY, bulgeSize, arcType, groundSegment, rng, profile)
+        else:
+            with profiling.hotPath(profile, "splineSetup"):
+                upperTemplate, lowerTemplate = buildCutoffTemplates(sizeX, sizeY, rng)
         if noMargins:
             whitenMargin = False
         else:
-            whitenMargin = random.choice([True, False])
+            whitenMargin = rng.choice([True, False])
     
     # need to subtract bulgeSize//2 from sizeXedge to make brush strokes narrower because the polynomial template cutoffs (cutting of from top and bottom) make them wider. Subtracting the stroke width by bulgeSize instead of bulgeSize//2 would make the strokes too narrow.
-    strokeim, strokepix = imgIO.createTransparentImg(sizeX + int(ceil(bulgeSize/2)), sizeY)
+    strokeWidth = sizeX + int(ceil(bulgeSize/2))
     sizeXedge = sizeX - bulgeSize//2 # the number of pixels along the x-axis that will actually be colored in
     
     startColors = interpolateColors(startColors, sizeXedge) # from startColors, create a vector of length sizeXedge of RGBA values with smooth color transitions (unlike in the original startColors)
     endColors = interpolateColors(endColors, sizeXedge)
     
-    if arcType == "log":
-        arc = createLogArc(sizeY, bulgeSize)
-    elif arcType == "cos":
-        arc = createCosArc(sizeY, bulgeSize)
-    arcLen = len(arc)
+    if templateCache == None:
+        if arcType == "log":
+            arc = createLogArc(sizeY, bulgeSize)
+        elif arcType == "cos":
+            arc = createCosArc(sizeY, bulgeSize)
     
     # group hairlines into color streaks (smudges) along the brush stroke length:
     streakWidthMax = sizeXedge // 4
-    streakWidthMin = randint(1, max(1,streakWidthMax))
-    streakWidth = 0
+    streakWidthMin = rng.randint(1, max(1,streakWidthMax))
     sizeYedge = sizeY - upperTemplate[0] - lowerTemplate[0]
-    gradientStart = randint(sizeYedge//3, max(1,sizeYedge//2 -1)) # distance from upper margin at which gradient starts
-    gradientStop = 0
+    gradientStart = rng.randint(sizeYedge//3, max(1,sizeYedge//2 -1)) # distance from upper margin at which gradient starts
     
-    for x in range(0, sizeXedge):
-        sizeYedge = sizeY - upperTemplate[x] - lowerTemplate[x] # y-size of the visible portion of brush stroke
-        
-        gradientStart, gradientStop, streakWidth, streakWidthMin = getStreakGradientPoints(streakWidth, streakWidthMin, streakWidthMax, gradientStart, gradientStop, sizeYedge)
+    if vectorized:
+        sizeYedges = sizeY - np.asarray(upperTemplate[:sizeXedge], dtype=int) - np.asarray(lowerTemplate[:sizeXedge], dtype=int)
+        gradientStarts, gradientStops = getStreakGradientArrays(sizeYedges, streakWidthMin, streakWidthMax, gradientStart, rng)
+        strokeArr = rasterizeComplexStroke(strokeWidth, sizeY, sizeXedge, arc, upperTemplate, lowerTemplate, startColors, endColors, gradientStarts, gradientStops, whitenMargin)
+    else:
+        strokeim, strokepix = imgIO.createTransparentImg(strokeWidth, sizeY)
+        streakWidth = 0
+        gradientStop = 0
         
-        if sizeYedge == 1:
-            strokepix[x + arc[0], 0] = (startColors[0][0], startColors[0][1], startColors[0][2], 255)
-        else:
-            progressStop = sizeYedge - gradientStop - gradientStart # size of range for which color gradient is computed. The rest uses constant colors.
+        for x in range(0, sizeXedge):
+            sizeYedge = sizeY - upperTemplate[x] - lowerTemplate[x] # y-size of the visible portion of brush stroke
             
-            RGBdists = startColors[x] - endColors[x]  # color distances between start and end colors. This is sort of a gradient maximum. With this, and the spatial distance from a startColor pixel, we can compute the gradient for any y value between upperTemplate[x] (startColors) and sizeYedge (endColors).
-            A = 255
+            gradientStart, gradientStop, streakWidth, streakWidthMin = getStreakGradientPoints(streakWidth, streakWidthMin, streakWidthMax, gradientStart, gradientStop, sizeYedge, rng)
             
-            for y in range(upperTemplate[x], sizeYedge):
-                # if we are below the area our upperTemplate tells us not to paint and above the area lowerTemplate tells us not to paint:
+            if sizeYedge == 1:
+                strokepix[x + arc[0], 0] = (startColors[0][0], startColors[0][1], startColors[0][2], 255)
+            else:
+                progressStop = sizeYedge - gradientStop - gradientStart # size of range for which color gradient is computed. The rest uses constant colors.
+                
+                RGBdists = startColors[x] - endColors[x]  # color distances between start and end colors. This is sort of a gradient maximum. With this, and the spatial distance from a startColor pixel, we can compute the gradient for any y value between upperTemplate[x] (startColors) and sizeYedge (endColors).
+                A = 255
                 
-                # compute color gradient along y-axis (highly variable gradientStart and gradientStop values cause color streaks along the length of the brush stroke):
-                R, G, B, A = computeYcolorGradient(y, sizeY, sizeYedge, startColors[x], endColors[x], gradientStart, gradientStop, whitenMargin, progressStop, RGBdists, A)
-                strokepix[x + arc[y], y] = (R, G, B, A)
+                for y in range(upperTemplate[x], sizeYedge):
+                    # if we are below the area our upperTemplate tells us not to paint and above the area lowerTemplate tells us not to paint:
+                    
+                    # compute color gradient along y-axis (highly variable gradientStart and gradientStop values cause color streaks along the length of the brush stroke):
+                    R, G, B, A = computeYcolorGradient(y, sizeY, sizeYedge, startColors[x], endColors[x], gradientStart, gradientStop, whitenMargin, progressStop, RGBdists, A)
+                    strokepix[x + arc[y], y] = (R, G, B, A)
+        del strokepix
+        strokeArr = np.asarray(strokeim)
     
-    strokeim = strokeim.rotate(angle, resample=Image.BICUBIC, expand=True)
-    strokeim_bbox = strokeim.getbbox()
-    strokeim = strokeim.crop(strokeim_bbox) # crop away unnecessary empty margins caused by rotation
-
-    strokeimWidth, strokeimHeight = strokeim.size
-    xMidpoint = int(round(strokeimWidth / 2))
-    yMidpoint = int(round(strokeimHeight / 2))
+    with profiling.hotPath(profile, "rotate"):
+        if directRaster:
+            sprite, spriteCorner = rotateStroke(strokeArr, angle, resample)
+        else:
+            strokeim = Image.fromarray(strokeArr).rotate(angle, resample=PIL_FILTERS[resample], expand=True)
+            strokeim_bbox = strokeim.getbbox()
+            sprite = np.asarray(strokeim.crop(strokeim_bbox)) # crop away unnecessary empty margins caused by rotation
+    if directRaster and sprite.size == 0:
+        return
+
+    spriteHeight, spriteWidth = sprite.shape[:2]
+    xMidpoint = int(round(spriteWidth / 2))
+    yMidpoint = int(round(spriteHeight / 2))
     
-    outIm.paste(strokeim, (X - xMidpoint, Y - yMidpoint), strokeim)
-    del strokepix
-    del strokeim
+    with profiling.hotPath(profile, "paste"):
+        pasted = outCanvas.paste(sprite, (X - xMidpoint, Y - yMidpoint))
+    if profile != None:
+        profile.count("pixelsPasted", pasted)
 
 
 
@@ -287,7 +533,7 @@ def complex_brushstroke(outIm, X, Y, sizeX, sizeY, startColors, endColors, angle
 def build_simple_CutoffTemplates(sizeX, capSize):
     upperTemplate = createCosArc(sizeX, capSize)
     # we want the ends of upperTemplate to contain the highest values:
-    upperTemplate = [abs(int(capSize - upperTemplate[i])) for i in range(0, len(upperTemplate))]
+    upperTemplate = np.abs((capSize - upperTemplate).astype(int))
     lowerTemplate = upperTemplate
     return upperTemplate, lowerTemplate
 
@@ -300,35 +546,33 @@ def euclidDist(p1, p2):
 def getLineVectors(start, end):
     v = (end[0] - start[0], end[1] - start[1]) # vector between end points of regLine
     n = (-v[1], v[0])
-    n_normed = (n[0] / np.linalg.norm(n), n[1] / np.linalg.norm(n)) # normed normal vector
+    nLength = sqrt(float(n[0]) * float(n[0]) + float(n[1]) * float(n[1]))  # the same value np.linalg.norm(n) gives
     if (start[0] * n[0] + start[1] * n[1]) >= 0:
-        n_normed = (n[0] / np.linalg.norm(n), n[1] / np.linalg.norm(n)) # normed normal vector
+        n_normed = (n[0] / nLength, n[1] / nLength) # normed normal vector
     else:
-        n_normed = (-n[0] / np.linalg.norm(n), -n[1] / np.linalg.norm(n)) # normed normal vector
+        n_normed = (-n[0] / nLength, -n[1] / nLength) # normed normal vector
     distLineOrigin = start[0] * n_normed[0] + start[1] * n_normed[1]  # offset der Geraden vom Ursprung
     return n_normed, distLineOrigin
 
 
 # this function computes the distance between the point pnt and a line defined by its normed normal vector and its distance from origin
+# pnt can also be a pair of coordinate arrays, the distances of all points are returned as an array then
 def pointLineDist(pnt, n_normed, distLineOrigin):
     dist = abs((pnt[0] * n_normed[0] + pnt[1] * n_normed[1]) - distLineOrigin)
     return dist
 
 
 def create_arc_from_regLine(regLine):
-    # The regression line regLine contains all x coordinates in its first element (a list) and all y coordinates in its second element (also a list).
+    # The regression line regLine contains all x coordinates in its first element and all y coordinates in its second element (two int arrays, see afremize.getRegLineCoordinates()).
     # First, we create the line equation r for the line defined by the start point and the end point of regLine, and its normal vector normal_vec
-    # For each point P in regLine, we compute the line equation for the normal line n (n is the line defined by the normal vector of r which crosses P) and the cross_section of the lines n and r. This cross-section is also the point on line r which is closest to the point P.
-    # The array 'arc' returned by this function contains the Euclidean distance between each point P and its corresponding point cross_section.
+    # For each point P in regLine, we compute the distance between P and its closest point on line r (the cross-section of r and the normal line of r which crosses P).
+    # The array 'arc' returned by this function contains these distances as ints, for all points P at once.
     # While regLine describes the curvature of a segment at its position in the input image, arc describes the curvature as a set of distances of each point in regLine from a straight line connecting the end points of regLine.
-    regLineLen = len(regLine[0])
-    arc = [[] for i in range(0, regLineLen)]
     start = (regLine[0][0], regLine[1][0])
     end = (regLine[0][-1], regLine[1][-1])
 
     n_normed, distLineOrigin = getLineVectors(start, end)
-    for p in range(0, regLineLen):
-        arc[p] = int(pointLineDist((regLine[0][p], regLine[1][p]), n_normed, distLineOrigin))
+    arc = pointLineDist(regLine, n_normed, distLineOrigin).astype(int)
     
     # if regLine's midpoint is to the left of the line connecting its endpoints, we need to flip arc values:
     lineMidpoint_y = (start[1] + end[1]) / 2
@@ -337,103 +581,92 @@ def create_arc_from_regLine(regLine):
     midPointAbove = regLine[1][int(len(regLine[1]) / 2)] < lineMidpoint_y
     
     if (not posSlope) and (not midPointAbove):
-        maxarc = max(arc)
-        for i in range(0, len(arc)):
-            arc[i] = maxarc - arc[i]
+        arc = arc.max() - arc
     
     if posSlope and midPointAbove:
-        maxarc = max(arc)
-        reversed_arc = [[] for i in range(0, regLineLen)]
-        tmp_reversed_arc= [[] for i in range(0, regLineLen)]
-        for i in range(0, len(arc)):
-            reversed_arc[regLineLen - i - 1] = maxarc - arc[i]
-        return reversed_arc
+        return (arc.max() - arc)[::-1]
     return arc
 
 
     
-def findMarkerPixel(markerColor, strokepixTmp, width, height):
-    brushStart = [0,0]
-    R,G,B,A = markerColor
-    dists = []
-    for x in range(0, width):
-        for y in range(0, height):
-            
-            if strokepixTmp[x, y] != (0,0,0,0) and abs(strokepixTmp[x, y][0] - R) < 200 and abs(strokepixTmp[x, y][1] - G) < 200 and abs(strokepixTmp[x, y][2] - B) < 200 and abs(strokepixTmp[x, y][3] - A) < 200:
-            
-                dists.append([abs(strokepixTmp[x, y][0] - R) + abs(strokepixTmp[x, y][1] - G) + abs(strokepixTmp[x, y][2] - B) + abs(strokepixTmp[x, y][3] - A), [x, y]])
+# Returns the coordinates of the brush stroke apex template_midpoint within the rotated and cropped brush stroke image.
+# These have to be subtracted from the X,Y position where the upper left corner of the brushstroke image should be pasted into the resulting image.
+# The apex used to be found by painting a marker pixel into a copy of the stroke, rotating the copy and searching it for the pixel closest to the marker color.
+# Here the same search is done without any marker image: only the pixels around the rotated apex position (from the rotation matrix of Image.rotate(angle, expand=True)) can get color from the marker,
+# so their colors are resampled directly with the marker in place, which gives the same position as the marker search.
+# stroke: upright brush stroke as an RGBA uint8 array of shape (height, width, 4)
+# spriteCorner: position of the upper left corner of the cropped sprite in the rotated image, as returned by rotateStroke() (or the first two values of getbbox())
+def getBrushStart(template_midpoint, stroke, angle, spriteCorner, color):
+    height, width = stroke.shape[:2]
+    x, y = template_midpoint
+    markerColor = [0 if c > 128 else 255 for c in color[:3]] + [255]  # as different from the stroke color as possible
+    cornerX, cornerY = spriteCorner
+    turns = (angle % 360.0) / 90
+    if turns == int(turns):  # multiples of 90 degrees are exact transpositions, the marker pixel is just moved
+        x, y = [(x, y), (y, width - 1 - x), (width - 1 - x, height - 1 - y), (height - 1 - y, x)][int(turns)]
+        return [x - min(cornerX, x), y - min(cornerY, y)]
     
-    if dists != []:
-        brushStartDist = dists[0][0]
-        brushStart = dists[0][1]
-        for i in range(0, len(dists)):
-            if dists[i][0] < brushStartDist:
-                brushStartDist = dists[i][0]
-                brushStart = dists[i][1]
-    else:
-        return False
-    return brushStart
+    (a, b, c, d, e, f), rotatedSize = getRotationMatrix(width, height, angle)
+    det = a * e - b * d
+    rotX = int(floor(( e * (x + 0.5 - c) - b * (y + 0.5 - f)) / det))
+    rotY = int(floor((-d * (x + 0.5 - c) + a * (y + 0.5 - f)) / det))
+    # the candidates sample the stroke at most 3 * sqrt(2) + 2 pixels away from the marker, so only the pixels around it need to be premultiplied:
+    left, top = max(0, x - 8), max(0, y - 8)
+    premultiplied = premultiplyAlpha(stroke[top:y + 9, left:x + 9])
+    premultiplied[y - top, x - left] = markerColor
+    # all candidates in the same scan order as the former marker search (x outer, y inner):
+    candXs, candYs = [v.ravel() for v in np.meshgrid(np.arange(rotX - 3, rotX + 4), np.arange(rotY - 3, rotY + 4), indexing='ij')]
+    pixels = sampleBicubicRGBa(premultiplied, a * (candXs + 0.5) + b * (candYs + 0.5) + c - left, d * (candXs + 0.5) + e * (candYs + 0.5) + f - top)
+    visible = pixels[:, 3] != 0
+    if not visible.any():
+        return [rotX - cornerX, rotY - cornerY]  # fallback if no pixel resembles the marker
+    # the marker can make pixels visible that are transparent in the sprite, these extend the bounding box the former marker search was cropped to:
+    cornerX, cornerY = min(cornerX, int(candXs[visible].min())), min(cornerY, int(candYs[visible].min()))
+    diffs = np.abs(pixels - markerColor)
+    matching = visible & (diffs.max(axis=1) < 200)
+    if not matching.any():
+        return [rotX - cornerX, rotY - cornerY]
+    best = np.argmin(np.where(matching, diffs.sum(axis=1), np.iinfo(np.int64).max))  # the first of equally close pixels wins
+    return [int(candXs[best]) - cornerX, int(candYs[best]) - cornerY]
+
+
+# RGBA -> RGBa (premultiplied alpha) with PIL's rounding, as an int array
+def premultiplyAlpha(stroke):
+    premultiplied = stroke.astype(np.int32)
+    tmp = premultiplied[:, :, :3] * premultiplied[:, :, 3:] + 128
+    premultiplied[:, :, :3] = ((tmp >> 8) + tmp) >> 8
+    return premultiplied
+
+
+def cubic(v1, v2, v3, v4, d):
+    return v2 + d * (-v1 + v3 + d * (2 * (v1 - v2) + v3 - v4 + d * (-v1 + v2 - v3 + v4)))
+
+
+# colors of the pixels at the coordinate arrays (xin, yin) of a premultiplied image, resampled like PIL's bicubic transform, returned as an (n, 4) int array of RGBA values
+def sampleBicubicRGBa(premultiplied, xin, yin):
+    height, width = premultiplied.shape[:2]
+    inside = (xin >= 0) & (xin < width) & (yin >= 0) & (yin < height)
+    x, y = np.floor(xin - 0.5).astype(int), np.floor(yin - 0.5).astype(int)
+    dx, dy = (xin - 0.5 - x)[:, None], (yin - 0.5 - y)[:, None]
+    xs = np.clip(x[:, None] + np.arange(-1, 3), 0, width - 1)
+    ys = np.clip(y[:, None] + np.arange(-1, 3), 0, height - 1)
+    window = premultiplied[ys[:, :, None], xs[:, None, :]].astype(np.float64)  # shape (n, 4, 4, 4)
+    rows = cubic(window[:, :, 0], window[:, :, 1], window[:, :, 2], window[:, :, 3], dx[:, :, None])
+    values = cubic(rows[:, 0], rows[:, 1], rows[:, 2], rows[:, 3], dy)
+    pixels = np.where(values < 0, 0, np.where(values >= 255, 255, np.trunc(values))).astype(int)
+    pixels[~inside] = 0
+    alpha = pixels[:, 3:]
+    translucent = (alpha > 0) & (alpha < 255)
+    pixels[:, :3] = np.where(translucent, np.minimum(255, (255 * pixels[:, :3]) // np.maximum(alpha, 1)), pixels[:, :3])
+    return pixels
 
 
 
-def getBrushStart(template_midpoint, strokeim, angle, color):
-    # mark the starting point of the brush stroke in the brush stroke image:
-    strokeimTmp = strokeim.copy()
-    strokepixTmp = strokeimTmp.load()
-    
-    R = 0 if color[0] > 128 else 255
-    G = 0 if color[1] > 128 else 255
-    B = 0 if color[2] > 128 else 255
-    markerColor = (R, G, B, 255)  # let markerColor be as different from segment color as possible so that we can find it again after the rotation
-    strokepixTmp[template_midpoint[0], template_midpoint[1]] = markerColor # we mark the pixel that needs to coincide with regLine start to find it again after rotation
-    width, height = strokeimTmp.size
-    imgMidpoint = [width // 2, height // 2]
-    distMarkerMidpoint = euclidDist(template_midpoint, [imgMidpoint[0], imgMidpoint[1]])  # distance between marker pixel and brushstroke image midpoint
-    
-    # rotate brush stroke image
-    strokeimTmp = strokeimTmp.rotate(360 - angle, resample=Image.BICUBIC, expand=True)            
-    strokeimTmp_bbox = strokeimTmp.getbbox() # because after rotating, there will be big empty areas around the segment
-    strokeimTmp = strokeimTmp.crop(strokeimTmp_bbox)
-    strokepixTmp = strokeimTmp.load() # reload the pixelAccess object after rotating the image
-    widthRot, heightRot = strokeimTmp.size
-    
-    # find the starting point of the brush stroke in the rotated image:
-    brushStart = findMarkerPixel(markerColor, strokepixTmp, widthRot, heightRot)
-    
-    # if brushstart pixel was not found, compute it trigonometrically (less precise):
-    # imgMidpoint = center point of the brushstroke image rotation
-    # template_midpoint = brushStart coordinates before rotation
-    # [x_tmp, y_tmp] = brushStart coordinates after rotation
-    # Pbetw_midpoint_and_marker = point halfway between imgMidpoint and template_midpoint
-    # markerMovement = distance between template_midpoint and [x_tmp, y_tmp]
-    if not brushStart:
-        # law of cosines (Kosinussatz): c^2 = a^2 + b^2 - 2ab*cos(gamma)
-        markerMovement = sqrt(2*(distMarkerMidpoint**2) + 2 * distMarkerMidpoint * distMarkerMidpoint * cos(radians(abs(angle))))
-        if markerMovement > 0:
-            Pbetw_midpoint_and_marker = [min(imgMidpoint[0], template_midpoint[0]) + (abs(imgMidpoint[0] - template_midpoint[0]) // 2), min(imgMidpoint[1], template_midpoint[1]) + (abs(imgMidpoint[1] - template_midpoint[1]) // 2)]
-            
-            h = sqrt(distMarkerMidpoint**2 - euclidDist(imgMidpoint, Pbetw_midpoint_and_marker)**2)
-            
-            if angle <= 0:
-                x_tmp = int(Pbetw_midpoint_and_marker[0] + ((h * ( template_midpoint[1] - imgMidpoint[1] )) / distMarkerMidpoint))
-                y_tmp = int(Pbetw_midpoint_and_marker[1] - ((h * ( template_midpoint[0] - imgMidpoint[0] )) / distMarkerMidpoint))
-            else:
-                x_tmp = int(Pbetw_midpoint_and_marker[0] - ((h * ( template_midpoint[1] - imgMidpoint[1] )) / distMarkerMidpoint))
-                y_tmp = int(Pbetw_midpoint_and_marker[1] + ((h * ( template_midpoint[0] - imgMidpoint[0] )) / distMarkerMidpoint))
-            return [x_tmp, y_tmp]
-        if markerMovement == 0:
-            return template_midpoint # probably angle was close to 0
-    else:
-        return brushStart
-    
-    return [0,0]
-
-
 # make arc look a bit less computer-generated and a bit more hand-drawn
-def randomizeArc(arc):
+def randomizeArc(arc, rng=random):
     offset = 0
     hysterese = 0
-    hystereseMax = randint(0, int(len(arc) * 0.01))
+    hystereseMax = rng.randint(0, int(len(arc) * 0.01))
     hystereseMax_before_plateau = hystereseMax
     hystereseMaxRoof = int(len(arc) * 0.01)
     modus = 2  # 0: offset increase, 1: offset descrease, 2: plateau
@@ -445,24 +678,24 @@ def randomizeArc(arc):
                 modus = 2
                 hystereseMax_before_plateau = hystereseMax
                 randIncr = int(len(arc) * 0.01)
-                if random.choice([True, False]):
-                    hystereseMax = min(hystereseMaxRoof, randint(hystereseMax_before_plateau, hystereseMax_before_plateau + randIncr))
+                if rng.choice([True, False]):
+                    hystereseMax = min(hystereseMaxRoof, rng.randint(hystereseMax_before_plateau, hystereseMax_before_plateau + randIncr))
                 else:
-                    hystereseMax = min(hystereseMaxRoof, max(0, randint(hystereseMax_before_plateau - randIncr, hystereseMax_before_plateau)))
+                    hystereseMax = min(hystereseMaxRoof, max(0, rng.randint(hystereseMax_before_plateau - randIncr, hystereseMax_before_plateau)))
             else: # we are coming down from a plateau
                 if modus_before_plateau == 0:
                     modus = 1
                 else:
                     modus = 0
                 randIncr = int(len(arc) * 0.01)
-                if random.choice([True, False]):
-                    hystereseMax = min(hystereseMaxRoof, randint(hystereseMax_before_plateau, hystereseMax_before_plateau + randIncr))
+                if rng.choice([True, False]):
+                    hystereseMax = min(hystereseMaxRoof, rng.randint(hystereseMax_before_plateau, hystereseMax_before_plateau + randIncr))
                 else:
-                    hystereseMax = min(hystereseMaxRoof,max(0, randint(hystereseMax_before_plateau - randIncr, hystereseMax_before_plateau)))
+                    hystereseMax = min(hystereseMaxRoof,max(0, rng.randint(hystereseMax_before_plateau - randIncr, hystereseMax_before_plateau)))
             hysterese = 0
-        if modus == 0 and randint(0,5) == 0:
+        if modus == 0 and rng.randint(0,5) == 0:
             offset += 1
-        elif modus == 1 and randint(0,5) == 0:
+        elif modus == 1 and rng.randint(0,5) == 0:
             offset -= 1
         arc[i] = max(0, arc[i] + offset)
         hysterese += 1
@@ -470,29 +703,111 @@ def randomizeArc(arc):
 
 
 
+# precomputed plateau/ramp runs of randomizeArcArray(), by hystereseMaxRoof (see getArcRuns())
+arcRuns = {}
+
+
+# Returns a long run of the plateau/ramp pattern randomizeArc() walks through for arcs with hystereseMaxRoof = int(len(arc) * 0.01):
+# the direction of every row as an int8 array (1: offset increase, -1: offset decrease, 0: plateau) and the sorted start indices of all plateaus that are followed by a decreasing ramp.
+# The phase lengths do the same random walk between 1 and hystereseMaxRoof as in randomizeArc(). The run is generated once per hystereseMaxRoof from its own random.Random seeded by hystereseMaxRoof,
+# so it is the same in every process and does not depend on the order in which strokes ask for it.
+def getArcRuns(hystereseMaxRoof):
+    if hystereseMaxRoof not in arcRuns:
+        rng = random.Random(hystereseMaxRoof)
+        runLength = max(16384, 400 * (hystereseMaxRoof + 1))  # at least 4 times the length of the longest arc with this hystereseMaxRoof
+        
+        def nextHystereseMax(hystereseMax):
+            if rng.choice([True, False]):
+                return min(hystereseMaxRoof, rng.randint(hystereseMax, hystereseMax + hystereseMaxRoof))
+            return min(hystereseMaxRoof, max(0, rng.randint(hystereseMax - hystereseMaxRoof, hystereseMax)))
+        
+        lengths = []
+        directions = []
+        hystereseMax = rng.randint(0, hystereseMaxRoof)
+        direction = -1  # like randomizeArc(), start with a decreasing ramp after the first plateau
+        covered = 0
+        while covered < runLength:
+            plateau = nextHystereseMax(hystereseMax)
+            hystereseMax = nextHystereseMax(hystereseMax)  # the ramp after the plateau
+            lengths += [max(1, plateau), max(1, hystereseMax)]
+            directions += [0, direction]
+            covered += lengths[-2] + lengths[-1]
+            direction = -direction
+        starts = np.cumsum([0] + lengths[:-1])
+        arcRuns[hystereseMaxRoof] = (np.repeat(np.array(directions, dtype=np.int8), lengths), starts[0::4])
+    return arcRuns[hystereseMaxRoof]
+
+
+# Array version of randomizeArc() for an ndarray arc: the arc follows a stretch of the precomputed plateau/ramp run for its length (see getArcRuns()), starting at a randomly chosen plateau,
+# and within a ramp every row moves the arc by one more pixel with a chance of 1/6.
+# This gives the plateaus and ramps the same statistics as randomizeArc(), but needs just one random start and one random bit string per arc instead of several random numbers per row.
+def randomizeArcArray(arc, rng=random):
+    sizeY = len(arc)
+    directions, plateauStarts = getArcRuns(int(sizeY * 0.01))
+    usable = np.searchsorted(plateauStarts, len(directions) - sizeY, side='right')  # plateaus that leave enough rows behind them
+    start = plateauStarts[rng.randrange(usable)]
+    # one 16 bit random number per row, the arc moves if it is below 2**16 / 6:
+    randomBits = np.frombuffer(rng.getrandbits(16 * sizeY).to_bytes(2 * sizeY, 'little'), dtype=np.uint16)
+    steps = directions[start:start + sizeY] * (randomBits < 10923)
+    return np.maximum(0, arc + np.cumsum(steps))
+
+
+# Array version of the x/y loop in simple_brushstroke(): returns the upright, single-colored brush stroke as an (sizeY, sizeX + max(arc) + 1, 4) uint8 array
+def rasterizeSimpleStroke(sizeX, sizeY, arc, upperTemplate, lowerTemplate, color):
+    strokeWidth = sizeX + int(arc.max()) + 1
+    stroke = np.zeros((sizeY, strokeWidth), dtype=np.uint32)  # one RGBA pixel per uint32, all pixels get the same color
+    ys = np.arange(sizeY)[:, None]
+    # pixels below the area upperTemplate tells us not to paint and above the area lowerTemplate tells us not to paint:
+    painted = (ys >= upperTemplate[:sizeX]) & (ys <= sizeY - lowerTemplate[:sizeX])
+    rows, cols = np.nonzero(painted)
+    stroke[rows, cols + arc[rows]] = np.array([color[0], color[1], color[2], 255], dtype=np.uint8).view(np.uint32)[0]
+    return stroke.view(np.uint8).reshape(sizeY, strokeWidth, 4)
+
+
+# outCanvas: the canvas.Canvas the brush stroke is painted on
 # startColors is a numpy array of shape (x,4) containing x many RGBA values to use from the top of the brush stroke
 #  X, Y are the coordinates of the pixel where the center of the simple brushstroke is about to be placed
 # capSize is the distance between the brush stroke cap apex and closest point in the brushstroke which has maximal width (the caps being the rounded ends of a brush stroke)
 # unlike in complex_brushstroke(), sizeX has the same value as sizeXedge would
-def simple_brushstroke(outIm, X, Y, sizeX, sizeY, angle, color, regLine):
+# vectorized: if False, the arc is randomized by randomizeArc() and the stroke is filled pixel by pixel (slow reference implementation) instead of by randomizeArcArray() and rasterizeSimpleStroke()
+# directRaster, resample, rng, profile: see complex_brushstroke()
+def simple_brushstroke(outCanvas, X, Y, sizeX, sizeY, angle, color, regLine, vectorized=True, directRaster=True, resample="bicubic", rng=random, profile=None):
     if sizeX > 1 and sizeY > 1:  # because computing a curved brush strokes for these small sizes fails (no curvature for width 1) and painting a line of with 1 looks ugly
-        capSize = randint(int(sizeX * 0.3), int(sizeX * 0.5))
+        capSize = rng.randint(int(sizeX * 0.3), int(sizeX * 0.5))
         bulgeSize = int(sizeX * 0.75)
         
         arc = create_arc_from_regLine(regLine)
-        arc = randomizeArc(arc)
+        if vectorized:
+            arc = randomizeArcArray(arc, rng)
+        else:
+            arc = np.array(randomizeArc(arc.tolist(), rng))
         sizeY = len(arc)
         if sizeY <= 1:
             return
         
-        strokeim, strokepix = imgIO.createTransparentImg(sizeX + max(arc) + 1, sizeY)
         upperTemplate, lowerTemplate = build_simple_CutoffTemplates(sizeX, capSize)
+        if vectorized:
+            stroke = rasterizeSimpleStroke(sizeX, sizeY, arc, upperTemplate, lowerTemplate, color)
+        else:
+            strokeim, strokepix = imgIO.createTransparentImg(sizeX + int(arc.max()) + 1, sizeY)
+            for x in range(0, sizeX):
+                for y in range(0, sizeY):
+                    # if we are below the area our upperTemplate tells us not to paint and above the area lowerTemplate tells us not to paint:
+                    if y >= upperTemplate[x] and y <= (sizeY - lowerTemplate[x]):
+                        strokepix[int(x + arc[y]), y] = (color[0], color[1], color[2], 255)
+            stroke = np.asarray(strokeim)
         
-        for x in range(0, sizeX):
-            for y in range(0, sizeY):
-                # if we are below the area our upperTemplate tells us not to paint and above the area lowerTemplate tells us not to paint:
-                if y >= upperTemplate[x] and y <= (sizeY - lowerTemplate[x]):
-                    strokepix[x + arc[y], y] = (color[0], color[1], color[2], 255)
+        # angle sais by how many degrees we need to rotate a segment to make it upright, so we need 360-angle here to revert it again
+        with profiling.hotPath(profile, "rotate"):
+            if directRaster:
+                sprite, spriteCorner = rotateStroke(stroke, 360 - angle, resample)
+            else:
+                strokeim = Image.fromarray(stroke).rotate(360 - angle, resample=PIL_FILTERS[resample], expand=True)
+                strokeim_bbox = strokeim.getbbox() # because after rotating, there will be big empty areas around the segment
+                sprite = np.asarray(strokeim.crop(strokeim_bbox))
+                spriteCorner = strokeim_bbox[:2]
+        if directRaster and sprite.size == 0:
+            return
         
         if angle < 0:
             template_midpoint = ((sizeX//2) + arc[0], upperTemplate[sizeX//2])  # len(upperTemplate) = sizeX
@@ -502,13 +817,26 @@ def simple_brushstroke(outIm, X, Y, sizeX, sizeY, angle, color, regLine):
             template_midpoint = ((sizeX//2) + arc[0], upperTemplate[sizeX//2])
             brushStart = template_midpoint
         if angle != 0:
-            brushStart = getBrushStart(template_midpoint, strokeim, angle, color)  # get the coordinates of the brush stroke apex within the brushstroke image. These have to be subtracted from the X,Y position where the upper left corner of the brushstroke image should be pasted into the resulting image outIm
-        
-        # angle sais by how many degrees we need to rotate a segment to make it upright, so we need 360-angle here to revert it again
-        strokeim = strokeim.rotate(360 - angle, resample=Image.BICUBIC, expand=True)
-        strokeim_bbox = strokeim.getbbox() # because after rotating, there will be big empty areas around the segment
-        strokeim = strokeim.crop(strokeim_bbox)
-        strokepix = strokeim.load() # reload the pixelAccess object after rotating the image
+            brushStart = getBrushStart(template_midpoint, stroke, 360 - angle, spriteCorner, color)  # get the coordinates of the brush stroke apex within the rotated brushstroke image
         
         # now we paste the generated brush stroke so that the start of the regression line has the same coordinates as the start of the brush stroke (e.g. the midpoint of its left cap)
-        outIm.paste(strokeim, (X - brushStart[0], Y - brushStart[1]), strokeim)
+        with profiling.hotPath(profile, "paste"):
+            pasted = outCanvas.paste(sprite, (X - brushStart[0], Y - brushStart[1]))
+        if profile != None:
+            profile.count("pixelsPasted", pasted)
+
+
+
+# paints a brush stroke planned by afremize.planStrokes() on outCanvas
+# stroke: a tuple (strokeType, X, Y, params, strokeSeed), see afremize.planStrokes(). The stroke draws its random numbers from random.Random(strokeSeed), or from the random module if strokeSeed is None.
+# the other arguments are passed on to complex_brushstroke() and simple_brushstroke()
+def paintStroke(outCanvas, stroke, colorify=0, noMargins=False, vectorized=True, templateCache=None, directRaster=True, resample="bicubic", profile=None):
+    strokeType, X, Y, params, strokeSeed = stroke
+    rng = random if strokeSeed == None else random.Random(strokeSeed)
+    if strokeType == "simple":
+        sizeX, sizeY, angle, color, regLine = params
+        simple_brushstroke(outCanvas, X, Y, sizeX, sizeY, angle, color, regLine, vectorized=vectorized, directRaster=directRaster, resample=resample, rng=rng, profile=profile)
+    else:
+        sizeX, sizeY, startColors, endColors, angleStart, angleStop, groundSegment = params
+        # copies, because colorify changes the colors in place and a stroke may be painted more than once (on overlapping tiles)
+        complex_brushstroke(outCanvas, X, Y, sizeX, sizeY, startColors.copy(), endColors.copy(), angleStart, angleStop, arcType="log", groundSegment=groundSegment, colorify=colorify, noMargins=noMargins, vectorized=vectorized, templateCache=templateCache, directRaster=directRaster, resample=resample, rng=rng, profile=profile)
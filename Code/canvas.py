@@ -0,0 +1,68 @@
+# Copyright (C) 2015 Jana Cavojska
+# This file is part of 'Afremize'.
+
+# 'Afremize' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+
+# 'Afremize' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with 'Afremize'.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division
+import numpy as np
+from PIL import Image
+
+
+# Compositing canvas for the output image, backed by a numpy array of shape (height, width, bands).
+# Brush strokes are blended into it with the same arithmetic as Image.paste(sprite, position, sprite), so the result is pixel-identical to pasting into the PIL image,
+# but no PIL image is needed per brush stroke and the painted image is converted back to PIL only once, before saving.
+# image: the PIL image to paint on (mode RGB or RGBA), e.g. the colored background
+# origin: position of the image's upper left corner in the coordinates the brush strokes are pasted with, for canvases that are a tile of the output image
+class Canvas(object):
+
+    def __init__(self, image, origin=(0, 0)):
+        self.mode = image.mode
+        self.pixels = np.array(image)
+        self.height, self.width = self.pixels.shape[:2]
+        self.bands = self.pixels.shape[2]
+        self.origin = origin
+
+    # blends the RGBA uint8 array sprite into the canvas with its upper left corner at position (x, y), using the sprite's alpha channel as mask (like Image.paste() with a mask).
+    # The parts of the sprite outside of the canvas are clipped. Returns the number of pixels blended.
+    def paste(self, sprite, position):
+        x, y = position[0] - self.origin[0], position[1] - self.origin[1]
+        spriteHeight, spriteWidth = sprite.shape[:2]
+        left, top = max(0, x), max(0, y)
+        right, bottom = min(self.width, x + spriteWidth), min(self.height, y + spriteHeight)
+        if left >= right or top >= bottom:
+            return 0
+        src = sprite[top - y:bottom - y, left - x:right - x]
+        dst = self.pixels[top:bottom, left:right]
+        mask = src[:, :, 3:].astype(np.uint16)
+        # DIV255(dst * (255 - mask) + src * mask) as in PIL's paste with a mask, fits into 16 bits:
+        tmp = dst * (255 - mask) + src[:, :, :self.bands] * mask + 128
+        dst[...] = ((tmp >> 8) + tmp) >> 8
+        return (right - left) * (bottom - top)
+
+    # sets the pixels at the coordinate arrays xs, ys (relative to the canvas, not to origin) to one RGB(A) color per pixel in the array colors (shape (len(xs), 3) or (len(xs), 4)),
+    # the alpha value defaults to 255 like with PIL's pixel access objects
+    def fillColors(self, xs, ys, colors):
+        if self.bands == 4 and colors.shape[1] == 3:
+            colors = np.concatenate((colors, np.full((len(colors), 1), 255, dtype=colors.dtype)), axis=1)
+        self.pixels[ys, xs] = colors[:, :self.bands]
+
+    # sets every pixel to the color of its segment in palette, in one lookup palette[labels]
+    # labels: the label array of the canvas's pixels, palette: the RGB(A) colors of the segments indexed by segmentID (the alpha value defaults to 255 like in fillColors())
+    # The lookup runs over the whole label array, a few small segments (like the hairlines) are filled faster with segments.SegmentIndex.pixelsOf() and fillColors().
+    def fillSegments(self, labels, palette):
+        if self.bands == 4 and palette.shape[1] == 3:
+            palette = np.concatenate((palette, np.full((len(palette), 1), 255, dtype=palette.dtype)), axis=1)
+        self.pixels[...] = palette[labels, :self.bands]
+
+    def toImage(self):
+        return Image.fromarray(self.pixels, self.mode)
@@ -13,7 +13,12 @@
 # You should have received a copy of the GNU General Public License
 # along with 'Afremize'.  If not, see <http://www.gnu.org/licenses/>.
 
+from __future__ import division
 from PIL import Image, ImageDraw
+import numpy as np
+import struct
+import zlib
+from math import sqrt
 
 # converts the pixel access object pic into a numpy array
 def pixelAccessToNumpy(pixelAccess):
@@ -48,6 +53,17 @@ def savePixelAccessImg(outfile, im):
     im.save(outfile)
 
 
+# Pixel access object for an image array of shape (height, width, 3): pix[x, y] is the RGB tuple at (x, y), like with the pixel access objects of PIL images.
+class ArrayPixelAccess(object):
+
+    def __init__(self, pixelsNP):
+        self.pixelsNP = pixelsNP
+
+    def __getitem__(self, position):
+        x, y = position
+        return tuple(int(value) for value in self.pixelsNP[y, x])
+
+
 # creates and returns a white image and it pixel access object
 # each color value of the pixel access object will be (255, 255, 255, 255)
 def createWhiteImg(width, height):
@@ -62,3 +78,69 @@ def createTransparentImg(width, height):
     im = Image.new("RGBA", (width, height))
     pix = im.load()
     return [im, pix]
+
+
+# writes a PNG file from bands of rows, without holding the whole image in memory (PIL's save() needs the complete image)
+# bands: an iterable of uint8 arrays of shape (rows, width, 3) or (rows, width, 4), mode RGB or RGBA, from the top of the image to its bottom
+# All rows are written with the Paeth filter, which only depends on the unfiltered pixels and can thus be computed for a whole band at once.
+def savePNGBands(outfile, width, height, mode, bands):
+    colorType = {"RGB": 2, "RGBA": 6}[mode]
+    
+    def writeChunk(f, chunkType, data):
+        f.write(struct.pack(">I", len(data)) + chunkType + data + struct.pack(">I", zlib.crc32(chunkType + data) & 0xffffffff))
+    
+    with open(outfile, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        writeChunk(f, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, colorType, 0, 0, 0))
+        compressor = zlib.compressobj(6)
+        previousRow = None
+        for band in bands:
+            rows = band.reshape(band.shape[0], -1).astype(np.int16)
+            bytesPerPixel = band.shape[2]
+            up = np.empty_like(rows)
+            up[0] = 0 if previousRow is None else previousRow
+            up[1:] = rows[:-1]
+            left = np.zeros_like(rows)
+            left[:, bytesPerPixel:] = rows[:, :-bytesPerPixel]
+            upLeft = np.zeros_like(rows)
+            upLeft[:, bytesPerPixel:] = up[:, :-bytesPerPixel]
+            estimate = left + up - upLeft
+            distLeft, distUp, distUpLeft = np.abs(estimate - left), np.abs(estimate - up), np.abs(estimate - upLeft)
+            predictor = np.where((distLeft <= distUp) & (distLeft <= distUpLeft), left, np.where(distUp <= distUpLeft, up, upLeft))
+            filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+            filtered[:, 0] = 4  # filter type Paeth
+            filtered[:, 1:] = (rows - predictor) & 0xff
+            previousRow = rows[-1]
+            data = compressor.compress(filtered.tobytes())
+            if len(data) > 0:
+                writeChunk(f, b"IDAT", data)
+        writeChunk(f, b"IDAT", compressor.flush())
+        writeChunk(f, b"IEND", b"")
+
+
+# returns a synthetic picture of about megapixels million pixels (aspect ratio 16:9), generated from seed to have large and small segments like a photograph:
+# smooth color gradients (random colors, upscaled bicubically), random ellipses, rectangles and lines on top of them, and some noise.
+# The shapes are placed relative to the size of the picture, so the pictures of different sizes show the same scene.
+def syntheticImage(megapixels, seed=0):
+    rng = np.random.RandomState(seed)
+    height = int(round(sqrt(megapixels * 1e6 * 9 / 16)))
+    width = int(round(height * 16 / 9))
+    im = Image.fromarray(rng.randint(0, 256, (9, 16, 3)).astype(np.uint8)).resize((width, height), Image.BICUBIC)
+    draw = ImageDraw.Draw(im)
+    for shape in range(0, 400):
+        x, y = rng.rand(2) * (width, height)
+        sizeX, sizeY = rng.pareto(2, 2) * 0.02 * np.array((width, height)) + 2
+        color = tuple(int(c) for c in rng.randint(0, 256, 3))
+        kind = rng.randint(0, 3)
+        if kind == 0:
+            draw.ellipse((x, y, x + sizeX, y + sizeY), fill=color)
+        elif kind == 1:
+            draw.rectangle((x, y, x + sizeX, y + sizeY), fill=color)
+        else:
+            draw.line((x, y, x + sizeX * rng.choice((-1, 1)), y + sizeY), fill=color, width=max(1, int(sizeX * 0.05)))
+    pixels = np.array(im)
+    bandRows = max(1, 2**22 // width)
+    for top in range(0, height, bandRows):  # noise of +-8, a band of rows at a time to save memory
+        band = pixels[top:top + bandRows]
+        band[...] = np.clip(band.astype(np.int16) + rng.randint(-8, 9, band.shape).astype(np.int16), 0, 255)
+    return Image.fromarray(pixels)
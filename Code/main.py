@@ -14,14 +14,95 @@
 # along with 'Afremize'.  If not, see <http://www.gnu.org/licenses/>.
 
 
-# This implementation was tested with Python 2.7.9 :: Anaconda 2.2.0 (64-bit)
-# and partly with Python 2.7.10 :: Anaconda 2.3.0 (64-bit)
+# This implementation needs Python 3.8 or newer and numpy 1.17 or newer (see requirements.txt),
+# it was tested with Python 3.11, numpy 2.4, scipy 1.17, scikit-image 0.26 and Pillow 12.
 
 import os
 from optparse import OptionParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import time
+import zlib
 
 # own imports:
 import afremize
+import segCache
+
+
+# returns the name of the profile (see --profile) of the image infile of a batch: the image's name is inserted into the file name profile, which may be None (no profile)
+def getProfileName(profile, infile):
+    if profile == None:
+        return None
+    base, extension = os.path.splitext(profile)
+    return base + "_" + os.path.splitext(os.path.basename(infile))[0] + (extension or ".json")
+
+
+# converts one image of the input_images directory in a worker process of the batch mode (--jobs)
+# task: (infile, seed, convertOptions), convertOptions being the keyword arguments for afremize.convertImage()
+# returns (infile, seconds, error), error is None if the output image was saved
+def convertBatchFile(task):
+    infile, seed, convertOptions = task
+    convertOptions = dict(convertOptions, profile=getProfileName(convertOptions.get("profile"), infile))
+    start = time.time()
+    try:
+        afremize.convertImage(infile, inIm=None, seed=seed, **convertOptions)
+    except Exception as e:  # e.g. a broken image file, which must not stop the batch
+        return infile, time.time() - start, type(e).__name__ + ": " + str(e)
+    return infile, time.time() - start, None
+
+
+# converts the tasks of convertBatchFile() with a pool of jobs processes and yields the result (infile, seconds, error) of every task as soon as it is done.
+# A worker process that dies (killed for lack of memory, or crashing in native code) breaks the pool, and with it the tasks it had not finished yet. These are converted again
+# with a new pool. If none of the tasks of a pool could be finished, the remaining ones are converted one at a time, each in a process of its own, so that only the images killing their process fail.
+def convertPooled(tasks, jobs):
+    isolated = False
+    while tasks:
+        broken = []
+        for group in ([[task] for task in tasks] if isolated else [tasks]):
+            executor = ProcessPoolExecutor(1 if isolated else jobs)
+            try:
+                futures = dict((executor.submit(convertBatchFile, task), task) for task in group)
+                for future in as_completed(futures):
+                    try:
+                        yield future.result()
+                    except BrokenProcessPool:
+                        if isolated:
+                            yield futures[future][0], 0.0, "the worker process died (e.g. killed for lack of memory)"
+                        else:
+                            broken.append(futures[future])
+            finally:
+                executor.shutdown()
+        isolated = len(broken) == len(tasks)
+        tasks = broken
+
+
+# converts the images infiles from the input directory with a pool of jobs processes (see convertPooled()) and moves each of them to input_done as soon as its output image was saved.
+# Every image gets its own random seed derived from its file name (and from seed, if given), so its result does not depend on the worker converting it or on the order of the images.
+# Images which could not be converted stay in the input directory. Prints a summary at the end.
+def convertBatch(infiles, jobs, path, input_dir, input_done, convertOptions, seed=None):
+    start = time.time()
+    tasks = []
+    for infile in infiles:
+        imageSeed = zlib.crc32(infile.encode('utf-8')) & 0xffffffff
+        if seed != None:
+            imageSeed += seed << 32
+        tasks.append((infile, imageSeed, convertOptions))
+    failures = []
+    for infile, seconds, error in convertPooled(tasks, jobs):
+        if error == None:
+            os.rename(path + input_dir + infile, path + input_done + infile)
+            print("converted file: "+str(infile)+" ("+str(round(seconds, 1))+" s)")
+        else:
+            failures.append((infile, error))
+            print("FAILED to convert file: "+str(infile)+" ("+error+")")
+    
+    seconds = time.time() - start
+    converted = len(infiles) - len(failures)
+    print("\nconverted "+str(converted)+" of "+str(len(infiles))+" images in "+str(round(seconds, 1))+" s with "+str(jobs)+" processes ("+str(round(converted * 60 / max(seconds, 0.001), 1))+" images per minute)")
+    if failures:
+        print(str(len(failures))+" images failed and were left in '"+path + input_dir+"':")
+        for infile, error in failures:
+            print("  "+str(infile)+": "+error)
 
 
 if __name__ == "__main__":
@@ -57,7 +138,7 @@ if __name__ == "__main__":
                       help="If set, the width:height ratio of multicolored brush strokes will be (STROKEWIDTH*0.7) : (STROKEWIDTH*1.3) (long strokes). The height may be smaller if the segment's bounding box is more quadratic than longitudinal. If not set, the ratio will be STROKEWIDTH:STROKEWIDTH (quadratic strokes). Setting this option doubles the runtime. [default: %default]")
     parser.add_option("-d", "--directed",
                       action="store_true", dest="directedRotate", default=False,
-                      help="If set, the orientation of the multicolored brush strokes will depend on their segments' orientation. If not set, multicolored strokes will have a random orientation. [default: %default]")
+                      help="If set, the multicolored brush strokes will be oriented along the edges and textures of the image at their position (the direction of its smoothed gradients, on the scale of the brush strokes). If not set, multicolored strokes will have a random orientation. [default: %default]")
     
     parser.add_option("-W", "--width",
                       dest="strokeWidth",
@@ -73,7 +154,7 @@ if __name__ == "__main__":
                       help="This value corresponds to the maximum number of pixels a segment must have to be classified as a small segment (for simple, single-colored brush strokes), and also to the minimum value (when increased by 1) a segment must have to be classified as a large segment (for multicolored, multi-colored brush strokes). Decrease segBound if you want to see more multicolored brush strokes and less details. [default: (image_width * image_height) / 5000]")
     parser.add_option("-C", "--smallSeg", "--colDiff",
                       dest="colDiff", default=500,
-                      help="Minimum amount of color difference a small segment must have from its surrounding regions in order for the small segment to be painted at all, with a simple brush stroke. If the color difference of a segment is lower than the smallSeg value, the small segment will not be painted at all. Increase this value is there are too many simple brushstrokes (thin, curved lines) cluttering the image. Decrease if there are not enough details visible. A value of 3060 will make all simple brush strokes (and as a consequence, all small segments except for the hairlines) disappear from the resulting image. Values in range: 0..3060. [default: %default]")
+                      help="Minimum amount of color difference a small segment must have from its surrounding regions in order for the small segment to be painted at all, with a simple brush stroke. The color difference is 4 times the difference (summed over the RGB channels) between the mean color of the segment and the mean colors of its adjacent segments, averaged along its border. If the color difference of a segment is lower than the smallSeg value, the small segment will not be painted at all. Increase this value is there are too many simple brushstrokes (thin, curved lines) cluttering the image. Decrease if there are not enough details visible. A value of 3060 will make all simple brush strokes (and as a consequence, all small segments except for the hairlines) disappear from the resulting image. Values in range: 0..3060. [default: %default]")
     parser.add_option("--highlight",
                       action="store_true", dest="highlight", default=False,
                       help="If set, every 5th stroke in regions that would otherwise look very homogenous will get a slightly brighter color. If not set, no additional color manipulation will be performed on the colors sampled for the multicolored brush strokes. [default: %default]")
@@ -83,6 +164,36 @@ if __name__ == "__main__":
     parser.add_option("--otherfiles",
                       action="store_true", dest="otherfiles", default=False,
                       help="If set, the program will create additional files that help the user understand the intermediate stages of creating the resulting image. The file 'FILE_clustered.png' visualizes the detected Felzenszwalb clusters using their actual colors. The file 'FILE_clustered_randomColor.png' visualizes the detected Felzenszwalb clusters using random colors. The file 'FILE_regLines.png' shows the quadratic regression lines for each Felzenszwalb segment. The file 'FILE_saturated.png' shows the level of saturation used for the output image. [default: %default]")
+    parser.add_option("--perPixel",
+                      action="store_true", dest="perPixel", default=False,
+                      help="If set, brush strokes will be filled pixel by pixel using the original (much slower) reference implementation instead of the vectorized one. Both produce the same multicolored brush strokes, the single-colored ones are randomized alike but not identically. [default: %default]")
+    parser.add_option("-j", "--jobs",
+                      dest="jobs", default=1,
+                      help="Number of images of the 'input_images' directory converted in parallel, if no input file is given. With more than 1 job, every image gets its own random seed, images which cannot be converted are skipped and left in 'input_images', and a summary is printed at the end. [default: %default]")
+    parser.add_option("--seed",
+                      dest="seed",
+                      help="Seed for the random numbers, a non-negative integer. The same seed gives the same output image, no matter how many processes paint it (see --renderJobs). In the batch mode (--jobs), every image gets its own seed derived from this one and its file name. [default: random]")
+    parser.add_option("--renderJobs",
+                      dest="renderJobs", default=1,
+                      help="Number of processes painting the brush strokes of an image. If greater than 1, the image is split into tiles which are painted in parallel. The brush strokes then get their own random seeds, so the result differs from the one of a single process, but not between different numbers of processes. [default: %default]")
+    parser.add_option("--segCache",
+                      dest="segCache",
+                      help="Directory of a persistent cache of segmentations. Converting the same picture again with the same saturation and Felzenszwalb parameters (e.g. to try other brush stroke options) then skips the segmentation. [default: no cache]")
+    parser.add_option("--segCacheSize",
+                      dest="segCacheSize", default=2048,
+                      help="Maximum size of the segmentation cache in MB. The least recently used segmentations are deleted when it grows larger. [default: %default]")
+    parser.add_option("--memoryBudget",
+                      dest="memoryBudget",
+                      help="Convert out of core, for pictures too large to be converted in memory: the picture is segmented and painted in tiles, with the large arrays kept in files, so that the memory used stays at about this many MB on top of the memory of the program itself, whatever the size of the picture. Compressed pictures (like JPEG or PNG files) are decoded as a whole and rejected if they do not fit into the budget, uncompressed PPM or TIFF files are read band by band. In the batch mode (--jobs), this is the budget of each job. [default: in memory]")
+    parser.add_option("--workDir",
+                      dest="workDir",
+                      help="Directory for the temporary files of the out-of-core conversion (see --memoryBudget), which need about 15 bytes per pixel. [default: the system's temporary directory]")
+    parser.add_option("--profile",
+                      dest="profile",
+                      help="Write a profile of the conversion to this JSON file: the wall and CPU time and peak memory of every stage, the numbers of segments of each class, of brush strokes and of pixels written, and the time spent rotating and pasting brush strokes and setting up their color splines. In the batch mode, the name of each image is appended to the file name. [default: no profile]")
+    parser.add_option("--lean",
+                      action="store_true", dest="lean", default=False,
+                      help="Convert with as little memory as possible, e.g. to run more conversions at once (see --jobs): only one copy of the input image is kept, the labels of the segments take 4 bytes per pixel and the output image is written band by band. The output image stays the same. With --verbose, the peak memory of every stage is printed. [default: %default]")
     parser.add_option("--felzScale",
                       dest="felzScale", default=50,
                       help="The first parameter ('scale') for the Felzenszwalb clustering. Description: Free parameter. Higher means larger clusters. [default: %default]")
@@ -117,6 +228,18 @@ if __name__ == "__main__":
     felzScale           = int(float(options.felzScale))
     felzSigma           = float(options.felzSigma)
     felzMinsize         = int(float(options.felzMinsize))
+    vectorized          = not options.perPixel
+    renderJobs          = max(1, int(options.renderJobs))
+    jobs                = max(1, int(options.jobs))
+    seed                = None if options.seed == None else int(options.seed)
+    segCacheDir         = options.segCache
+    segCacheSize        = int(options.segCacheSize)
+    memoryBudget        = None if options.memoryBudget == None else int(float(options.memoryBudget) * 1024**2)
+    workDir             = options.workDir
+    profile             = options.profile
+    lean                = options.lean
+    if seed != None and seed < 0:  # the seeds of the random streams (see afremize.getStreamSeed()) have to be non-negative
+        parser.error("--seed must be a non-negative integer")
     
     if options.infile == None:
         infile = None
@@ -167,9 +290,20 @@ if __name__ == "__main__":
               +"\ncolDiff: "+str(colDiff)
               +"\nfelzScale: "+str(felzScale)
               +"\nfelzSigma: "+str(felzSigma)
-              +"\nfelzMinsize: "+str(felzMinsize))
+              +"\nfelzMinsize: "+str(felzMinsize)
+              +"\nperPixel: "+str(not vectorized)
+              +"\nrenderJobs: "+str(renderJobs)
+              +"\njobs: "+str(jobs)
+              +"\nseed: "+str(seed)
+              +"\nsegCache: "+str(segCacheDir)
+              +"\nmemoryBudget: "+str(options.memoryBudget)
+              +"\nprofile: "+str(profile)
+              +"\nlean: "+str(lean))
     
     
+    segmentationCache = None if segCacheDir == None else segCache.SegmentationCache(segCacheDir, segCacheSize * 1024**2)
+    noInput = False  # whether the input directory is empty, the hint at the end is only meant for that case
+    
     if infile == None:
         path = ""
         input_dir = "input_images/"
@@ -182,13 +316,11 @@ if __name__ == "__main__":
             os.makedirs(path + output_dir)
         if not os.path.isdir(path + input_done):
             os.makedirs(path + input_done)
+        infiles = sorted(os.listdir(path + input_dir))
+        noInput = not infiles
     
-        for infile in os.listdir(path + "input_images/"):
-        
-            print("\nconverting file: "+ str(infile))
-            afremize.convertImage(
-                infile,
-                inIm=None,
+        if jobs > 1:
+            convertOptions = dict(
                 path=path,
                 input_dir=input_dir,
                 output_dir=output_dir,
@@ -211,9 +343,57 @@ if __name__ == "__main__":
                 otherfiles=otherfiles,
                 felzScale=felzScale,
                 felzSigma=felzSigma,
-                felzMinsize=felzMinsize
+                felzMinsize=felzMinsize,
+                vectorized=vectorized,
+                renderJobs=1,  # the batch processes cannot start processes of their own
+                segCache=segmentationCache,
+                memoryBudget=memoryBudget,
+                workDir=workDir,
+                profile=profile,
+                lean=lean
                 )
-            os.rename(path + input_dir + infile, path + input_done + infile)
+            if infiles:
+                convertBatch(infiles, jobs, path, input_dir, input_done, convertOptions, seed)
+        else:
+            for infile in infiles:
+        
+                print("\nconverting file: "+ str(infile))
+                afremize.convertImage(
+                    infile,
+                    inIm=None,
+                    path=path,
+                    input_dir=input_dir,
+                    output_dir=output_dir,
+                    verbose=verbose,
+                    strokeWidth=strokeWidth,
+                    strokeHeight=strokeHeight,
+                    randSizes=randSizes,
+                    longStrokes=longStrokes,
+                    directedRotate=directedRotate,
+                    strokeDensity=strokeDensity,
+                    background=background,
+                    noHairlines=noHairlines,
+                    noMargins=noMargins,
+                    segBound=segBound,
+                    colDiff=colDiff,
+                    saturation=saturation,
+                    ground=ground,
+                    highlight=highlight,
+                    colorify=colorify,
+                    otherfiles=otherfiles,
+                    felzScale=felzScale,
+                    felzSigma=felzSigma,
+                    felzMinsize=felzMinsize,
+                    vectorized=vectorized,
+                    renderJobs=renderJobs,
+                    seed=seed,
+                    segCache=segmentationCache,
+                    memoryBudget=memoryBudget,
+                    workDir=workDir,
+                    profile=getProfileName(profile, infile),
+                    lean=lean
+                    )
+                os.rename(path + input_dir + infile, path + input_done + infile)
     else:
         path = ""
         input_dir = ""
@@ -245,7 +425,15 @@ if __name__ == "__main__":
             otherfiles=otherfiles,
             felzScale=felzScale,
             felzSigma=felzSigma,
-            felzMinsize=felzMinsize
+            felzMinsize=felzMinsize,
+            vectorized=vectorized,
+            renderJobs=renderJobs,
+            seed=seed,
+            segCache=segmentationCache,
+            memoryBudget=memoryBudget,
+            workDir=workDir,
+            profile=profile,
+            lean=lean
             )
-    if infile == None:
+    if noInput:
         print("Please specify at least one input file. Example:\npython main.py -f 'name_of_input_image.png'")
@@ -0,0 +1,70 @@
+# Copyright (C) 2015 Jana Cavojska
+# This file is part of 'Afremize'.
+
+# 'Afremize' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+
+# 'Afremize' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with 'Afremize'.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division
+import numpy as np
+
+
+LUMINANCE = np.array([0.299, 0.587, 0.114])  # weights of the RGB channels in the luminance (ITU-R 601, like PIL's convert("L"))
+CELL_SAMPLES = 4  # the pixels sampled per row and column of a cell by getCellMeans()
+
+
+# Dense field of the orientation of the structures (edges and textures) of an image, from its smoothed structure tensor, for the directed complex brush strokes (see afremize.planStrokes()).
+# The luminance of the image array pixelsNP is averaged over cells of cell x cell pixels (a quarter of scale) from a sample of their pixels (see getCellMeans()), so the field needs only a few bytes per cell and reads only a small part of the image.
+# Its gradients are taken with Sobel filters, and the products of the gradients (the structure tensor) are smoothed with a Gaussian of scale pixels, the scale of the brush strokes.
+# The structures run perpendicular to the dominant gradient. angles holds their direction in every cell, as the angle by which a segment along them would be rotated upright (see afremize.getRegLineAngles()).
+class OrientationField(object):
+
+    def __init__(self, pixelsNP, scale, blockRows=256):
+        from scipy import ndimage  # imported here, like skimage in afremize.clustering()
+        height, width = pixelsNP.shape[:2]
+        self.cell = max(1, min(int(scale // 4), height, width))
+        luminance = getCellMeans(pixelsNP, self.cell, blockRows)
+        
+        gradientX = ndimage.sobel(luminance, axis=1)
+        gradientY = ndimage.sobel(luminance, axis=0)
+        sigma = max(1, scale / self.cell)
+        tensorXX = ndimage.gaussian_filter(gradientX * gradientX, sigma)
+        tensorXY = ndimage.gaussian_filter(gradientX * gradientY, sigma)
+        tensorYY = ndimage.gaussian_filter(gradientY * gradientY, sigma)
+        
+        # direction of the structures in degrees, in [-90, 90) with y pointing down, perpendicular to the dominant gradient direction 0.5 * atan2(2*Jxy, Jxx - Jyy):
+        direction = (np.degrees(0.5 * np.arctan2(2 * tensorXY, tensorXX - tensorYY)) + 180) % 180 - 90
+        # as in afremize.getRegLineAngles(): the angle to the vertical, negative if y increases with x
+        self.angles = np.where(direction > 0, np.abs(direction) - 90, 90 - np.abs(direction)).astype(np.float32)
+
+    # returns the angles at the coordinates (an array of [x, y] rows, see afremize.getStrokePositions())
+    def anglesAt(self, coordinates):
+        rows = np.minimum(coordinates[:, 1] // self.cell, self.angles.shape[0] - 1)
+        columns = np.minimum(coordinates[:, 0] // self.cell, self.angles.shape[1] - 1)
+        return self.angles[rows, columns]
+
+
+# returns the mean luminance of the image array pixelsNP in the cells of cell x cell pixels, reading it in bands of about blockRows rows. The pixels beyond the last whole cells are left out.
+# Only a grid of about CELL_SAMPLES x CELL_SAMPLES evenly spaced pixels of every cell is read, which is enough for gradients smoothed over several cells and spares reading the whole image.
+def getCellMeans(pixelsNP, cell, blockRows=256):
+    height, width = pixelsNP.shape[:2]
+    rows, columns = height // cell, width // cell
+    step = max(1, cell // CELL_SAMPLES)
+    offsets = np.arange(step // 2, cell, step)  # of the sampled pixels within a cell
+    columnIndex = (np.arange(columns)[:, None] * cell + offsets).ravel()
+    means = np.zeros((rows, columns))
+    bandCells = max(1, blockRows // cell)  # rows of cells per band
+    for top in range(0, rows, bandCells):
+        bottom = min(rows, top + bandCells)
+        rowIndex = (np.arange(top, bottom)[:, None] * cell + offsets).ravel()
+        band = np.asarray(pixelsNP[np.ix_(rowIndex, columnIndex)][:, :, :3], dtype=np.float64)
+        means[top:bottom] = band.reshape(bottom - top, len(offsets), columns, len(offsets), 3).mean(axis=(1, 3)).dot(LUMINANCE)
+    return means
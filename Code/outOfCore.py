@@ -0,0 +1,359 @@
+# Copyright (C) 2015 Jana Cavojska
+# This file is part of 'Afremize'.
+
+# 'Afremize' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+
+# 'Afremize' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with 'Afremize'.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+import ctypes
+import ctypes.util
+import mmap
+import multiprocessing
+import os
+import pickle
+import random
+import shutil
+import struct
+import tempfile
+from math import ceil, sqrt
+from PIL import Image, ImageFilter, ImageEnhance
+
+# own imports:
+import afremize
+import imgIO
+import segments
+import tiling
+
+
+# Out-of-core conversion of images too large to be segmented and painted in memory (see afremize.convertImage(..., memoryBudget=...)).
+# The input image, its saturated copy, the felzenszwalb label array and the output canvas are kept in memory-mapped files in a temporary work directory,
+# and every step works on one tile or band of rows at a time, sized so that the memory it needs stays within memoryBudget:
+#   - the saturated image is segmented in overlapping tiles, whose labels are stitched across the tile borders (see segmentTiled())
+#   - the segments are indexed in one pass over the label array, without sorting its pixels (see segments.BandedSegmentIndex)
+#   - the brush strokes are planned as usual and spooled to a file, then the canvas is painted tile by tile (see paintSpooled())
+#   - the canvas is written to a PNG file band by band (see imgIO.savePNGBands())
+# Like with tiled rendering (see tiling.py), all strokes are planned before they are painted, so without a seed the result differs from a serial in-memory run.
+
+# rough peak memory per pixel of a tile or band in the steps above, measured with the default settings:
+DECODE_BYTES_PER_PIXEL = 4  # PIL's decoded image of a compressed input file
+SATURATE_BYTES_PER_PIXEL = 24  # the PIL images of ImageEnhance.Color
+FELZENSZWALB_BYTES_PER_PIXEL = 400  # skimage's felzenszwalb() itself needs about 320
+BAND_BYTES_PER_PIXEL = 128  # afremize.getSegmentMoments() and the other passes over bands of rows
+PAINT_BYTES_PER_PIXEL = 64  # a canvas tile, its background and hairline mask
+PNG_BYTES_PER_PIXEL = 128  # the filtering in imgIO.savePNGBands()
+SEGMENT_BYTES = 1024  # the segment table and index, and the lists of afremize.planStrokes(), per segment
+TILE_OVERLAP = 64  # number of pixels by which each segmentation tile reaches into its neighbours
+
+
+# returns the C library's malloc_trim(), which hands the memory freed on the heap back to the system, or None if there is none (it is a function of glibc)
+def getMallocTrim():
+    try:
+        return ctypes.CDLL(ctypes.util.find_library("c")).malloc_trim
+    except (OSError, AttributeError, TypeError):
+        return None
+
+MALLOC_TRIM = getMallocTrim()
+
+
+# Temporary directory (within directory, the system's default if None) holding the memory-mapped arrays of a conversion.
+# The pages of a mapped file that were read or written count towards the memory of the process until they are unmapped, release() drops them again (the data stays in the files).
+# release() also trims the heap: glibc keeps the memory of freed arrays of a tile or band for later ones, and the pieces it keeps add up with the number of tiles.
+class WorkFiles(object):
+
+    def __init__(self, directory=None):
+        self.directory = tempfile.mkdtemp(prefix="afremize_", dir=directory)
+        self.maps = []
+
+    # returns a new array of the given shape and dtype, mapped to the file name in the work directory
+    def create(self, name, shape, dtype):
+        size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        with open(os.path.join(self.directory, name), "w+b") as f:
+            f.truncate(size)
+            mapped = mmap.mmap(f.fileno(), size)
+        self.add(mapped)
+        return np.ndarray(shape, dtype, buffer=mapped)
+
+    # returns a read-only array of the given shape and dtype, mapped to the file filename from offset on
+    def map(self, filename, shape, dtype, offset=0):
+        with open(filename, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.add(mapped)
+        return np.ndarray(shape, dtype, buffer=mapped, offset=offset)
+
+    # Keeps the map mapped for release(). Reading around the pages that are accessed is turned off for it: the strokes of a large segment are planned from pixels
+    # scattered over the whole image (see afremize.planStrokes()), and the pages around them would add up to most of the files before the next release().
+    def add(self, mapped):
+        if hasattr(mmap, "MADV_RANDOM"):
+            mapped.madvise(mmap.MADV_RANDOM)
+        self.maps.append(mapped)
+
+    def release(self):
+        if hasattr(mmap, "MADV_DONTNEED"):  # not on Windows, which trims the pages of a process by itself
+            for mapped in self.maps:
+                mapped.madvise(mmap.MADV_DONTNEED)
+        if MALLOC_TRIM != None:
+            MALLOC_TRIM(0)
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+# returns the number of rows of a band of an image width pixels wide that takes memoryBudget bytes at bytesPerPixel
+def getBandRows(width, memoryBudget, bytesPerPixel):
+    return max(1, int(memoryBudget // (bytesPerPixel * width)))
+
+
+# returns the side length of the square tiles that take memoryBudget bytes at bytesPerPixel, minus twice the overlap (but at least minSide)
+def getTileSide(memoryBudget, bytesPerPixel, overlap=0, minSide=64):
+    return max(minSide, int(sqrt(memoryBudget / bytesPerPixel)) - 2 * overlap)
+
+
+# splits an image of size width x height into a grid of tiles of at most side x side pixels and returns the x and the y coordinates of the tile borders
+def getGrid(width, height, side):
+    cols = int(ceil(width / side))
+    rows = int(ceil(height / side))
+    return [(width * i) // cols for i in range(0, cols + 1)], [(height * j) // rows for j in range(0, rows + 1)]
+
+
+# returns the input image as an array of shape (height, width, 3). Uncompressed RGB files (like PPM or uncompressed TIFF files) are mapped directly,
+# all other images are decoded by PIL and copied into the work directory band by band. PIL decodes compressed files (like JPEG or PNG files) as a whole,
+# so a ValueError is raised before decoding one whose decoded image would not fit into memoryBudget.
+def loadInput(work, filename, inIm, memoryBudget):
+    if inIm == None:
+        inIm = Image.open(filename)
+        width, height = inIm.size
+        if inIm.mode == "RGB" and len(inIm.tile) == 1:
+            decoder, extents, offset, args = inIm.tile[0]
+            args = args if isinstance(args, tuple) else (args,)
+            if decoder == "raw" and tuple(extents) == (0, 0, width, height) and args[0] == "RGB" and (len(args) < 2 or args[1] in (0, 3 * width)) and (len(args) < 3 or args[2] == 1):
+                return work.map(filename, (height, width, 3), np.uint8, offset)
+        if width * height * DECODE_BYTES_PER_PIXEL > memoryBudget:
+            raise ValueError("decoding " + filename + " takes about " + str(width * height * DECODE_BYTES_PER_PIXEL // 1024**2) + " MB, more than the memory budget: convert it to an uncompressed PPM or TIFF file first, which is read band by band")
+    width, height = inIm.size
+    inPixNP = work.create("input", (height, width, 3), np.uint8)
+    bandRows = getBandRows(width, memoryBudget, 8)
+    for top in range(0, height, bandRows):
+        inPixNP[top:top + bandRows] = np.asarray(inIm.crop((0, top, width, min(height, top + bandRows))).convert("RGB"))
+        work.release()
+    return inPixNP
+
+
+# saturates the image array inPixNP band by band, with the same result as afremize.saturateImage() (ImageEnhance.Color works pixel by pixel), and returns the saturated array
+def saturateBands(work, inPixNP, saturation, memoryBudget):
+    height, width = inPixNP.shape[:2]
+    saturatedNP = work.create("saturated", (height, width, 3), np.uint8)
+    bandRows = getBandRows(width, memoryBudget, SATURATE_BYTES_PER_PIXEL)
+    for top in range(0, height, bandRows):
+        band = Image.fromarray(np.ascontiguousarray(inPixNP[top:top + bandRows]))
+        saturatedNP[top:top + bandRows] = np.asarray(ImageEnhance.Color(band).enhance(saturation))
+        work.release()
+    return saturatedNP
+
+
+# Segments the image array saturatedNP with felzenszwalb() in tiles of at most side x side pixels and returns the label array, mapped to a file in the work directory.
+# Every tile is segmented together with a margin of TILE_OVERLAP pixels, so that the segments along its borders are not cut off, and keeps the labels of its own pixels,
+# with the parts of a segment that are only connected through the margin labelled separately (so that every segment stays connected, as afremize.fitSegmentRegressions() assumes).
+# A segment crossing a tile border is then stitched together from the parts on both sides: two neighbouring pixels on opposite sides of the border belong to the same segment
+# if the segmentation of either tile (one of which segmented them in its margin) puts them into one segment. The parts connected this way are merged by a connected components search.
+def segmentTiled(work, saturatedNP, side, scale=50, sigma=4.5, min_size=10, memoryBudget=1024**3, verbose=False):
+    from scipy.sparse import coo_matrix  # imported here, like skimage in afremize.clustering()
+    from scipy.sparse.csgraph import connected_components
+    from skimage.measure import label as labelConnected
+    from skimage.segmentation import felzenszwalb
+    height, width = saturatedNP.shape[:2]
+    xs, ys = getGrid(width, height, side)
+    cols, rows = len(xs) - 1, len(ys) - 1
+    labelsNP = work.create("labels", (height, width), np.int32)
+    numOfParts = 0
+    seams = {}  # whether a tile's segmentation puts the pixel pairs along its right and bottom borders into one segment, until the tile on the other side is segmented
+    partsA, partsB = [], []  # the pairs of parts to be merged
+    for row in range(0, rows):
+        for col in range(0, cols):
+            left, top, right, bottom = xs[col], ys[row], xs[col + 1], ys[row + 1]
+            outerLeft, outerTop = max(0, left - TILE_OVERLAP), max(0, top - TILE_OVERLAP)
+            outerRight, outerBottom = min(width, right + TILE_OVERLAP), min(height, bottom + TILE_OVERLAP)
+            tileLabels = felzenszwalb(np.asarray(saturatedNP[outerTop:outerBottom, outerLeft:outerRight]), scale, sigma, min_size)
+            
+            # the tile's own pixels, x0 <= x < x1 and y0 <= y < y1 in tileLabels:
+            x0, y0, x1, y1 = left - outerLeft, top - outerTop, right - outerLeft, bottom - outerTop
+            parts = labelConnected(tileLabels[y0:y1, x0:x1], background=-1, connectivity=2)  # the labels start at 1
+            labelsNP[top:bottom, left:right] = parts + (numOfParts - 1)
+            numOfParts += int(parts.max())
+            
+            if col > 0:
+                same = seams.pop(("left", row, col)) | (tileLabels[y0:y1, x0 - 1] == tileLabels[y0:y1, x0])
+                partsA.append(labelsNP[top:bottom, left - 1][same])
+                partsB.append(labelsNP[top:bottom, left][same])
+            if row > 0:
+                same = seams.pop(("top", row, col)) | (tileLabels[y0 - 1, x0:x1] == tileLabels[y0, x0:x1])
+                partsA.append(labelsNP[top - 1, left:right][same])
+                partsB.append(labelsNP[top, left:right][same])
+            if col < cols - 1:
+                seams[("left", row, col + 1)] = tileLabels[y0:y1, x1 - 1] == tileLabels[y0:y1, x1]
+            if row < rows - 1:
+                seams[("top", row + 1, col)] = tileLabels[y1 - 1, x0:x1] == tileLabels[y1, x0:x1]
+            del tileLabels, parts
+            work.release()
+    
+    partsA = np.concatenate(partsA + [np.zeros(0, dtype=np.int32)])
+    partsB = np.concatenate(partsB + [np.zeros(0, dtype=np.int32)])
+    graph = coo_matrix((np.ones(len(partsA), dtype=np.int8), (partsA, partsB)), shape=(numOfParts, numOfParts))
+    numOfSegments, segmentOfPart = connected_components(graph, directed=False)
+    segmentOfPart = segmentOfPart.astype(np.int32)
+    bandRows = getBandRows(width, memoryBudget, 16)
+    for top in range(0, height, bandRows):
+        labelsNP[top:top + bandRows] = segmentOfPart[labelsNP[top:top + bandRows]]
+        work.release()
+    if verbose:
+        print("out-of-core segmentation: "+str(cols)+"x"+str(rows)+" tiles, "+str(numOfParts)+" parts stitched to "+str(numOfSegments)+" segments")
+    return labelsNP
+
+
+# returns the background of the canvas tile (left, top, right, bottom) as an array of mode RGB ("blur") or RGBA, with the same pixels afremize.colorBackground() gives the whole image
+# segmentColors: the color of every segment (for the "cluster" background)
+def getBackgroundTile(saturatedNP, labelsNP, segmentColors, tile, background):
+    left, top, right, bottom = tile
+    height, width = labelsNP.shape
+    if background == "blur":
+        # BLUR is a 5x5 filter, blurring the tile with a margin of 2 pixels gives the same pixels as blurring the whole image:
+        outerLeft, outerTop, outerRight, outerBottom = max(0, left - 2), max(0, top - 2), min(width, right + 2), min(height, bottom + 2)
+        blurred = np.asarray(Image.fromarray(np.ascontiguousarray(saturatedNP[outerTop:outerBottom, outerLeft:outerRight])).filter(ImageFilter.BLUR))
+        return blurred[top - outerTop:bottom - outerTop, left - outerLeft:right - outerLeft]
+    pixels = np.full((bottom - top, right - left, 4), 255, dtype=np.uint8)
+    if background == "cluster":
+        pixels[:, :, :3] = segmentColors[labelsNP[top:bottom, left:right]]
+    return pixels
+
+
+# fills the pixels of the hairline segments hairlineIDs (a sorted array) in the canvas tile (left, top, right, bottom) with their segmentColors, like paintImg_with_brushstrokes() does
+def fillHairlines(tilePixels, labelsNP, segmentColors, tile, hairlineIDs):
+    left, top, right, bottom = tile
+    labels = labelsNP[top:bottom, left:right]
+    hairline = np.isin(labels, hairlineIDs)
+    tilePixels[hairline, :3] = segmentColors[labels[hairline]]
+    if tilePixels.shape[2] == 4:
+        tilePixels[hairline, 3] = 255
+
+
+# Paints the strokes planned by afremize.planStrokes() on the memory-mapped canvas canvasNP (of mode RGB or RGBA), in tiles of at most tileSide x tileSide pixels.
+# The strokes are spooled to a file in painting order while they are planned, and their footprints (see tiling.strokeFootprint()) and file offsets to another one, which is mapped for looking up the strokes of the tiles.
+# Then each tile reads the strokes reaching into it back from the file and is painted by tiling.paintTile() on its background, like a tile of tiling.paintTiled(),
+# which also gives every stroke its own random seed. renderJobs tiles are painted at once by as many processes.
+# hairlineIDs: the list planStrokes() appends the hairline segments to, which are filled in with their segmentColors (unless noHairlines) after the strokes
+def paintSpooled(work, canvasNP, mode, strokes, tileSide, saturatedNP, labelsNP, segmentColors, background, hairlineIDs, noHairlines=False, renderJobs=1, verbose=False, options=(0, False, True, True, True, "bicubic")):
+    height, width = labelsNP.shape
+    spool = open(os.path.join(work.directory, "strokes"), "w+b")
+    footprintsFile = os.path.join(work.directory, "footprints")
+    numOfStrokes = 0
+    with open(footprintsFile, "wb") as footprints:
+        for stroke in strokes:
+            if stroke[4] == None:
+                stroke = stroke[:4] + (random.getrandbits(32),)
+            footprints.write(struct.pack("=5q", *(tiling.strokeFootprint(stroke) + (spool.tell(),))))  # left, top, right, bottom, offset
+            pickle.dump(stroke, spool, pickle.HIGHEST_PROTOCOL)
+            numOfStrokes += 1
+            if numOfStrokes % 1000 == 0:
+                work.release()
+    footprints = work.map(footprintsFile, (numOfStrokes, 5), np.int64) if numOfStrokes > 0 else np.zeros((0, 5), dtype=np.int64)
+    hairlineIDs = np.unique(np.array(hairlineIDs, dtype=np.int64))
+    
+    xs, ys = getGrid(width, height, tileSide)
+    tiles = [(xs[i], ys[j], xs[i + 1], ys[j + 1]) for j in range(0, len(ys) - 1) for i in range(0, len(xs) - 1)]
+    if verbose:
+        print("out-of-core rendering: "+str(numOfStrokes)+" strokes, "+str(len(tiles))+" tiles")
+    pool = None if renderJobs <= 1 else multiprocessing.Pool(renderJobs)
+    try:
+        for first in range(0, len(tiles), renderJobs):
+            tasks = []
+            for tile in tiles[first:first + renderJobs]:
+                left, top, right, bottom = tile
+                hits = np.nonzero((footprints[:, 0] < right) & (footprints[:, 2] > left) & (footprints[:, 1] < bottom) & (footprints[:, 3] > top))[0]
+                tileStrokes = []
+                for offset in footprints[hits, 4]:
+                    spool.seek(offset)
+                    tileStrokes.append(pickle.load(spool))
+                tasks.append((tile, getBackgroundTile(saturatedNP, labelsNP, segmentColors, tile, background), mode, tileStrokes, options, None))
+            results = map(tiling.paintTile, tasks) if pool == None else pool.map(tiling.paintTile, tasks)
+            for tile, tilePixels, tileProfile in results:
+                left, top, right, bottom = tile
+                if not noHairlines and len(hairlineIDs) > 0:
+                    fillHairlines(tilePixels, labelsNP, segmentColors, tile, hairlineIDs)
+                canvasNP[top:bottom, left:right] = tilePixels
+            del tasks, results
+            work.release()
+    finally:
+        spool.close()
+        if pool != None:
+            pool.close()
+            pool.join()
+
+
+# yields the rows of the array canvasNP in bands of bandRows rows, releasing the pages of the work files after each band
+def getBands(work, canvasNP, bandRows):
+    for top in range(0, canvasNP.shape[0], bandRows):
+        yield canvasNP[top:top + bandRows]
+        work.release()
+
+
+# Converts an image out of core, with the arguments of afremize.convertImage(). The arrays of the size of the image are kept in a temporary directory within workDir (the system's default if None), which is removed afterwards.
+# memoryBudget: the number of bytes the conversion may take on top of the memory of the modules it uses. The data kept per segment (SEGMENT_BYTES) is taken from it, the tiles and bands of rows get the rest.
+#   Compressed input files are rejected if their decoded image does not fit into it (see loadInput()), as are images with so many segments that less than a quarter would be left.
+# The painted image is always saved as a PNG file, also with webinterface, and returned as the PIL image of that file, which is only loaded when it is used.
+# The preview, plan and segCache of afremize.convertImage() and the files of otherfiles are not supported.
+def convertImage(infile, inIm=None, path="", input_dir="", output_dir="", verbose=False, strokeWidth=100, strokeHeight=100, randSizes=100, longStrokes=False, directedRotate=False, strokeDensity=70, background='blur', noHairlines=False, noMargins=False, segBound=100, colDiff=500, ground=False, saturation=2.5, highlight=False, colorify=0, felzScale=50, felzSigma=4.5, felzMinsize=10, vectorized=True, cacheTemplates=True, directRaster=True, resample="bicubic", renderJobs=1, seed=None, memoryBudget=1024**3, workDir=None):
+    work = WorkFiles(workDir)
+    try:
+        inPixNP = loadInput(work, path + input_dir + infile, inIm, memoryBudget)
+        height, width = inPixNP.shape[:2]
+        saturatedNP = saturateBands(work, inPixNP, saturation, memoryBudget)
+        del inPixNP
+        
+        segmentationSide = getTileSide(memoryBudget, FELZENSZWALB_BYTES_PER_PIXEL, TILE_OVERLAP)
+        labelsNP = segmentTiled(work, saturatedNP, segmentationSide, felzScale, felzSigma, felzMinsize, memoryBudget, verbose)
+        segmentIndex = segments.BandedSegmentIndex(labelsNP, getBandRows(width, memoryBudget, BAND_BYTES_PER_PIXEL), work.release)
+        # the data kept per segment until the strokes are painted is taken from the budget of the bands and tiles:
+        bandBudget = memoryBudget - len(segmentIndex) * SEGMENT_BYTES
+        if bandBudget < memoryBudget // 4:
+            raise ValueError("the " + str(len(segmentIndex)) + " segments of " + infile + " take about " + str(len(segmentIndex) * SEGMENT_BYTES // 1024**2) + " MB, too much of the memory budget: raise it, or the Felzenszwalb scale or minimum size for fewer segments")
+        bandRows = getBandRows(width, bandBudget, BAND_BYTES_PER_PIXEL)
+        inPix = imgIO.ArrayPixelAccess(saturatedNP)
+        segmentTable = afremize.getSegmentTable(segmentIndex, saturatedNP, False, None, width, height, bandRows)
+        work.release()
+        
+        complex_sizeX, complex_sizeY, stroke_density = afremize.setParameters(width, height, verbose, randSizes, longStrokes, strokeWidth, strokeHeight, strokeDensity)
+        smallSegment_maxSize = segBound if segBound != None else (width * height) // 5000
+        largeSegment_minSize = segBound if segBound != None else (width * height) // 5000
+        if verbose:
+            print("segBound: "+str(smallSegment_maxSize))
+        segmentColors = segmentTable.byID("color")  # the color of each segment's first pixel
+        
+        hairlineIDs = []
+        strokes = afremize.planStrokes(segmentTable, segmentIndex, inPix, saturatedNP, width, height, hairlineIDs, complex_sizeX, complex_sizeY, stroke_density, smallSegment_maxSize, largeSegment_minSize, randSizes=randSizes, directedRotate=directedRotate, colDiff=colDiff, ground=ground, highlight=highlight, seed=seed, blockRows=bandRows)
+        mode = "RGB" if background == "blur" else "RGBA"
+        canvasNP = work.create("canvas", (height, width, len(mode)), np.uint8)
+        paintSide = getTileSide(bandBudget / max(1, renderJobs), PAINT_BYTES_PER_PIXEL)
+        options = (colorify, noMargins, vectorized, cacheTemplates, directRaster, resample)
+        paintSpooled(work, canvasNP, mode, strokes, paintSide, saturatedNP, labelsNP, segmentColors, background, hairlineIDs, noHairlines, renderJobs, verbose, options)
+        del segmentIndex, segmentTable, segmentColors, strokes, hairlineIDs, inPix
+        work.release()
+        
+        outfile = afremize.getOutfileName(path, output_dir, infile, reserve=True)[1]
+        try:
+            imgIO.savePNGBands(outfile, width, height, mode, getBands(work, canvasNP, getBandRows(width, memoryBudget, PNG_BYTES_PER_PIXEL)))
+        except BaseException:
+            os.remove(outfile)
+            raise
+    finally:
+        work.remove()
+    return Image.open(outfile)
@@ -0,0 +1,140 @@
+# Copyright (C) 2015 Jana Cavojska
+# This file is part of 'Afremize'.
+
+# 'Afremize' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+
+# 'Afremize' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with 'Afremize'.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division
+from __future__ import print_function
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+# Profile of one conversion (see afremize.convertImage(..., profile=...)), written as a JSON trace:
+#   - the wall and CPU time and the peak memory (resident set size) of every stage
+#   - counters, like the numbers of segments of each class, of strokes and of pixels written
+#   - the time spent in hot paths (see hotPath()), with their number of calls
+# Nothing of this is collected without a profile: the conversion functions only check whether their profile argument is None, and the hot paths are timed where they are called,
+# by the profile passed down to them, so that nothing global is changed and several conversions (e.g. in the threads of a process) can be profiled at the same time.
+# The processes of tiled rendering (see tiling.py) record profiles of their own, which are merged into the profile of the conversion (see merge()).
+# timeHotPaths: if False, hotPath() does not time the hot paths, for profiles only kept for their stages (like those of lean conversions, see afremize.convertImage())
+class Profile(object):
+
+    def __init__(self, timeHotPaths=True):
+        self.timeHotPaths = timeHotPaths
+        self.info = OrderedDict()  # e.g. the file name and size of the image
+        self.stages = []
+        self.counters = OrderedDict()
+        self.timers = OrderedDict()  # seconds and number of calls, by name
+
+    # context manager recording the stage name
+    @contextmanager
+    def stage(self, name):
+        resetPeakRSS()
+        wall, cpu = time.time(), time.process_time()
+        try:
+            yield
+        finally:
+            self.stages.append(OrderedDict([("name", name), ("wall", time.time() - wall), ("cpu", time.process_time() - cpu), ("peakRSS", getPeakRSS())]))
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def addTime(self, name, seconds, calls=1):
+        timer = self.timers.setdefault(name, [0.0, 0])
+        timer[0] += seconds
+        timer[1] += calls
+
+    # context manager adding the time spent in it as one call to the timer name
+    @contextmanager
+    def hotPath(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.addTime(name, time.time() - start)
+
+    # adds the counters and timers of the profile other (e.g. of a tile painted by another process) to those of this profile
+    def merge(self, other):
+        for name, n in other.counters.items():
+            self.count(name, n)
+        for name, (seconds, calls) in other.timers.items():
+            self.addTime(name, seconds, calls)
+
+    def toDict(self):
+        trace = OrderedDict(self.info)
+        trace["stages"] = self.stages
+        trace["total"] = OrderedDict([("wall", sum(stage["wall"] for stage in self.stages)), ("cpu", sum(stage["cpu"] for stage in self.stages)), ("peakRSS", max([stage["peakRSS"] for stage in self.stages] + [0]))])
+        trace["counters"] = self.counters
+        trace["hotPaths"] = OrderedDict((name, OrderedDict([("seconds", seconds), ("calls", calls)])) for name, (seconds, calls) in self.timers.items())
+        return trace
+
+    def write(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.toDict(), f, indent=2)
+
+    # prints the wall time and peak memory of every stage
+    def printStages(self):
+        for stage in self.stages:
+            print(stage["name"] + ": " + str(round(stage["wall"], 2)) + " s, peak RSS " + str(stage["peakRSS"] // 1024**2) + " MB")
+
+
+# returns a context manager recording the stage name in profile, or doing nothing if profile is None
+def stage(profile, name):
+    if profile == None:
+        return NOT_PROFILED
+    return profile.stage(name)
+
+
+# returns a context manager timing the hot path name (see Profile.hotPath()) in profile, or doing nothing if profile is None or does not time its hot paths
+def hotPath(profile, name):
+    if profile == None or not profile.timeHotPaths:
+        return NOT_PROFILED
+    return profile.hotPath(name)
+
+
+# context manager of stage() and hotPath() without a profile
+class NotProfiled(object):
+    def __enter__(self):
+        return None
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+NOT_PROFILED = NotProfiled()
+
+
+# resets the peak memory of the process reported by getPeakRSS(), where the system allows it (Linux)
+def resetPeakRSS():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except (IOError, OSError):
+        pass
+
+
+# returns the peak resident set size of the process in bytes since the last resetPeakRSS(), or since its start if that is not supported (0 where neither /proc nor resource exist, e.g. on Windows)
+def getPeakRSS():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # kB on Linux
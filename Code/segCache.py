@@ -0,0 +1,105 @@
+# Copyright (C) 2015 Jana Cavojska
+# This file is part of 'Afremize'.
+
+# 'Afremize' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+
+# 'Afremize' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with 'Afremize'.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import division
+import numpy as np
+import hashlib
+import os
+import shutil
+import tempfile
+
+# own imports:
+import segments
+
+
+CACHE_FORMAT = 2  # part of the keys, so that entries of an older format are not found (and evicted eventually)
+
+
+# Persistent cache of the segmentation of images: the felzenszwalb label array, its segments.SegmentIndex and its segments.SegmentTable (see afremize.getSegmentTable()).
+# None of these depend on the brush stroke options, so repeated renders of the same image with other stroke options can skip straight to painting.
+# An entry is keyed by a hash of the input pixels and the parameters the segmentation depends on (see getKey()). Each entry is a directory with the files
+#   labels.npy, order.npy: the label array and the order array of its SegmentIndex, loaded as memory maps
+#   segmentTable.npz: the segment table (see segments.SegmentTable.save())
+# When the entries take more than maxBytes on disk, the least recently used ones are deleted. The entries are written to a temporary directory first and renamed,
+# so several processes (e.g. the batch mode of main.py) can share a cache directory.
+class SegmentationCache(object):
+
+    def __init__(self, directory, maxBytes=2 * 1024**3):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    # returns the key of the segmentation of the RGB array inPixNP with the given saturation and felzenszwalb parameters
+    def getKey(self, inPixNP, saturation, felzScale, felzSigma, felzMinsize):
+        digest = hashlib.sha1(np.ascontiguousarray(inPixNP).data)
+        digest.update(repr((CACHE_FORMAT, inPixNP.shape, str(inPixNP.dtype), float(saturation), float(felzScale), float(felzSigma), int(felzMinsize))).encode('ascii'))
+        return digest.hexdigest()
+
+    # returns (segmentsNP, segmentIndex, segmentTable) of the entry key, or None if there is no such entry
+    def load(self, key):
+        entry = os.path.join(self.directory, key)
+        try:
+            segmentsNP = np.load(os.path.join(entry, "labels.npy"), mmap_mode='r')
+            order = np.load(os.path.join(entry, "order.npy"), mmap_mode='r')
+            segmentTable = segments.loadSegmentTable(os.path.join(entry, "segmentTable.npz"))
+            os.utime(entry, None)  # mark the entry as recently used
+        except (IOError, OSError, ValueError):  # no entry, or one that was just evicted by another process
+            self.misses += 1
+            return None
+        self.hits += 1
+        return segmentsNP, segments.SegmentIndex(segmentsNP, order), segmentTable
+
+    # stores the segmentation as the entry key and evicts the least recently used entries if the cache got too large
+    def store(self, key, segmentsNP, segmentIndex, segmentTable):
+        entry = os.path.join(self.directory, key)
+        if os.path.isdir(entry):
+            return
+        tmp = tempfile.mkdtemp(prefix=".tmp_", dir=self.directory)
+        np.save(os.path.join(tmp, "labels.npy"), segmentsNP.astype(np.int32) if len(segmentIndex) < 2**31 else segmentsNP)  # felzenszwalb() returns int64 labels
+        np.save(os.path.join(tmp, "order.npy"), segmentIndex.order)
+        segmentTable.save(os.path.join(tmp, "segmentTable.npz"))
+        try:
+            os.rename(tmp, entry)
+        except OSError:  # another process stored the same entry in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    # deletes the least recently used entries until the remaining ones take at most maxBytes
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            entry = os.path.join(self.directory, name)
+            if name.startswith(".") or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:  # evicted by another process
+                continue
+        total = sum(size for lastUsed, size, entry in entries)
+        for lastUsed, size, entry in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -0,0 +1,275 @@
+# Copyright (C) 2015 Jana Cavojska
+# This file is part of 'Afremize'.
+
+# 'Afremize' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+
+# 'Afremize' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with 'Afremize'.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division
+import numpy as np
+
+
+# Compact index of the pixels of every felzenszwalb segment, built from the label array segmentsNP (shape (height, width)) with a single argsort.
+# It replaces the former segmentsByIDlist (a list of (x, y) tuple lists, one per segmentID) and needs about 4 bytes per pixel instead of 100+.
+# CSR layout: order contains the flat (row-major) indices of all pixels grouped by segmentID, the pixels of segment s are order[offsets[s]:offsets[s+1]].
+# Within a segment, pixels keep the row-major order segmentsByIDlist had, so pixels(s)[0] is still the segment's first pixel.
+# order: the order array of an earlier index of the same label array (e.g. from segCache.SegmentationCache), which saves the argsort
+class SegmentIndex(object):
+
+    def __init__(self, segmentsNP, order=None):
+        self.labels = segmentsNP  # the label array itself, for lookups by position
+        self.height, self.width = segmentsNP.shape
+        labels = segmentsNP.ravel()
+        self.sizes = np.bincount(labels)  # number of pixels per segmentID
+        self.offsets = np.zeros(len(self.sizes) + 1, dtype=np.int64)
+        np.cumsum(self.sizes, out=self.offsets[1:])
+        if order is None:
+            indexType = np.int32 if labels.size < 2**31 else np.int64
+            order = np.argsort(labels, kind='stable').astype(indexType)
+        self.order = order
+
+    # number of segmentIDs (including IDs without any pixels)
+    def __len__(self):
+        return len(self.sizes)
+
+    def size(self, segmentID):
+        return int(self.sizes[segmentID])
+
+    # returns the x and y coordinates of all pixels of the segment as two arrays
+    def pixels(self, segmentID):
+        flat = self.order[self.offsets[segmentID]:self.offsets[segmentID + 1]]
+        ys, xs = np.divmod(flat, self.width)
+        return xs, ys
+
+    # returns the x and y coordinates of all pixels of the segments segmentIDs (a sequence) as two arrays, and the segmentID of every pixel
+    # with one gather from order instead of one pixels() call per segment
+    def pixelsOf(self, segmentIDs):
+        segmentIDs = np.asarray(segmentIDs, dtype=np.int64)
+        sizes = self.sizes[segmentIDs]
+        ends = np.cumsum(sizes)
+        positions = np.arange(ends[-1] if len(ends) > 0 else 0) + np.repeat(self.offsets[segmentIDs] - ends + sizes, sizes)
+        ys, xs = np.divmod(self.order[positions], self.width)
+        return xs, ys, np.repeat(segmentIDs, sizes)
+
+    # returns the (x, y) coordinates of the segment's first pixel (in row-major order)
+    def representative(self, segmentID):
+        y, x = divmod(int(self.order[self.offsets[segmentID]]), self.width)
+        return x, y
+
+    # returns the (x, y) coordinates of the first pixel of every segment as two arrays (undefined for empty segments)
+    def representatives(self):
+        first = self.order[np.minimum(self.offsets[:-1], len(self.order) - 1)]
+        ys, xs = np.divmod(first, self.width)
+        return xs, ys
+
+    # returns all segmentIDs sorted by their number of pixels from largest to smallest, segments of equal size by descending segmentID
+    def sortedBySize(self):
+        segmentIDs = np.arange(len(self.sizes))
+        return np.lexsort((-segmentIDs, -self.sizes))
+
+    # returns the bounding boxes of all segments as the arrays (minX, maxX, minY, maxY), indexed by segmentID (0 for empty segments)
+    def boundingBoxes(self):
+        nonEmpty = np.nonzero(self.sizes)[0]
+        starts = self.offsets[nonEmpty]
+        ys, xs = np.divmod(self.order, self.width)
+        minX, maxX, minY, maxY = [np.zeros(len(self.sizes), dtype=int) for i in range(0, 4)]
+        minX[nonEmpty] = np.minimum.reduceat(xs, starts)
+        maxX[nonEmpty] = np.maximum.reduceat(xs, starts)
+        minY[nonEmpty] = np.minimum.reduceat(ys, starts)
+        maxY[nonEmpty] = np.maximum.reduceat(ys, starts)
+        return minX, maxX, minY, maxY
+
+    # yields the label array in bands of blockRows rows as (top, labels[top:top + blockRows])
+    def labelBands(self, blockRows):
+        for top in range(0, self.height, blockRows):
+            yield top, self.labels[top:top + blockRows]
+
+
+# returns the color the first pixel (see representatives()) of every segment of segmentIndex has in the image array pixelsNP, as an array indexed by segmentID, e.g. to color the label array with palette[labels]
+# The pixels are looked up band by band along segmentIndex.labelBands(blockRows), so that a BandedSegmentIndex releases the pages of a memory-mapped pixelsNP after each band.
+def getPalette(segmentIndex, pixelsNP, blockRows=256):
+    xs, ys = segmentIndex.representatives()
+    palette = np.zeros((len(xs),) + pixelsNP.shape[2:], dtype=pixelsNP.dtype)
+    byRow = np.argsort(ys, kind='stable')
+    sortedYs = ys[byRow]
+    for top, labels in segmentIndex.labelBands(blockRows):
+        inBand = byRow[np.searchsorted(sortedYs, top):np.searchsorted(sortedYs, top + labels.shape[0])]
+        palette[inBand] = pixelsNP[ys[inBand], xs[inBand]]
+    return palette
+
+
+# the stroke classes of the segments of a SegmentTable, its column strokeClass being the index of the class in this list:
+# "none": no brush stroke can be planned for the segment (too small for a regression line, or its regression line lies outside of the image), "unclassified": not classified for the stroke options yet (see afremize.classifySegments()),
+# "hairline", "simple", "skipped" (a small segment of too little contrast to its neighbours), "unpainted" (a middle-sized segment), "complex" and "ground"
+STROKE_CLASSES = ["none", "unclassified", "hairline", "simple", "skipped", "unpainted", "complex", "ground"]
+STROKE_NONE, STROKE_UNCLASSIFIED, STROKE_HAIRLINE, STROKE_SIMPLE, STROKE_SKIPPED, STROKE_UNPAINTED, STROKE_COMPLEX, STROKE_GROUND = range(0, len(STROKE_CLASSES))
+
+# the columns of a SegmentTable:
+#   segmentID, area (number of pixels), minX, minY, maxX, maxY (the not-rotated bounding box), centroidX, centroidY,
+#   color (of the segment's first pixel, see getPalette(), the color the segment is filled with), meanColor,
+#   momentXX, momentXY, momentYY (the central second moments of the pixel coordinates), orientation (the angle of the segment's major axis to the x axis in degrees, y pointing down),
+#   regression (the coefficients of the regression line y = a*x^2 + b*x + c, highest power first, NaN without one), angle (by which the segment is rotated upright, NaN without a regression line), strokeClass (see STROKE_CLASSES)
+SEGMENT_TABLE_DTYPE = np.dtype([("segmentID", np.int64), ("area", np.int64), ("minX", np.int32), ("minY", np.int32), ("maxX", np.int32), ("maxY", np.int32), ("centroidX", np.float64), ("centroidY", np.float64),
+                                ("color", np.uint8, (3,)), ("meanColor", np.float64, (3,)), ("momentXX", np.float64), ("momentXY", np.float64), ("momentYY", np.float64), ("orientation", np.float64),
+                                ("regression", np.float64, (3,)), ("angle", np.float64), ("strokeClass", np.int8)])
+
+
+# Columnar table of the properties of all non-empty segments of a label array, built by afremize.getSegmentTable() in one pass over the label array and read by all later stages.
+# rows: a structured array of SEGMENT_TABLE_DTYPE with one row per segment, in painting order (by size from largest to smallest, see SegmentIndex.sortedBySize())
+# The points of the regression lines (see afremize.getRegLineCoordinates()) are concatenated in regLineX and regLineY, those of row i being [regLineOffsets[i]:regLineOffsets[i+1]].
+# numOfSegments: the number of segmentIDs of the label array, including empty ones, and thus the length of the arrays returned by byID()
+# The table is saved as a .npz file of these arrays and the names of the stroke classes (see save()), which numpy reads without this module.
+class SegmentTable(object):
+
+    def __init__(self, rows, regLineOffsets, regLineX, regLineY, numOfSegments):
+        self.rows = rows
+        self.regLineOffsets = regLineOffsets
+        self.regLineX = regLineX
+        self.regLineY = regLineY
+        self.numOfSegments = numOfSegments
+
+    def __len__(self):
+        return len(self.rows)
+
+    # returns the regression line of row as [x coordinates, y coordinates]
+    def regLine(self, row):
+        start, stop = self.regLineOffsets[row], self.regLineOffsets[row + 1]
+        return [self.regLineX[start:stop], self.regLineY[start:stop]]
+
+    # returns the column as an array indexed by segmentID, with fill for the empty segments, e.g. byID("color") to color the label array with palette[labels]
+    def byID(self, column, fill=0):
+        values = self.rows[column]
+        result = np.full((self.numOfSegments,) + values.shape[1:], fill, dtype=values.dtype)
+        result[self.rows["segmentID"]] = values
+        return result
+
+    def save(self, filename):
+        np.savez(filename, rows=self.rows, regLineOffsets=self.regLineOffsets, regLineX=self.regLineX, regLineY=self.regLineY, numOfSegments=self.numOfSegments, strokeClasses=np.array(STROKE_CLASSES))
+
+
+# loads a SegmentTable saved with SegmentTable.save()
+def loadSegmentTable(filename):
+    with np.load(filename) as arrays:
+        return SegmentTable(arrays["rows"], arrays["regLineOffsets"], arrays["regLineX"], arrays["regLineY"], int(arrays["numOfSegments"]))
+
+
+# Region adjacency graph of the segments of segmentIndex (a SegmentIndex or BandedSegmentIndex), computed in one pass over bands of blockRows rows of the label array.
+# Two segments are neighbours if a pixel of one of them lies directly left, right, above or below a pixel of the other one. The graph is kept as three arrays:
+# the segmentIDs segmentsA < segmentsB of every pair of neighbours and the length of their common border (boundaryLengths, the number of such pixel pairs).
+class RegionAdjacencyGraph(object):
+
+    # meanColors: the mean color of every segment, indexed by segmentID (see SegmentTable.byID())
+    def __init__(self, segmentIndex, meanColors, blockRows=256):
+        numOfSegments = len(segmentIndex)
+        borders = []  # (pairs, lengths) of the borders found in each band, a pair being segmentA * numOfSegments + segmentB
+        lastRow = None
+        for top, labels in segmentIndex.labelBands(blockRows):
+            borders.append(getBorders(labels[:, :-1], labels[:, 1:], numOfSegments))
+            borders.append(getBorders(labels[:-1], labels[1:], numOfSegments))
+            if lastRow is not None:
+                borders.append(getBorders(lastRow, labels[0], numOfSegments))
+            lastRow = np.array(labels[-1])
+        pairs = np.concatenate([pairs for pairs, lengths in borders] + [np.zeros(0, dtype=np.int64)])
+        lengths = np.concatenate([lengths for pairs, lengths in borders] + [np.zeros(0, dtype=np.int64)])
+        pairs, inverse = np.unique(pairs, return_inverse=True)
+        self.boundaryLengths = np.bincount(inverse.ravel(), weights=lengths, minlength=len(pairs))
+        self.segmentsA, self.segmentsB = np.divmod(pairs, numOfSegments)
+        self.meanColors = meanColors
+
+    # returns the contrast of every segment to its neighbours, indexed by segmentID: the L1 distance of the segment's mean color to the mean colors of its neighbours, averaged over the segment's border,
+    # times 4, which puts it into the range 0..3060 of colDiff (see afremize.planStrokes()), as it used to be the sum of the distances to 4 pixels. It is 0 for segments without neighbours.
+    def contrast(self):
+        numOfSegments = len(self.meanColors)
+        distances = np.abs(self.meanColors[self.segmentsA] - self.meanColors[self.segmentsB]).sum(axis=1) * self.boundaryLengths
+        weightedSums = np.bincount(self.segmentsA, weights=distances, minlength=numOfSegments) + np.bincount(self.segmentsB, weights=distances, minlength=numOfSegments)
+        borderLengths = np.bincount(self.segmentsA, weights=self.boundaryLengths, minlength=numOfSegments) + np.bincount(self.segmentsB, weights=self.boundaryLengths, minlength=numOfSegments)
+        return 4 * weightedSums / np.maximum(borderLengths, 1)
+
+
+# returns the borders between the label arrays labelsA and labelsB of the same shape, whose pixels are neighbours pixel by pixel: the pairs of different segments a < b as a * numOfSegments + b, without repetitions, and the number of pixels of each pair
+def getBorders(labelsA, labelsB, numOfSegments):
+    different = labelsA != labelsB
+    labelsA, labelsB = labelsA[different].astype(np.int64), labelsB[different].astype(np.int64)
+    return np.unique(np.minimum(labelsA, labelsB) * numOfSegments + np.maximum(labelsA, labelsB), return_counts=True)
+
+
+# Index of a label array too large to sort its pixels, like the memory-mapped label arrays of out-of-core conversions (see outOfCore.py).
+# It is built in one pass over bands of bandRows rows and keeps per-segment data only: the number of pixels, the bounding box and the first pixel (in row-major order) of every segment.
+# pixels() searches the segment's bounding box in the label array, which is fast for the small and thin segments it is needed for (hairlines, segments without width or height).
+# release: called after each band read from the label array, e.g. to drop the pages of a memory-mapped label array from memory again, and by pixels() whenever the rows it searched add up to bandRows
+class BandedSegmentIndex(object):
+
+    def __init__(self, segmentsNP, bandRows=256, release=None):
+        self.labels = segmentsNP
+        self.height, self.width = segmentsNP.shape
+        self.release = release
+        self.bandRows = bandRows
+        self.rowsSearched = 0  # by pixels() since the last release
+        numOfSegments = 1 + max(int(labels.max()) for top, labels in self.labelBands(bandRows))
+        self.sizes = np.zeros(numOfSegments, dtype=np.int64)
+        self.minX = np.full(numOfSegments, self.width, dtype=np.int64)
+        self.maxX = np.full(numOfSegments, -1, dtype=np.int64)
+        self.minY = np.zeros(numOfSegments, dtype=np.int64)
+        self.maxY = np.zeros(numOfSegments, dtype=np.int64)
+        self.first = np.full(numOfSegments, -1, dtype=np.int64)  # flat index of the first pixel
+        for top, labels in self.labelBands(bandRows):
+            labels = labels.ravel()
+            self.sizes += np.bincount(labels, minlength=numOfSegments)
+            xs = np.tile(np.arange(self.width), len(labels) // self.width)
+            np.minimum.at(self.minX, labels, xs)
+            np.maximum.at(self.maxX, labels, xs)
+            segmentIDs, firstInBand = np.unique(labels, return_index=True)
+            lastInBand = len(labels) - 1 - np.unique(labels[::-1], return_index=True)[1]
+            new = self.first[segmentIDs] < 0
+            self.first[segmentIDs[new]] = top * self.width + firstInBand[new]
+            self.minY[segmentIDs[new]] = top + firstInBand[new] // self.width
+            self.maxY[segmentIDs] = top + lastInBand // self.width
+        empty = self.sizes == 0
+        self.minX[empty] = 0
+        self.maxX[empty] = 0
+        self.first[empty] = 0
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def size(self, segmentID):
+        return int(self.sizes[segmentID])
+
+    # returns the x and y coordinates of all pixels of the segment as two arrays, in row-major order like SegmentIndex.pixels()
+    def pixels(self, segmentID):
+        minX, maxX, minY, maxY = self.minX[segmentID], self.maxX[segmentID], self.minY[segmentID], self.maxY[segmentID]
+        ys, xs = np.nonzero(self.labels[minY:maxY + 1, minX:maxX + 1] == segmentID)
+        self.rowsSearched += maxY - minY + 1
+        if self.release != None and self.rowsSearched >= self.bandRows:
+            self.release()
+            self.rowsSearched = 0
+        return xs + minX, ys + minY
+
+    def representative(self, segmentID):
+        y, x = divmod(int(self.first[segmentID]), self.width)
+        return x, y
+
+    def representatives(self):
+        ys, xs = np.divmod(self.first, self.width)
+        return xs, ys
+
+    def sortedBySize(self):
+        segmentIDs = np.arange(len(self.sizes))
+        return np.lexsort((-segmentIDs, -self.sizes))
+
+    def boundingBoxes(self):
+        return self.minX.copy(), self.maxX.copy(), self.minY.copy(), self.maxY.copy()
+
+    def labelBands(self, blockRows):
+        for top in range(0, self.height, blockRows):
+            yield top, self.labels[top:top + blockRows]
+            if self.release != None:
+                self.release()
@@ -0,0 +1,458 @@
+# Copyright (C) 2015 Jana Cavojska
+# This file is part of 'Afremize'.
+
+# 'Afremize' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+
+# 'Afremize' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with 'Afremize'.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division
+from __future__ import print_function
+import io
+import json
+import math
+import multiprocessing
+import signal
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from optparse import OptionParser
+from PIL import Image
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qsl
+
+# own imports:
+import afremize
+import imgIO
+import segCache
+
+
+# Local HTTP service converting pictures with a pool of worker processes, which stay alive between requests.
+# The workers import numpy, scipy and skimage and paint a small warm-up picture once when they are started, so requests do not pay for that, and they keep the stroke template cache (see brushstroke.templateCache) and the optional segmentation cache between requests.
+# Requests waiting for a worker are queued. When the queue is full, a request is answered at once with 503 and a Retry-After header instead of waiting.
+# A request taking longer than the timeout (including its time in the queue) is answered with 504, and the worker painting it is replaced by a new one.
+#
+#   POST /convert?OPTION=VALUE&...   body: the picture (any format PIL reads), answer: the painted picture as PNG
+#                                    OPTIONS: those of REQUEST_OPTIONS, as in afremize.convertImage(), e.g. /convert?strokeWidth=50&seed=1
+#   GET /health                      {"status": "ok"}, or "degraded" (with 503 if no worker is up) while workers are replaced
+#   GET /metrics                     counters of the requests and their outcome, queue length and latencies, as JSON
+
+
+WARMUP_MEGAPIXELS = 0.05  # size of the synthetic picture painted by every worker when it is started
+LATENCY_WINDOW = 200  # number of recent requests the latencies of /metrics are computed from
+
+
+def parseBool(value):
+    if value.lower() in ("", "1", "true", "yes", "on"):
+        return True
+    if value.lower() in ("0", "false", "no", "off"):
+        return False
+    raise ValueError("not a boolean: " + value)
+
+
+def parseBackground(value):
+    if value not in ("blur", "cluster", "none"):
+        raise ValueError("background must be blur, cluster or none")
+    return value
+
+
+# the seeds of the random streams (see afremize.getStreamSeed()) have to be non-negative
+def parseSeed(value):
+    seed = int(value)
+    if seed < 0:
+        raise ValueError("seed must be a non-negative integer")
+    return seed
+
+
+def parseRandSizes(value):
+    return min(100, max(1, int(value)))
+
+
+# the options of afremize.convertImage() a request may set in its query string, and the functions parsing their values
+REQUEST_OPTIONS = {
+    "strokeWidth": int,
+    "strokeHeight": int,
+    "strokeDensity": int,
+    "randSizes": parseRandSizes,
+    "longStrokes": parseBool,
+    "directedRotate": parseBool,
+    "background": parseBackground,
+    "noHairlines": parseBool,
+    "noMargins": parseBool,
+    "segBound": int,
+    "colDiff": int,
+    "ground": parseBool,
+    "saturation": float,
+    "highlight": parseBool,
+    "colorify": int,
+    "felzScale": int,
+    "felzSigma": float,
+    "felzMinsize": int,
+    "seed": parseSeed,
+    "preview": parseBool,
+    "previewLatency": float,
+    }
+
+# the defaults of main.py which differ from those of afremize.convertImage(): the stroke sizes and segBound are computed from the size of the picture
+DEFAULT_OPTIONS = dict(strokeWidth=None, strokeHeight=None, strokeDensity=None, segBound=None)
+
+# the HTTP status of every outcome of RenderService.render()
+HTTP_STATUS = {"ok": 200, "badImage": 400, "error": 500, "rejected": 503, "timeout": 504}
+
+
+# returns the keyword arguments for afremize.convertImage() given by the query string query. Raises ValueError for unknown options and invalid values.
+def parseOptions(query):
+    options = dict(DEFAULT_OPTIONS)
+    for name, value in parse_qsl(query, keep_blank_values=True):
+        if name not in REQUEST_OPTIONS:
+            raise ValueError("unknown option: " + name)
+        try:
+            options[name] = REQUEST_OPTIONS[name](value)
+        except ValueError:
+            raise ValueError("invalid value of " + name + ": " + value)
+    return options
+
+
+# converts the picture imageData (the content of a picture file) with the keyword arguments options for afremize.convertImage()
+# returns (status, data): ("ok", the painted picture as PNG), ("badImage", message) if imageData cannot be read, or ("error", message)
+def renderImage(imageData, options, segmentationCache=None):
+    try:
+        inIm = Image.open(io.BytesIO(imageData))
+        inIm.load()
+    except Exception as e:  # PIL raises various errors for data it cannot decode
+        return "badImage", "cannot read the picture (" + type(e).__name__ + ": " + str(e) + ")"
+    try:
+        outIm = afremize.convertImage("request.png", inIm=inIm, webinterface=True, segCache=segmentationCache, **options)
+        if options.get("preview"):
+            outIm = outIm[0]  # without the plan
+        outFile = io.BytesIO()
+        outIm.save(outFile, "PNG")
+    except Exception as e:  # e.g. a MemoryError, which must not end the worker
+        return "error", type(e).__name__ + ": " + str(e)
+    return "ok", outFile.getvalue()
+
+
+# the main function of a worker process: paints a warm-up picture, sends ("ready", None) and then answers every request (imageData, options) received through the pipe conn with renderImage(), until it receives None
+def workerLoop(conn, segCacheDir=None, segCacheSize=None):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C stops the server, which then stops its workers
+    segmentationCache = None if segCacheDir == None else segCache.SegmentationCache(segCacheDir, segCacheSize)
+    renderImage(b"", {})  # not a picture, but PIL's decoders get loaded
+    afremize.convertImage("warmup.png", inIm=imgIO.syntheticImage(WARMUP_MEGAPIXELS), webinterface=True, seed=0, **DEFAULT_OPTIONS)
+    conn.send(("ready", None))
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:  # the server was stopped
+            break
+        if task == None:
+            break
+        imageData, options = task
+        conn.send(renderImage(imageData, options, segmentationCache))
+    conn.close()
+
+
+# a worker process of RenderService, started with workerLoop() and reached through the pipe conn
+class Worker(object):
+
+    def __init__(self, segCacheDir=None, segCacheSize=None):
+        self.conn, workerConn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=workerLoop, args=(workerConn, segCacheDir, segCacheSize))
+        self.process.daemon = True
+        self.process.start()
+        workerConn.close()
+
+    # waits until the worker is warmed up, returns False if it died before
+    def waitReady(self):
+        try:
+            status, data = self.conn.recv()
+        except (EOFError, IOError, OSError):
+            return False
+        return status == "ready"
+
+    # sends the request to the worker and returns its answer (status, data) as renderImage(), or ("timeout", None) if there was no answer within timeout seconds, or ("died", None)
+    def render(self, imageData, options, timeout):
+        try:
+            self.conn.send((imageData, options))
+            if not self.conn.poll(max(0, timeout)):
+                return "timeout", None
+            return self.conn.recv()
+        except (EOFError, IOError, OSError):  # the worker died, e.g. killed for lack of memory
+            return "died", None
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (IOError, OSError):
+            pass
+        self.process.join(5)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+
+
+# Pool of numOfWorkers Worker processes with a queue of at most queueSize requests waiting for one of them.
+# Each request may take up to timeout seconds, from its arrival until it is painted. Workers which time out or die are replaced.
+# lean: if True, all pictures are converted with afremize.convertImage(..., lean=True), which needs less memory per worker
+class RenderService(object):
+
+    def __init__(self, numOfWorkers=1, queueSize=4, timeout=120, segCacheDir=None, segCacheSize=2048 * 1024**2, lean=False):
+        self.numOfWorkers = numOfWorkers
+        self.lean = lean
+        self.queueSize = queueSize
+        self.timeout = timeout
+        self.segCacheDir = segCacheDir
+        self.segCacheSize = segCacheSize
+        self.lock = threading.Condition()
+        self.idle = []  # the workers ready for a request
+        self.busy = []
+        self.waiting = 0  # number of requests in the queue
+        self.stopped = False
+        self.started = time.time()
+        self.counters = OrderedDict((name, 0) for name in ("requests", "completed", "badImages", "failed", "rejected", "timedOut", "workerRestarts"))
+        self.latencies = deque(maxlen=LATENCY_WINDOW)  # seconds from arrival to answer of the recent completed requests
+        self.renderTimes = deque(maxlen=LATENCY_WINDOW)  # seconds the workers needed for them
+        starting = [Worker(segCacheDir, segCacheSize) for i in range(0, numOfWorkers)]  # warmed up in parallel
+        for worker in starting:
+            self.addWorker(worker)
+
+    # waits until worker is warmed up and adds it to the idle workers. A worker dying during its warm-up is not replaced, as the next one would most likely die as well.
+    def addWorker(self, worker):
+        if not worker.waitReady():
+            worker.kill()
+            return
+        with self.lock:
+            if self.stopped:
+                worker.stop()
+                return
+            self.idle.append(worker)
+            self.lock.notify()
+
+    # kills worker and starts a new worker in the background
+    def replaceWorker(self, worker):
+        worker.kill()
+        with self.lock:
+            self.counters["workerRestarts"] += 1
+            if self.stopped:
+                return
+        newWorker = Worker(self.segCacheDir, self.segCacheSize)
+        thread = threading.Thread(target=self.addWorker, args=(newWorker,))
+        thread.daemon = True
+        thread.start()
+
+    # returns the seconds after which a rejected request should be retried: the time until the workers got through the queue, judged by the recent render times
+    def getRetryAfter(self):
+        renderTime = sum(self.renderTimes) / len(self.renderTimes) if self.renderTimes else 1
+        return max(1, int(math.ceil(renderTime * (self.waiting + 1) / self.numOfWorkers)))
+
+    # converts the picture imageData with the keyword arguments options for afremize.convertImage()
+    # returns (status, data, retryAfter): status and data as renderImage() returns them, or ("rejected", message, seconds to wait before retrying) if the queue is full, or ("timeout", message, None)
+    def render(self, imageData, options):
+        arrival = time.time()
+        deadline = arrival + self.timeout
+        with self.lock:
+            self.counters["requests"] += 1
+            if not self.idle and self.waiting >= self.queueSize:
+                self.counters["rejected"] += 1
+                return "rejected", "the queue is full", self.getRetryAfter()
+            self.waiting += 1
+            try:
+                while not self.idle and time.time() < deadline:
+                    self.lock.wait(deadline - time.time())
+            finally:
+                self.waiting -= 1
+            if not self.idle:
+                self.counters["timedOut"] += 1
+                return "timeout", "no worker became free within " + str(self.timeout) + " s", None
+            worker = self.idle.pop()
+            self.busy.append(worker)
+
+        start = time.time()
+        status, data = worker.render(imageData, dict(options, lean=True) if self.lean else options, deadline - start)
+        end = time.time()
+        with self.lock:
+            self.busy.remove(worker)
+            if status not in ("timeout", "died"):
+                self.idle.append(worker)
+                self.lock.notify()
+        if status in ("timeout", "died"):
+            self.replaceWorker(worker)
+            with self.lock:
+                if status == "timeout":
+                    self.counters["timedOut"] += 1
+                    return "timeout", "the picture was not painted within " + str(self.timeout) + " s", None
+                self.counters["failed"] += 1
+                return "error", "the worker process died (exit code " + str(worker.process.exitcode) + ")", None
+
+        with self.lock:
+            if status == "ok":
+                self.counters["completed"] += 1
+                self.latencies.append(end - arrival)
+                self.renderTimes.append(end - start)
+            else:
+                self.counters["badImages" if status == "badImage" else "failed"] += 1
+        return status, data, None
+
+    # returns (status, health) for /health: "ok" if all workers are up, "degraded" while some of them are being replaced, "down" if none is up
+    def health(self):
+        with self.lock:
+            up = len(self.idle) + len(self.busy)
+        status = "ok" if up == self.numOfWorkers else "degraded" if up > 0 else "down"
+        return status, OrderedDict([("status", status), ("workers", self.numOfWorkers), ("workersUp", up)])
+
+    # returns the metrics for /metrics
+    def metrics(self):
+        with self.lock:
+            metrics = OrderedDict()
+            metrics["uptime"] = round(time.time() - self.started, 1)
+            metrics["workers"] = self.numOfWorkers
+            metrics["idleWorkers"] = len(self.idle)
+            metrics["busyWorkers"] = len(self.busy)
+            metrics["queued"] = self.waiting
+            metrics["queueSize"] = self.queueSize
+            metrics.update(self.counters)
+            latencies = sorted(self.latencies)
+            renderTimes = list(self.renderTimes)
+        for name, percentile in (("latency50", 0.5), ("latency95", 0.95), ("latencyMax", 1)):
+            metrics[name] = round(latencies[min(len(latencies) - 1, int(percentile * len(latencies)))], 3) if latencies else None
+        metrics["renderTimeMean"] = round(sum(renderTimes) / len(renderTimes), 3) if renderTimes else None
+        return metrics
+
+    # stops all workers, requests still being painted fail
+    def close(self):
+        with self.lock:
+            self.stopped = True
+            workers = self.idle + self.busy
+            self.idle = []
+        for worker in workers:
+            worker.stop()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/health":
+            status, health = self.server.service.health()
+            self.sendJSON(503 if status == "down" else 200, health)
+        elif path == "/metrics":
+            self.sendJSON(200, self.server.service.metrics())
+        else:
+            self.sendJSON(404, {"error": "unknown path " + path})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/convert":
+            self.close_connection = True  # the body is not read
+            self.sendJSON(404, {"error": "unknown path " + url.path})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length <= 0:
+            self.sendJSON(411, {"error": "the picture must be sent as the body of the request, with a Content-Length"})
+            return
+        if length > self.server.maxUpload:
+            self.close_connection = True
+            self.sendJSON(413, {"error": "the picture is larger than " + str(self.server.maxUpload // 1024**2) + " MB"})
+            return
+        imageData = self.rfile.read(length)
+        try:
+            options = parseOptions(url.query)
+        except ValueError as e:
+            self.sendJSON(400, {"error": str(e)})
+            return
+
+        status, data, retryAfter = self.server.service.render(imageData, options)
+        if status == "ok":
+            self.sendData(200, data, "image/png")
+        else:
+            self.sendJSON(HTTP_STATUS[status], {"error": data}, None if retryAfter == None else {"Retry-After": str(retryAfter)})
+
+    def sendJSON(self, code, content, headers=None):
+        self.sendData(code, json.dumps(content, indent=1).encode("utf-8"), "application/json", headers)
+
+    def sendData(self, code, data, contentType, headers=None):
+        self.send_response(code)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+# HTTP server answering every request in a thread of its own, with the RenderService service
+class RenderServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service, maxUpload=50 * 1024**2, verbose=False):
+        HTTPServer.__init__(self, address, RequestHandler)
+        self.service = service
+        self.maxUpload = maxUpload
+        self.verbose = verbose
+
+
+if __name__ == "__main__":
+
+    parser = OptionParser()
+    parser.add_option("--host",
+                      dest="host", default="127.0.0.1",
+                      help="Address the server listens on. [default: %default]")
+    parser.add_option("--port",
+                      dest="port", default=8080,
+                      help="Port the server listens on. [default: %default]")
+    parser.add_option("--workers",
+                      dest="workers", default=1,
+                      help="Number of worker processes converting pictures. Each of them needs the memory of a conversion (see the README). [default: %default]")
+    parser.add_option("--queueSize",
+                      dest="queueSize", default=4,
+                      help="Number of requests which may wait for a free worker. Further requests are answered with 503 and a Retry-After header. [default: %default]")
+    parser.add_option("--timeout",
+                      dest="timeout", default=120,
+                      help="Seconds a request may take, including its time in the queue, before it is answered with 504. A worker still painting it is replaced. [default: %default]")
+    parser.add_option("--maxUpload",
+                      dest="maxUpload", default=50,
+                      help="Maximum size of an uploaded picture in MB. [default: %default]")
+    parser.add_option("--segCache",
+                      dest="segCache",
+                      help="Directory of a segmentation cache shared by the workers (see main.py --segCache). [default: no cache]")
+    parser.add_option("--segCacheSize",
+                      dest="segCacheSize", default=2048,
+                      help="Maximum size of the segmentation cache in MB. [default: %default]")
+    parser.add_option("--lean",
+                      action="store_true", dest="lean", default=False,
+                      help="Convert the pictures with less memory per worker (see main.py --lean). [default: %default]")
+    parser.add_option("-v", "--verbose",
+                      action="store_true", dest="verbose", default=False,
+                      help="Log every request to stderr. [default: %default]")
+
+    (options, args) = parser.parse_args()
+
+    print("starting " + str(options.workers) + " workers")
+    service = RenderService(max(1, int(options.workers)), max(0, int(options.queueSize)), float(options.timeout), options.segCache, int(options.segCacheSize) * 1024**2, options.lean)
+    server = RenderServer((options.host, int(options.port)), service, int(float(options.maxUpload) * 1024**2), options.verbose)
+    if service.health()[0] == "down":
+        sys.exit("the workers could not be started")
+    print("listening on http://" + options.host + ":" + str(server.server_address[1]) + "/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
@@ -0,0 +1,114 @@
+# Copyright (C) 2015 Jana Cavojska
+# This file is part of 'Afremize'.
+
+# 'Afremize' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+
+# 'Afremize' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with 'Afremize'.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+from PIL import Image
+from math import ceil, sqrt
+import multiprocessing
+import random
+import time
+
+# own imports:
+import brushstroke
+import canvas
+import profiling
+
+
+# Tiled rendering of one image with several processes.
+# All brush strokes are planned first (see afremize.planStrokes()) and each gets its own random seed (unless planned with one already), so a stroke looks the same no matter which process paints it.
+# The canvas is split into tiles, and every process paints the strokes whose footprint (the area a stroke can cover after rotation) intersects its tile,
+# in painting order, on a copy of the tile. Strokes near the tile borders are therefore painted by all tiles they reach into (the halo around a tile is as wide as the largest stroke),
+# and since blending only depends on the strokes covering a pixel and their order, copying the tiles back gives the same image as painting all strokes one after another on the whole canvas.
+
+
+# returns the footprint (left, top, right, bottom) of a stroke planned by afremize.planStrokes(): no pixel of the pasted brush stroke lies outside of it
+def strokeFootprint(stroke):
+    strokeType, X, Y, params, strokeSeed = stroke
+    if strokeType == "simple":
+        sizeX, sizeY, angle, color, regLine = params
+        # the stroke image is at most sizeX + max(arc) + 1 pixels wide and len(arc) high, randomizeArc() moves the arc by at most one pixel per row,
+        # and it is pasted so that (X, Y) is a pixel of the stroke, so every pixel of the rotated stroke is closer to (X, Y) than the diagonal of the stroke image:
+        arcLength = len(regLine[0])
+        strokeWidth = sizeX + int(brushstroke.create_arc_from_regLine(regLine).max()) + arcLength + 1
+        radius = sqrt(strokeWidth**2 + arcLength**2)
+    else:
+        sizeX, sizeY, startColors, endColors, angleStart, angleStop, groundSegment = params
+        # the rotated stroke image is centered on (X, Y) and its diagonal is shorter than 2*sqrt(sizeX^2 + sizeY^2), even for ground segments (0.4*sizeX wide and 2*sizeY high)
+        radius = sqrt(sizeX**2 + sizeY**2)
+    radius = int(ceil(radius)) + 4  # rounding and the support of the resampling filter
+    return X - radius, Y - radius, X + radius + 1, Y + radius + 1
+
+
+# splits a canvas of size width x height into about numOfTiles tiles of similar size and returns them as a list of (left, top, right, bottom)
+def getTiles(width, height, numOfTiles):
+    cols = max(1, min(width, int(round(sqrt(numOfTiles * width / height)))))
+    rows = max(1, min(height, int(ceil(numOfTiles / cols))))
+    xs = [(width * i) // cols for i in range(0, cols + 1)]
+    ys = [(height * j) // rows for j in range(0, rows + 1)]
+    return [(xs[i], ys[j], xs[i + 1], ys[j + 1]) for j in range(0, rows) for i in range(0, cols)]
+
+
+# paints the strokes of one tile. task: (tile, tilePixels, mode, strokes, options, timeHotPaths) as built by paintTiled(), timeHotPaths None for no profile
+# runs in the worker processes, returns the tile, its painted pixels and, if profiled, a profiling.Profile of the painting (the time of the strokes of each type and of the hot paths, see brushstroke.paintStroke()), otherwise None
+def paintTile(task):
+    tile, tilePixels, mode, strokes, options, timeHotPaths = task
+    colorify, noMargins, vectorized, cacheTemplates, directRaster, resample = options
+    templateCache = brushstroke.templateCache if cacheTemplates else None
+    profile = profiling.Profile(timeHotPaths) if timeHotPaths != None else None
+    tileCanvas = canvas.Canvas(Image.fromarray(tilePixels, mode), origin=tile[:2])
+    for stroke in strokes:
+        if profile != None:
+            start = time.time()
+        brushstroke.paintStroke(tileCanvas, stroke, colorify=colorify, noMargins=noMargins, vectorized=vectorized, templateCache=templateCache, directRaster=directRaster, resample=resample, profile=profile)
+        if profile != None:
+            profile.addTime(stroke[0] + "Strokes", time.time() - start)
+    return tile, tileCanvas.pixels, profile
+
+
+# paints the planned strokes on outCanvas using a pool of renderJobs processes
+# strokes: an iterable of strokes as yielded by afremize.planStrokes(), in painting order
+# profile: a profiling.Profile the profiles of the tiles are merged into (see paintTile()), or None. Strokes reaching into several tiles are painted, and counted, once per tile.
+# the other arguments are passed on to brushstroke.paintStroke()
+def paintTiled(outCanvas, strokes, renderJobs, verbose=False, colorify=0, noMargins=False, vectorized=True, cacheTemplates=True, directRaster=True, resample="bicubic", profile=None):
+    plannedStrokes = [stroke if stroke[4] != None else stroke[:4] + (random.getrandbits(32),) for stroke in strokes]
+    if len(plannedStrokes) == 0:
+        return
+    footprints = np.array([strokeFootprint(stroke) for stroke in plannedStrokes])
+    halo = int((footprints[:, 2] - footprints[:, 0]).max() // 2)
+    
+    # more tiles than processes, so that processes which got tiles with few strokes can take over others:
+    tiles = getTiles(outCanvas.width, outCanvas.height, 2 * renderJobs)
+    options = (colorify, noMargins, vectorized, cacheTemplates, directRaster, resample)
+    tasks = []
+    for tile in tiles:
+        left, top, right, bottom = tile
+        hits = np.nonzero((footprints[:, 0] < right) & (footprints[:, 2] > left) & (footprints[:, 1] < bottom) & (footprints[:, 3] > top))[0]
+        if len(hits) > 0:
+            tasks.append((tile, outCanvas.pixels[top:bottom, left:right], outCanvas.mode, [plannedStrokes[i] for i in hits], options, profile.timeHotPaths if profile != None else None))
+    if verbose:
+        print("tiled rendering: "+str(len(plannedStrokes))+" strokes, "+str(len(tiles))+" tiles, halo "+str(halo)+" px, "+str(sum(len(task[3]) for task in tasks))+" stroke paintings")
+    
+    pool = multiprocessing.Pool(renderJobs)
+    try:
+        for tile, tilePixels, tileProfile in pool.imap_unordered(paintTile, tasks):
+            left, top, right, bottom = tile
+            outCanvas.pixels[top:bottom, left:right] = tilePixels
+            if tileProfile != None:
+                profile.merge(tileProfile)
+    finally:
+        pool.close()
+        pool.join()